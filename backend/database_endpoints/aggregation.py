@@ -0,0 +1,153 @@
+from typing import Dict, List, Any, Union
+
+import numpy as np
+import pandas as pd
+
+from backend.database_endpoints.expended_query import ExpendedQuery
+from backend.utils.utils import iso8601_series_to_microseconds
+from utils.errors import InvalidRequestError, ValidationError
+
+# width of the named buckets of a bookings aggregate, in seconds
+BUCKET_SECONDS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+# 1970-01-01 is a Thursday, weeks are bucketed from Mondays
+_WEEK_SHIFT_SECONDS = 3 * 86400
+AGGREGATES = ("count", "tickets", "bookings", "utilization", "top")
+
+
+def _python(value: Any) -> Any:
+    """
+    A value as it is serialized in a response
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ExpendedAggregation:
+    """
+    Aggregates a GET computes over the expended rows of every entity it covers, instead of returning the rows.
+    The rows are those the filters and time range of the request select, read with only the columns the aggregates use,
+    and each aggregate is a vectorized pass over them:
+        count: {} -> number of rows
+        tickets: {} -> tickets sold, of those available, on a Ticketed entity
+        bookings: {"bucket": "hour" | "day" | "week" | seconds} -> slots starting in each bucket, on a Slotted entity
+        utilization: {} -> share of [from, until] the slots cover, on a Slotted entity
+        top: {"by": collected column, "n": 10} -> the n values of a column with the most tickets, or rows if Slotted
+    """
+
+    def __init__(self, aggregates: Dict[str, Dict[str, Any]]):
+        """
+        :param aggregates: Name of the aggregate -> its options
+        """
+        self.aggregates = aggregates
+
+    @staticmethod
+    def validate_request(data: Dict) -> None:
+        """
+        Checks the aggregate key of a GET request
+        :param data: The raw request
+        :return:
+        """
+        if "aggregate" not in data:
+            return
+        aggregates = data["aggregate"]
+        if not isinstance(aggregates, dict) or len(aggregates) == 0:
+            raise ValidationError(f"aggregate must map some of {list(AGGREGATES)} to their options.")
+        for name, options in aggregates.items():
+            if name not in AGGREGATES:
+                raise ValidationError(f"Unknown aggregate {name}, expected one of {list(AGGREGATES)}.")
+            if not isinstance(options, dict):
+                raise ValidationError(f"The options of aggregate {name} must be an object.")
+        paged = [key for key in ("columns", "limit", "cursor") if key in data]
+        if len(paged) > 0:
+            raise ValidationError(f"An aggregate can not be paged or projected, remove {paged}.")
+        bucket = aggregates.get("bookings", {}).get("bucket", "day")
+        if not (bucket in BUCKET_SECONDS or (isinstance(bucket, int) and not isinstance(bucket, bool) and bucket > 0)):
+            raise ValidationError(f"bookings bucket must be one of {list(BUCKET_SECONDS)} or a positive number of seconds.")
+        if "utilization" in aggregates and not ("from" in data and "until" in data):
+            raise ValidationError("utilization needs the window it is computed over, from and until.")
+        if "top" in aggregates:
+            top = aggregates["top"]
+            if not isinstance(top.get("by"), str):
+                raise ValidationError("top must name the collected column it ranks, by.")
+            n = top.get("n", 10)
+            if not isinstance(n, int) or isinstance(n, bool) or n <= 0:
+                raise ValidationError("top n must be a positive integer.")
+
+    @staticmethod
+    def from_request(data: Dict) -> Union["ExpendedAggregation", None]:
+        """
+        :param data: A validated GET request
+        :return: The aggregation, None if the request does not ask for one
+        """
+        if "aggregate" not in data:
+            return None
+        return ExpendedAggregation(data["aggregate"])
+
+    def columns(self, schema) -> List[str]:
+        """
+        :param schema: RequestSchema of the entity aggregated
+        :return: The columns the aggregates read, checked against the entity
+        """
+        collected = [field.column for field in schema.collected]
+        columns = []
+        if "tickets" in self.aggregates:
+            if schema.start is not None:
+                raise InvalidRequestError("tickets can only be aggregated on a Ticketed entity.")
+            columns.append("quantity")
+        if "bookings" in self.aggregates or "utilization" in self.aggregates:
+            if schema.start is None:
+                raise InvalidRequestError("bookings and utilization can only be aggregated on a Slotted entity.")
+            columns.extend([schema.start.column, schema.end.column])
+        if "top" in self.aggregates:
+            if schema.start is None:
+                # tickets are ranked, not rows
+                columns.append("quantity")
+            if self.aggregates["top"]["by"] not in collected:
+                raise InvalidRequestError(f"top can only rank collected columns, {self.aggregates['top']['by']} is not.")
+            columns.append(self.aggregates["top"]["by"])
+        return list(dict.fromkeys(columns))
+
+    def compute(self, frame: pd.DataFrame, schema, information: pd.DataFrame, query: ExpendedQuery) -> Dict[str, Any]:
+        """
+        :param frame: The selected rows, with the columns of this aggregation
+        :param schema: RequestSchema of the entity
+        :param information: Info sheet of the entity
+        :param query: The filters the rows were selected with
+        :return: Name of the aggregate -> its value
+        """
+        results = {}
+        starts = ends = None
+        if schema.start is not None and ("bookings" in self.aggregates or "utilization" in self.aggregates):
+            starts, valid_starts = iso8601_series_to_microseconds(frame[schema.start.column])
+            ends, valid_ends = iso8601_series_to_microseconds(frame[schema.end.column])
+            valid = valid_starts & valid_ends
+            starts, ends = starts[valid], ends[valid]
+        quantities = None
+        if "quantity" in frame.columns:
+            quantities = pd.to_numeric(frame["quantity"], errors="coerce").fillna(0).astype(np.int64)
+
+        if "count" in self.aggregates:
+            results["count"] = len(frame)
+        if "tickets" in self.aggregates:
+            sold, available = int(quantities.sum()), int(information.available[0])
+            results["tickets"] = {"sold": sold, "available": available,
+                                  "percent_sold": 100 * sold / available if available > 0 else None}
+        if "bookings" in self.aggregates:
+            bucket = self.aggregates["bookings"].get("bucket", "day")
+            width = BUCKET_SECONDS.get(bucket, bucket) * 1000000
+            shift = _WEEK_SHIFT_SECONDS * 1000000 if bucket == "week" else 0
+            buckets, counts = np.unique((starts + shift) // width * width - shift, return_counts=True)
+            labels = np.datetime_as_string(buckets.astype("datetime64[us]"), unit="s")
+            results["bookings"] = {f"{label}Z": int(count) for label, count in zip(labels, counts)}
+        if "utilization" in self.aggregates:
+            low, high = query.overlapping
+            booked = np.clip(np.minimum(ends, high) - np.maximum(starts, low), 0, None).sum()
+            # overlapping slots of a non-strict entity are each counted, so it may pass 100
+            results["utilization"] = {"window_seconds": (high - low) / 1000000, "booked_seconds": int(booked) / 1000000,
+                                      "percent": 100 * int(booked) / (high - low) if high > low else None}
+        if "top" in self.aggregates:
+            by, n = self.aggregates["top"]["by"], self.aggregates["top"].get("n", 10)
+            amounts = frame.groupby(by, sort=False).size() if quantities is None \
+                else quantities.groupby(frame[by], sort=False).sum()
+            amounts = amounts.sort_values(ascending=False, kind="stable").iloc[:n]
+            results["top"] = [[_python(value), _python(amount)] for value, amount in amounts.items()]
+        return results
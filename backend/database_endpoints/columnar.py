@@ -0,0 +1,205 @@
+import json
+import math
+import os
+import shutil
+from typing import Dict, List, Any, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from backend.utils.utils import validate_iso8601, iso8601_to_microseconds
+
+COLUMNAR_VERSION = 1
+META_FILE_NAME = "meta.json"
+# stands for a missing time in a timestamp column
+MISSING_TIME = np.iinfo(np.int64).min
+
+
+def _encodable(value: Any) -> Any:
+    """
+    A value as stored in a dictionary, missing values are None
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ColumnarTable:
+    """
+    A snapshot of an expended table, stored column by column in a directory and memory-mapped when loaded,
+    so that a reader only touches the pages of the columns and rows it asks for, and the OS shares them across workers.
+
+    Numeric columns are stored as fixed-width NumPy arrays. Other columns are dictionary encoded: an int32 code per row,
+    and the distinct values in JSON. Columns of ISO 8601 times also store them as int64 microseconds since the epoch.
+    Every write goes to a new generation directory, and meta.json, which names the current one, is replaced atomically.
+    """
+
+    def __init__(self, directory: str, meta: Dict[str, Any]):
+        self.meta = meta
+        self.rows = meta["rows"]
+        self._generation = f"{directory}/{meta['generation']}"
+        self._columns = {}
+        self._dictionaries = {}
+        self._timestamps = {}
+        # map every file now, so that the generation can be removed while this table is in use
+        for column in meta["columns"]:
+            name, file_name = column["name"], column["file"]
+            self._columns[name] = np.load(f"{self._generation}/{file_name}.npy", mmap_mode="r")
+            if column["kind"] == "dictionary":
+                with open(f"{self._generation}/{file_name}.json", "r") as file:
+                    values = json.load(file)
+                # code -1 indexes the last entry, a missing value
+                dictionary = np.full(len(values) + 1, np.nan, dtype=object)
+                for code, value in enumerate(values):
+                    if value is not None:
+                        dictionary[code] = value
+                self._dictionaries[name] = dictionary
+            if column.get("timestamp"):
+                self._timestamps[name] = np.load(f"{self._generation}/{file_name}.us.npy", mmap_mode="r")
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def columns(self) -> List[str]:
+        return [column["name"] for column in self.meta["columns"]]
+
+    def column(self, name: str, start: int = 0, stop: int = None) -> np.ndarray:
+        """
+        :param name:
+        :param start:
+        :param stop:
+        :return: The values of rows [start, stop) of a column. Numeric columns are a view of the mapped file.
+        """
+        values = self._columns[name][start:stop]
+        if name in self._dictionaries:
+            return self._dictionaries[name][values]
+        return values
+
+    def timestamps(self, name: str, start: int = 0, stop: int = None) -> Union[np.ndarray, None]:
+        """
+        :return: Microseconds since the epoch of rows [start, stop) of a time column, None if it is not one
+        """
+        if name not in self._timestamps:
+            return None
+        return self._timestamps[name][start:stop]
+
+    def equals(self, name: str, values: List[Any], start: int = 0, stop: int = None) -> np.ndarray:
+        """
+        :return: Which of rows [start, stop) of a column hold one of values. Dictionary columns compare codes, so the
+            rows are not decoded.
+        """
+        stored = self._columns[name][start:stop]
+        if name in self._dictionaries:
+            wanted = np.flatnonzero(pd.Series(self._dictionaries[name][:-1], dtype=object).isin(values).to_numpy())
+            return np.isin(stored, wanted.astype(np.int32))
+        return pd.Series(stored).isin(values).to_numpy()
+
+    def overlapping(self, start_name: str, end_name: str, low: int, high: int,
+                    start: int = 0, stop: int = None) -> Union[np.ndarray, None]:
+        """
+        :return: Which of rows [start, stop) hold a time slot overlapping [low, high], in microseconds.
+            None if the columns are not time columns.
+        """
+        if start_name not in self._timestamps or end_name not in self._timestamps:
+            return None
+        starts, ends = self._timestamps[start_name][start:stop], self._timestamps[end_name][start:stop]
+        return (starts != MISSING_TIME) & (ends != MISSING_TIME) & (starts <= high) & (ends >= low)
+
+    def take(self, columns: List[str], rows: np.ndarray) -> pd.DataFrame:
+        """
+        :param columns: Columns to read, those the table does not have are left out
+        :param rows: Positions of the rows to read
+        :return: The rows, indexed by their position
+        """
+        columns = [column for column in columns if column in self._columns]
+        frame = {}
+        for name in columns:
+            values = self._columns[name][rows]
+            frame[name] = self._dictionaries[name][values] if name in self._dictionaries else values
+        return pd.DataFrame(frame, index=pd.Index(rows), columns=columns)
+
+    def to_frame(self, columns: List[str] = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        columns = self.columns if columns is None else [column for column in columns if column in self._columns]
+        stop = self.rows if stop is None else min(stop, self.rows)
+        start = min(start, stop)
+        return pd.DataFrame({name: self.column(name, start, stop) for name in columns},
+                            index=pd.RangeIndex(start, stop), columns=columns)
+
+    @staticmethod
+    def _file_name(index: int) -> str:
+        # column names come from requests, so files are numbered
+        return f"column_{index}"
+
+    @staticmethod
+    def write(directory: str, frame: pd.DataFrame, source: Tuple) -> None:
+        """
+        Stores a frame as the current generation of a table
+        :param directory:
+        :param frame:
+        :param source: Identifies what the frame was read from, a table is only loaded for the same source
+        :return:
+        """
+        generation = f"generation_{'_'.join(str(part) for part in source)}"
+        generation_path = f"{directory}/{generation}"
+        os.makedirs(generation_path, exist_ok=True)
+        columns = []
+        for index, name in enumerate(frame.columns):
+            file_name = ColumnarTable._file_name(index)
+            series = frame[name]
+            column = {"name": name, "file": file_name}
+            if series.dtype.kind in "biuf":
+                column["kind"] = "numeric"
+                np.save(f"{generation_path}/{file_name}.npy", np.ascontiguousarray(series.to_numpy()))
+            else:
+                column["kind"] = "dictionary"
+                values = [_encodable(value) for value in series.tolist()]
+                dictionary, codes = {}, np.empty(len(values), dtype=np.int32)
+                for row, value in enumerate(values):
+                    if value is None:
+                        codes[row] = -1
+                        continue
+                    key = json.dumps(value, sort_keys=True, default=str)
+                    if key not in dictionary:
+                        dictionary[key] = (len(dictionary), value)
+                    codes[row] = dictionary[key][0]
+                np.save(f"{generation_path}/{file_name}.npy", codes)
+                with open(f"{generation_path}/{file_name}.json", "w") as file:
+                    json.dump([value for _, value in dictionary.values()], file, default=str)
+                present = [value for value in values if value is not None]
+                if len(present) > 0 and all(isinstance(value, str) and validate_iso8601(value) for value in present):
+                    column["timestamp"] = True
+                    np.save(f"{generation_path}/{file_name}.us.npy", np.array(
+                        [MISSING_TIME if value is None else iso8601_to_microseconds(value) for value in values], dtype=np.int64
+                    ))
+            columns.append(column)
+        meta = {"version": COLUMNAR_VERSION, "generation": generation, "source": list(source),
+                "rows": len(frame), "columns": columns}
+        temporary_path = f"{directory}/{META_FILE_NAME}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(temporary_path, f"{directory}/{META_FILE_NAME}")
+        # older generations are no longer named by meta.json. Tables using them keep their mapped files.
+        for entry in os.scandir(directory):
+            if entry.is_dir() and entry.name != generation:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    @staticmethod
+    def load(directory: str, source: Tuple) -> Union["ColumnarTable", None]:
+        """
+        :param directory:
+        :param source: What the table must have been written from
+        :return: The table, or None if there is none for this source
+        """
+        try:
+            with open(f"{directory}/{META_FILE_NAME}", "r") as file:
+                meta = json.load(file)
+            if meta.get("version") != COLUMNAR_VERSION or tuple(meta["source"]) != tuple(source):
+                return None
+            return ColumnarTable(directory, meta)
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Could not load the columnar table {directory}, it will be read from its source: {e}")
+            return None
@@ -0,0 +1,100 @@
+import math
+from typing import Dict, Any, Tuple, List
+
+from backend.database_endpoints.shared_state import SharedEntityState
+
+
+class TicketCounter:
+    """
+    The number of tickets taken from a Ticketed entity, without reading its expended table.
+
+    The storage persists the counter as (taken, position): the tickets taken by the first position expended rows.
+    Every write advances it in the same transaction as the rows, so reading it costs the same however many rows there are.
+    When the storage can not vouch for it, ex. rows appended before a crash and never counted, or expended before the
+    counter existed, the rows past its position are folded in when it is read.
+    In a server with SHARED_ENTITY_STATE, the counter is also kept in the SharedEntityState of the entity, and read from there.
+    """
+
+    def __init__(self, storage):
+        """
+        :param storage: EntityStorage of the entity
+        """
+        self.storage = storage
+
+    @staticmethod
+    def quantity(row: Dict[str, Any]) -> int:
+        """
+        :param row: An expended row
+        :return: Tickets taken by the row. Rows stored without a quantity took one ticket.
+        """
+        quantity = row.get("quantity")
+        if quantity is None or (isinstance(quantity, float) and math.isnan(quantity)):
+            return 1
+        return int(quantity)
+
+    def read(self, share: bool = False) -> Tuple[int, int]:
+        """
+        :param share: Publish the counter if it had to be read from the storage. Only in a transaction of the storage.
+        :return: (tickets taken, number of expended rows counted)
+        """
+        shared = SharedEntityState.of(self.storage.org_name, self.storage.entity_name)
+        counter = shared.tickets() if shared is not None else None
+        if counter is not None:
+            return counter
+        counter = self._read_storage()
+        if share:
+            self.share(counter)
+        return counter
+
+    def _read_storage(self) -> Tuple[int, int]:
+        """
+        :return: The counter stored with the expended rows, with the rows it missed folded in
+        """
+        taken, position, stale = self.storage.read_counter()
+        if stale and self.storage.count() < position:
+            # the counter was made durable but not all of its rows, count them all again
+            taken, position = 0, 0
+        if stale:
+            rows, position = self.storage.expended_since(position)
+            taken += sum(TicketCounter.quantity(row) for row in rows)
+        return taken, position
+
+    def take(self, observed: Tuple[int, int], quantities: List[int], available: int) -> Tuple[Tuple[int, int], List[int]]:
+        """
+        Compare and set: takes the tickets of new expended rows, if the counter is still what they were checked against.
+        Otherwise another worker took tickets since, and each row is checked again against the current counter, in order.
+        Must be called in a transaction of the storage, which then appends the rows taken and stores the returned counter.
+        :param observed: The counter the tickets were checked against, as returned by read
+        :param quantities: Tickets of each new row
+        :param available: Tickets of the entity
+        :return: The counter once the rows taken are appended, and the positions of the rows which no longer fit
+        """
+        current = self.read()
+        if current == observed:
+            return (current[0] + sum(quantities), current[1] + len(quantities)), []
+        taken, rejected = current[0], []
+        for position, quantity in enumerate(quantities):
+            if taken + quantity > available:
+                rejected.append(position)
+            else:
+                taken += quantity
+        return (taken, current[1] + len(quantities) - len(rejected)), rejected
+
+    def store(self, counter: Tuple[int, int]) -> None:
+        """
+        Must be called in a transaction of the storage, after appending the rows it counts
+        :param counter:
+        :return:
+        """
+        self.storage.write_counter(*counter)
+        self.share(counter)
+
+    def share(self, counter: Tuple[int, int]) -> None:
+        """
+        Publishes a counter read or stored in a transaction of the storage to the other workers
+        :param counter:
+        :return:
+        """
+        shared = SharedEntityState.of(self.storage.org_name, self.storage.entity_name)
+        if shared is not None:
+            shared.publish(counter[1], tickets=counter[0])
@@ -1,192 +1,599 @@
 import json
+import time
 from abc import abstractmethod
-from typing import Union, Dict, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import nullcontext, contextmanager
+from itertools import islice
+from typing import Union, Dict, Tuple, List, ContextManager, Any, Iterator
 
+import glob
 import pandas as pd
 import os
 
+from backend.policies.artifact import PolicyArtifact
 from backend.policies.factory import PolicyFactory
+from backend.database_endpoints.aggregation import ExpendedAggregation
+from backend.database_endpoints.counters import TicketCounter
+from backend.database_endpoints.expended_query import ExpendedQuery
+from backend.database_endpoints.interval_index import IntervalIndex, EntitySlots
+from backend.database_endpoints.query_cache import QueryCache
+from backend.database_endpoints.shared_state import SharedEntityState
+from backend.database_endpoints.storage import EntityStorage
+from backend.database_endpoints.request_schema import RequestSchema
 from backend.policies.policy import Policy
 from backend.requests.requests import Request
-from backend.utils.utils import validate_iso8601, hierarchical_keys, hierarchical_dict_lookup
-from utils.constants import TEMPORARY_DATA_ROOT
-from utils.errors import NoTicketsAvailableError, DatabaseWriteError, InvalidRequestError, InvalidTimeslotError, OverlappingTimeslotError
+from backend.utils.utils import validate_iso8601, FlatKeyIndex, iso8601_to_microseconds
+from utils.constants import TEMPORARY_DATA_ROOT, QUERY_READ_WORKERS, QUERY_DEADLINE_SECONDS
+from utils.errors import NoTicketsAvailableError, DatabaseWriteError, InvalidRequestError, InvalidTimeslotError, OverlappingTimeslotError, \
+    QueryDeadlineError, ValidationError
+
+# entities read ahead of the one streamed, per reader thread
+QUERY_READ_AHEAD = 4
 
 
 class PolicyManagement:
+    # organization name -> (signature of its policies directory, policy name -> compiled policy, or why it did not compile)
+    _catalogs: Dict[str, Tuple[Tuple, Dict[str, Union[Policy, Exception]]]] = {}
+
+    @staticmethod
+    def _policies_signature(policies_path: str) -> Tuple:
+        """
+        Identifies the state of a policies directory, so that edits invalidate the catalog.
+        :param policies_path:
+        :return: Sorted (file name, modification time, size) of every policy file
+        """
+        try:
+            with os.scandir(policies_path) as entries:
+                return tuple(sorted(
+                    (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                    for entry in entries if entry.name.endswith(".json")
+                ))
+        except FileNotFoundError:
+            return ()
+
+    @staticmethod
+    def get_policy_catalog(org_name: str) -> Dict[str, Union[Policy, Exception]]:
+        """
+        Every named policy of an organization, compiled once and shared between lookups.
+        The catalog is rebuilt when a file under policies/ is added, removed or modified.
+        Policies are taken from the organization's compiled artifact when it is up-to-date.
+        A policy that does not compile is kept as its error, so that only lookups of it fail.
+        :param org_name:
+        :return: Mapping of policy name to compiled policy, or to the error compiling it
+        """
+        policies_path = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/policies"
+        signature = PolicyManagement._policies_signature(policies_path)
+        cached = PolicyManagement._catalogs.get(org_name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        artifact = PolicyArtifact.load(org_name)
+        if artifact is not None:
+            PolicyManagement._catalogs[org_name] = (signature, artifact["policies"])
+            return artifact["policies"]
+        catalog = {}
+        for file_name, _, _ in signature:
+            policy_name = file_name[:-len(".json")]
+            try:
+                with open(f"{policies_path}/{file_name}", "r") as file:
+                    catalog[policy_name] = PolicyFactory.memoize(PolicyFactory.get_policy_from_dict(json.load(file)))
+            except Exception as e:
+                print(f"Could not compile policy {policy_name} of {org_name}: {e}")
+                catalog[policy_name] = e
+        PolicyManagement._catalogs[org_name] = (signature, catalog)
+        return catalog
+
+    @staticmethod
+    def set_policy_catalog(org_name: str, catalog: Dict[str, Policy]) -> None:
+        """
+        Takes policies compiled when the organization is built as its catalog, so that lookups of them by its entities
+        return the same instances. Call it once the policy files are written.
+        :param org_name:
+        :param catalog: Policy name -> compiled policy
+        :return:
+        """
+        signature = PolicyManagement._policies_signature(f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/policies")
+        PolicyManagement._catalogs[org_name] = (signature, catalog)
+
+    @staticmethod
+    def preload_catalogs() -> None:
+        """
+        Compiles the catalogs and loads the compiled artifacts of every organization, ex. in the server before workers are forked
+        :return:
+        """
+        for organization_path in glob.glob(f"{TEMPORARY_DATA_ROOT}/organization_*"):
+            try:
+                org_name = os.path.basename(organization_path)[len("organization_"):]
+                PolicyManagement.get_policy_catalog(org_name)
+                PolicyArtifact.load(org_name)
+            except Exception as e:
+                print(f"Could not preload policies of {organization_path}: {e}")
+
     @staticmethod
     def lookup_policy_from_org_name(org_name: str, policy_name: str) -> Union[None, Policy]:
-        possible_entity_path = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/policies/{policy_name}.json"
-        if os.path.exists(possible_entity_path):
-            with open(possible_entity_path, "r") as file:
-                return PolicyFactory.get_policy_from_dict(json.load(file))
-        return None
+        policy = PolicyManagement.get_policy_catalog(org_name).get(policy_name)
+        if isinstance(policy, Exception):
+            # raised as it was when the policy was compiled on lookup
+            raise policy
+        return policy
 
 
 class DataQueryManagement:
+    # (process id, readers of the entities of queries), threads are not inherited by forked workers
+    _readers: Union[Tuple[int, ThreadPoolExecutor], None] = None
+
     def __init__(self, request: Request):
         raw_data = request.raw_request
         request.validate()
+        ExpendedQuery.validate_request(raw_data)
+        ExpendedAggregation.validate_request(raw_data)
         self._request = request
         self._entity = raw_data['entity']
         self._recursive = raw_data['recursive']
+        self._expended_query = ExpendedQuery.from_request(raw_data)
+        self._aggregation = ExpendedAggregation.from_request(raw_data)
+        # a cursor continues the entity it was returned with
+        self._cursor_entity = ExpendedQuery.decode_cursor(raw_data["cursor"])[0] if "cursor" in raw_data else None
+        # seconds the entities are read for, a request may shorten the deadline of the server
+        deadline = raw_data.get("deadline", QUERY_DEADLINE_SECONDS or None)
+        if deadline is not None and (not isinstance(deadline, (int, float)) or isinstance(deadline, bool) or deadline <= 0):
+            raise ValidationError("deadline must be a positive number of seconds.")
+        self._deadline = deadline if not QUERY_DEADLINE_SECONDS else min(deadline, QUERY_DEADLINE_SECONDS)
+        self._cache = QueryCache(request.root_name, raw_data)
+        # entity tag of the results, known once stream found the entities
+        self.etag = None
+        # whether an entity missed the deadline
+        self._partial = False
 
     @staticmethod
-    def read_data_from_entity_and_organization_name(org_name: str, entity_name: str) -> Tuple[Dict, Dict]:
+    def read_data_from_entity_and_organization_name(org_name: str, entity_name: str,
+                                                    query: ExpendedQuery = None) -> Tuple[Dict, Dict, Union[str, None]]:
         """
         Given an entity and organization, reads all data related to it.
         :param org_name:
         :param entity_name:
-        :return: Tuple of (info, expended) as dictionaries
+        :param query: Which expended rows to read, all of them if None
+        :return: Tuple of (info, expended) as dictionaries, and the cursor of the next page, None if there is none
         """
-        info_frame = pd.read_csv(f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{entity_name}_resources_info.csv")
-        expended_frame = pd.read_csv(f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{entity_name}_resources_expended.csv")
-        return info_frame.to_dict(), expended_frame.to_dict()
+        storage = EntityStorage.for_entity(org_name, entity_name)
+        information = storage.information()
+        if query is None or query.everything:
+            return information.to_dict(), storage.expended().to_dict(), None
+        query = query.for_schema(RequestSchema.for_entity(org_name, entity_name, information))
+        expended, after = storage.query(query)
+        cursor = None if after is None else ExpendedQuery.encode_cursor(entity_name, after)
+        return information.to_dict(), expended.to_dict(), cursor
+
+    @staticmethod
+    def data_version_of_entity_and_organization_name(org_name: str, entity_name: str) -> int:
+        """
+        :param org_name:
+        :param entity_name:
+        :return: Version of the expended rows of the entity, see EntityStorage.data_version
+        """
+        return EntityStorage.for_entity(org_name, entity_name).data_version()
+
+    @staticmethod
+    def aggregate_entity_and_organization_name(org_name: str, entity_name: str, query: ExpendedQuery,
+                                               aggregation: ExpendedAggregation) -> Dict[str, Any]:
+        """
+        Given an entity and organization, aggregates the expended rows a query selects, reading only the columns used.
+        :param org_name:
+        :param entity_name:
+        :param query: Which expended rows are aggregated
+        :param aggregation:
+        :return: Name of the aggregate -> its value
+        """
+        storage = EntityStorage.for_entity(org_name, entity_name)
+        information = storage.information()
+        schema = RequestSchema.for_entity(org_name, entity_name, information)
+        query = query.for_schema(schema)
+        query.columns = aggregation.columns(schema)
+        expended, _ = storage.query(query)
+        return aggregation.compute(expended, schema, information, query)
 
     def query(self) -> Dict:
         """
         Generates a large dictionary of all data.
         :return:
         """
+        return dict(self.stream())
+
+    def stream(self) -> Iterator[Tuple[str, Union[Dict, str]]]:
+        """
+        Finds the entities of the query, which raises if the query can not be answered, and their data versions,
+        which set etag. Then reads them lazily, from the cache when they did not change since it was written.
+        If an entity missed the deadline, the results end raising QueryDeadlineError, as they do not hold the data etag is of.
+        :return: (entity name, its result) of each entity in tree order, as each is read
+        """
         from backend.routing.root_authority import RootAuthority
 
         entity = RootAuthority(self._request).get_root()
         all_entities = entity.get_children_of(self._entity, self._recursive)
+        if self._cursor_entity is not None:
+            all_entities = [current_entity for current_entity in all_entities if current_entity.name == self._cursor_entity]
+            if len(all_entities) == 0:
+                raise InvalidRequestError(f"The cursor continues {self._cursor_entity}, which is not under {self._entity}.")
         # we now have the entities that we wish to question for data
-        results = {}
-        for current_entity in all_entities:
+        deadline = None if self._deadline is None else time.monotonic() + self._deadline
+        versions = [current_entity.data_version() for current_entity in all_entities]
+        self.etag = QueryCache.etag(self._cache.signature, [[current_entity.name, version]
+                                                           for current_entity, version in zip(all_entities, versions)])
+        return self._complete(self._read_entities(list(zip(all_entities, versions)), deadline))
+
+    def _complete(self, results: Iterator[Tuple[str, Union[Dict, str]]]) -> Iterator[Tuple[str, Union[Dict, str]]]:
+        """
+        :param results: See _read_entities
+        :return: The results, raising once they are all given if any is partial
+        """
+        yield from results
+        if self._partial:
+            raise QueryDeadlineError(f"Some entities were not read within the {self._deadline} second deadline "
+                                     f"of the query, the results are partial.")
+
+    def _read_entities(self, entities: List[Tuple[Any, Union[int, None]]],
+                       deadline: Union[float, None]) -> Iterator[Tuple[str, Union[Dict, str]]]:
+        """
+        :param entities: (entity, data version) of the entities of the query, in tree order
+        :param deadline: time.monotonic() the entities must be read by, None for no deadline
+        :return: See stream
+        """
+        if QUERY_READ_WORKERS <= 0:
+            for current_entity, version in entities:
+                if deadline is not None and time.monotonic() >= deadline:
+                    yield current_entity.name, self._missed_deadline()
+                    continue
+                yield current_entity.name, self._read_entity(current_entity, version)
+            return
+
+        readers = DataQueryManagement._reader_pool()
+        unread = iter(entities)
+        # reads run a few entities per reader ahead of the one returned, so a slow entity does not hold the others up,
+        # and the results held while waiting for it are bounded
+        pending = deque((current_entity, readers.submit(self._read_entity, current_entity, version))
+                        for current_entity, version in islice(unread, QUERY_READ_AHEAD * QUERY_READ_WORKERS))
+        while len(pending) > 0:
+            current_entity, future = pending.popleft()
             try:
-                data = current_entity.query_data()
-                results[current_entity.name] = {
+                result = self._missed_deadline() if future is None else future.result(
+                    timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except FutureTimeoutError:
+                # a read already running finishes in the background
+                future.cancel()
+                result = self._missed_deadline()
+            next_entity = next(unread, None)
+            if next_entity is not None:
+                expired = deadline is not None and time.monotonic() >= deadline
+                pending.append((next_entity[0], None if expired else readers.submit(self._read_entity, *next_entity)))
+            yield current_entity.name, result
+
+    def _read_entity(self, entity, version: Union[int, None]) -> Union[Dict, str]:
+        """
+        :param entity: An entity of the query
+        :param version: Its data version, None if it has no data
+        :return: Its result, or why it has none
+        """
+        if version is not None:
+            cached = self._cache.load(entity.name, version)
+            if cached is not None:
+                return cached
+        try:
+            if self._aggregation is not None:
+                result = {"aggregates": entity.aggregate_data(self._expended_query, self._aggregation)}
+            else:
+                data = entity.query_data(self._expended_query)
+                result = {
                     "info": data[0],
                     "expended": data[1]
                 }
-            except InvalidRequestError as e:
-                results[current_entity.name] = str(e)
+                if data[2] is not None:
+                    result["cursor"] = data[2]
+        except InvalidRequestError as e:
+            return str(e)
+        if version is not None:
+            self._cache.store(entity.name, version, result)
+        return result
 
-        return results
+    def _missed_deadline(self) -> str:
+        self._partial = True
+        return str(QueryDeadlineError(f"Not read within the {self._deadline} second deadline of the query, "
+                                      f"this result is partial."))
+
+    @staticmethod
+    def _reader_pool() -> ThreadPoolExecutor:
+        """
+        Threads reading entities, shared by the queries of this process. Storage reads and pandas parsing release
+        the GIL, and SQLite opens a connection per thread.
+        :return:
+        """
+        readers = DataQueryManagement._readers
+        if readers is None or readers[0] != os.getpid():
+            readers = (os.getpid(), ThreadPoolExecutor(max_workers=QUERY_READ_WORKERS, thread_name_prefix="query-reader"))
+            DataQueryManagement._readers = readers
+        return readers[1]
 
 
 class DataManagement:
     def __init__(self, organization_name: str, entity_name: str):
         self.headers_map = None
+        self.key_index = None
+        self.schema = None
+        self.row = None
         self.organization_name = organization_name
         self.entity_name = entity_name
         # what resources have been handed out, and to who
-        self.data_allocated_path = f"{TEMPORARY_DATA_ROOT}/organization_{organization_name}/{entity_name}_resources_expended.csv"
+        self.storage = EntityStorage.for_entity(organization_name, entity_name)
         # overview of the resource (max, etc...)
-        self.data_information_path = f"{TEMPORARY_DATA_ROOT}/organization_{organization_name}/{entity_name}_resources_info.csv"
-        self.data_allocated = pd.read_csv(self.data_allocated_path)
-        self.data_information = pd.read_csv(self.data_information_path)
+        self.data_information = self.storage.information()
+        # registered rows which are not written yet
+        self._pending: List[Dict] = []
+
+    @property
+    def data_allocated(self) -> pd.DataFrame:
+        """
+        Every expended row, including registrations not written yet
+        :return:
+        """
+        frame = self.storage.expended()
+        if len(self._pending) == 0:
+            return frame
+        return pd.concat([frame, pd.DataFrame(self._pending)], ignore_index=True)
 
     @abstractmethod
-    def register(self, data: Dict):
-        # what data we expect
-        expected_headers_final = [x[8:] for x in self.data_information.columns.tolist() if x[0:8] == "header::"]
-        # we need to convert that to actual request headers location with the resources_info file!
-        headers_map = {header: self.data_information.iloc[0][f"header::{header}"] for header in expected_headers_final}
-        # what data we have
-        expected_headers_fully_qualified = set(headers_map.values())
-        available_headers = set(hierarchical_keys(data))
-        # manage discrepancy
-        if not expected_headers_fully_qualified.issubset(available_headers):
-            raise DatabaseWriteError(f"Tracking {expected_headers_fully_qualified} but provided {available_headers}")
-        self.headers_map = headers_map
-
-    def write_updates(self):
-        self.data_information.to_csv(self.data_information_path, index=False)
-        self.data_allocated.to_csv(self.data_allocated_path, index=False)
+    def register(self, data: Dict, key_index: FlatKeyIndex = None):
+        """
+        :param data: The raw request
+        :param key_index: Flat key index of data, ex. Request.key_index. Built here if not given.
+        :return:
+        """
+        self.key_index = FlatKeyIndex(data) if key_index is None else key_index
+        # what data we expect, and where it is in the request
+        self.schema = RequestSchema.for_entity(self.organization_name, self.entity_name, self.data_information)
+        self.headers_map = self.schema.headers_map
+        # the row to store, raises if anything is missing or of the wrong type
+        self.row = self.schema.extract(self.key_index)
+
+    def replay(self) -> None:
+        """
+        Restores the storage and the in-memory state of the entity, ex. in the server before workers are forked
+        :return:
+        """
+        self.storage.replay()
+
+    @staticmethod
+    def replay_organizations() -> None:
+        """
+        Replays the storage of every Ticketed and Slotted entity of every organization
+        :return:
+        """
+        managers = {"Ticketed": TicketDataManagement, "Slotted": TimeslotDataManagement}
+
+        def replay_entity(org_name: str, entity_definition: Dict) -> None:
+            if entity_definition["Type"] in managers:
+                try:
+                    managers[entity_definition["Type"]](org_name, entity_definition["Entity_Name"]).replay()
+                except Exception as e:
+                    print(f"Could not replay the storage of {org_name}.{entity_definition['Entity_Name']}: {e}")
+            for child in entity_definition.get("Children", []):
+                replay_entity(org_name, child)
+
+        for organization_path in glob.glob(f"{TEMPORARY_DATA_ROOT}/organization_*"):
+            try:
+                org_name = os.path.basename(organization_path)[len("organization_"):]
+                with open(f"{organization_path}/entity_definition.json", "r") as file:
+                    definition = json.load(file)
+                for entity_definition in definition.get("Children", []):
+                    replay_entity(org_name, entity_definition)
+            except Exception as e:
+                print(f"Could not replay the storage of {organization_path}: {e}")
+
+    def _transaction(self, commit: bool) -> ContextManager:
+        """
+        :param commit: Whether the registration is written right away. Otherwise, it is written in its own transaction by write_updates.
+        :return:
+        """
+        return self.storage.transaction() if commit else nullcontext()
+
+    @contextmanager
+    def _sharing(self):
+        """
+        Context of a write that then updates the SharedEntityState of the entity. If it fails once the storage may have
+        been written, the state is invalidated, so that workers read the storage until it is published again.
+        :return:
+        """
+        try:
+            yield
+        except BaseException:
+            shared = SharedEntityState.of(self.organization_name, self.entity_name)
+            if shared is not None:
+                shared.invalidate()
+            raise
+
+    def write_updates(self) -> Dict[int, Exception]:
+        """
+        Appends the registered rows to the log of the entity
+        :return: Position of each registration that was not written, in the order they were registered -> why
+        """
+        self.storage.append(self._pending)
+        self._pending = []
+        return {}
 
 
 class TicketDataManagement(DataManagement):
     def __init__(self, organization_name: str, entity_name: str):
         super().__init__(organization_name, entity_name)
+        self.counter = TicketCounter(self.storage)
+        # the counter the pending tickets were checked against, and how many they are
+        self._observed = None
+        self._pending_quantity = 0
+
+    def replay(self) -> None:
+        super().replay()
+        with self.storage.transaction():
+            counter = self.counter.read()
+            if self.storage.read_counter()[2]:
+                # store the counter with the rows it missed, so that workers read it as is
+                self.counter.store(counter)
+            else:
+                self.counter.share(counter)
 
-    def register(self, data: Dict):
+    def register(self, data: Dict, key_index: FlatKeyIndex = None, commit: bool = True):
         """
         Registers 'quantity' tickets
         :param data:
+        :param key_index:
+        :param commit: Write the tables. When False, the registration is kept in memory until write_updates.
         :return:
         """
-        super().register(data)
-        # ensure sufficient resources
-        tickets_available = self.data_information.available[0]
-        tickets_available -= len(self.data_allocated)
-        requested_quantity = hierarchical_dict_lookup(data, self.headers_map["quantity"])
-        if tickets_available < requested_quantity:
-            raise NoTicketsAvailableError(f"Requested {requested_quantity} tickets but only {tickets_available} are available.")
-        if requested_quantity <= 0:
-            raise InvalidRequestError(f"You must request >= 0 tickets for a ticketed resource.")
+        super().register(data, key_index)
+        # the check and the write are one transaction, so that concurrent workers can not both take the last tickets
+        with self._transaction(commit):
+            # ensure sufficient resources
+            if commit or self._observed is None:
+                self._observed = self.counter.read(share=commit)
+            tickets_available = int(self.data_information.available[0])
+            tickets_available -= self._observed[0] + self._pending_quantity
+            requested_quantity = self.row["quantity"]
+            if tickets_available < requested_quantity:
+                raise NoTicketsAvailableError(f"Requested {requested_quantity} tickets but only {tickets_available} are available.")
+            if requested_quantity <= 0:
+                raise InvalidRequestError(f"You must request >= 0 tickets for a ticketed resource.")
 
-        # update data table with new tickets, then write updates
-        data_arguments = {header: hierarchical_dict_lookup(data, self.headers_map[header]) for header in self.headers_map}
-        self.data_allocated = pd.concat([
-            self.data_allocated, pd.DataFrame([pd.Series(data_arguments)], index=[0])
-        ]).reset_index(drop=True)
+            # add the new tickets, then write updates
+            self._pending.append(self.row)
+            self._pending_quantity += requested_quantity
 
-        self.write_updates()
+            if commit:
+                for error in self.write_updates().values():
+                    raise error
+
+    def write_updates(self) -> Dict[int, Exception]:
+        """
+        Appends the registered rows, and takes their tickets from the counter in the same transaction.
+        Rows whose tickets another worker took since they were checked are not written.
+        :return: See DataManagement.write_updates
+        """
+        rejected = {}
+        if len(self._pending) > 0:
+            with self.storage.transaction():
+                quantities = [row["quantity"] for row in self._pending]
+                counter, positions = self.counter.take(self._observed, quantities, int(self.data_information.available[0]))
+                rejected = {position: NoTicketsAvailableError(f"Requested {quantities[position]} tickets, but other "
+                                                              f"registrations took them since.") for position in positions}
+                self._pending = [row for position, row in enumerate(self._pending) if position not in rejected]
+                with self._sharing():
+                    super().write_updates()
+                    self.counter.store(counter)
+        self._observed = None
+        self._pending_quantity = 0
+        return rejected
 
 
 class TimeslotDataManagement(DataManagement):
     def __init__(self, organization_name, entity_name):
         super().__init__(organization_name, entity_name)
-        self.data_information = pd.read_csv(self.data_information_path)
-        self.data_allocated = pd.read_csv(self.data_allocated_path)
+        # slots registered but not written yet
+        self._pending_slots = IntervalIndex()
 
-    def register(self, data: Dict):
+    def replay(self) -> None:
+        super().replay()
+        with self.storage.transaction():
+            self._publish_slots()
+
+    def _publish_slots(self) -> None:
+        """
+        Builds the interval index of the expended slots, which forked workers then only extend, and publishes it
+        as the shared state of the entity. Must hold the storage transaction.
+        :return:
+        """
+        schema = RequestSchema.for_entity(self.organization_name, self.entity_name, self.data_information)
+        slots = EntitySlots.of(self.storage, schema.start.column, schema.end.column)
+        shared = SharedEntityState.of(self.organization_name, self.entity_name)
+        if shared is not None:
+            shared.publish(slots.position, starts=slots.index.starts, ends=slots.index.ends)
+
+    def register(self, data: Dict, key_index: FlatKeyIndex = None, commit: bool = True):
         """
         Registers a timeslot request in database.
         Allows a write request if the data_information has strict = False or there is no overlap
         :param data:
+        :param key_index:
+        :param commit: Write the tables. When False, the registration is kept in memory until write_updates.
         :return:
         """
-        super().register(data)
-        try:
-            start_time = hierarchical_dict_lookup(data, self.data_information.start_key[0])
-            end_time = hierarchical_dict_lookup(data, self.data_information.end_key[0])
-        except KeyError:
-            raise DatabaseWriteError(f"Keyword argument for start time or end time is missing.")
+        super().register(data, key_index)
+        start_time, end_time = self.row[self.schema.start.column], self.row[self.schema.end.column]
 
         if not (validate_iso8601(start_time) and validate_iso8601(end_time)):
             raise DatabaseWriteError("Invalid timeslot format. Expected ISO 8601 format.")
+        start, end = iso8601_to_microseconds(start_time), iso8601_to_microseconds(end_time)
         # validate timeslot
-        if start_time >= end_time:
+        if start >= end:
             raise InvalidTimeslotError(f"start time {start_time} is greater than or equal to end time {end_time}")
 
-        # TODO this functionality should be defined in the policy
-        if self.data_information.strict[0]:
-            overlap_conditions = [
-                # start is in the middle
-                (self.data_allocated.start_time <= start_time) & (self.data_allocated.end_time >= start_time),
-                # end is in the middle
-                (self.data_allocated.start_time <= end_time) & (self.data_allocated.end_time >= end_time),
-                # surrounds full
-                (self.data_allocated.start_time >= start_time) & (self.data_allocated.end_time <= end_time),
-            ]
-            overlap_condition = None
-            # build the ors of the conditions
-            for condition in overlap_conditions:
-                if overlap_condition is None:
-                    overlap_condition = condition
-                    continue
-                overlap_condition = overlap_condition | condition
-            # check overlaps
-            overlapping_resources = self.data_allocated.loc[overlap_condition]
-            overlapping_count = len(overlapping_resources)
+        # the check and the write are one transaction, so that concurrent workers can not both take the same slot
+        with self._transaction(commit):
+            shared = SharedEntityState.of(self.organization_name, self.entity_name)
+            if commit and shared is not None and not shared.valid:
+                # invalidated by a failed write, the transaction makes the storage safe to publish
+                self._publish_slots()
+            # TODO this functionality should be defined in the policy
+            if self.data_information.strict[0]:
+                overlapping_count = self.storage.count_overlapping(self.schema.start.column, self.schema.end.column,
+                                                                   start_time, end_time)
+                overlapping_count += self._pending_slots.count_overlapping(start, end)
+                if overlapping_count > 0:
+                    raise OverlappingTimeslotError(f"Requested slot overlaps with {overlapping_count} existing timeslots.")
+            # ok
+            # update data table with new slots, then write updates
+            # the schema stores start key and end key under the last part of their key
+            self._pending.append(self.row)
+            self._pending_slots.add(start, end)
+            if commit:
+                # checked in this transaction
+                for error in self.write_updates(recheck=False).values():
+                    raise error
+
+    def write_updates(self, recheck: bool = True) -> Dict[int, Exception]:
+        """
+        Appends the registered rows, and adds their slots to the shared state of the entity in the same transaction.
+        On a strict entity, rows whose slot another worker took since they were checked are not written.
+        :param recheck: Check the slots again in the transaction. Only False when they were checked in the current one.
+        :return: See DataManagement.write_updates
+        """
+        rejected = {}
+        if len(self._pending) > 0:
+            with self.storage.transaction(), self._sharing():
+                if recheck and self.data_information.strict[0]:
+                    rejected = self._check_pending_slots()
+                rows = len(self._pending)
+                super().write_updates()
+                shared = SharedEntityState.of(self.organization_name, self.entity_name)
+                if shared is not None and not shared.add_slots(rows, self._pending_slots.starts, self._pending_slots.ends):
+                    self._publish_slots()
+        self._pending_slots.clear()
+        return rejected
+
+    def _check_pending_slots(self) -> Dict[int, Exception]:
+        """
+        Checks the registered slots again against the expended slots, and against each other in the order they were
+        registered, keeping only those that do not overlap. Must hold the storage transaction.
+        :return: See DataManagement.write_updates
+        """
+        start_column, end_column = self.schema.start.column, self.schema.end.column
+        kept, slots, rejected = [], IntervalIndex(), {}
+        for position, row in enumerate(self._pending):
+            start, end = iso8601_to_microseconds(row[start_column]), iso8601_to_microseconds(row[end_column])
+            overlapping_count = self.storage.count_overlapping(start_column, end_column, row[start_column], row[end_column])
+            overlapping_count += slots.count_overlapping(start, end)
             if overlapping_count > 0:
-                raise OverlappingTimeslotError(f"Requested slot overlaps with {overlapping_count} existing timeslots.")
-        # ok
-        # update data table with new slots, then write updates
-        data_arguments = {header: hierarchical_dict_lookup(data, self.headers_map[header]) for header in self.headers_map}
-        # we interpret start key and end key differently, but still take the info!
-        data_arguments.update({
-            self.data_information.start_key[0].split(".")[-1]: start_time,
-            self.data_information.end_key[0].split(".")[-1]: end_time
-        })
-        self.data_allocated = pd.concat([
-            self.data_allocated, pd.DataFrame([pd.Series(data_arguments)])
-        ]).reset_index(drop=True)
-        self.write_updates()
+                rejected[position] = OverlappingTimeslotError(f"Requested slot overlaps with {overlapping_count} existing "
+                                                              f"timeslots.")
+                continue
+            kept.append(row)
+            slots.add(start, end)
+        self._pending, self._pending_slots = kept, slots
+        return rejected
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+from typing import Union
+
+from utils.constants import TEMPORARY_DATA_ROOT
+
+VERSION_SUFFIX = "_resources_expended.version"
+# process ids are below this, see /proc/sys/kernel/pid_max
+_PID_LIMIT = 10 ** 7
+
+
+class DataVersion:
+    """
+    Version of the expended rows of an entity, in {entity}_resources_expended.version, so that it is read without
+    touching the storage. Every committed write stores a new version once its rows are visible to readers, so data
+    read after a version is never older than it. Versions are unique, not ordered.
+    """
+    # nanoseconds of the last version stored by this process, so that its versions increase
+    _last = 0
+    _lock = threading.Lock()
+
+    def __init__(self, org_name: str, entity_name: str):
+        self.path = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{entity_name}{VERSION_SUFFIX}"
+
+    def read(self) -> Union[int, None]:
+        """
+        :return: The current version, None if the entity has none stored
+        """
+        try:
+            with open(self.path, "r") as file:
+                return int(file.read())
+        except (OSError, ValueError):
+            return None
+
+    def bump(self) -> None:
+        """
+        Stores a new version. Call it once written rows are committed.
+        If it can not be stored, the version is removed, so that readers fall back to reading the storage.
+        :return:
+        """
+        temporary_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "w") as file:
+                file.write(str(DataVersion._new()))
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"Could not store the data version {self.path}: {e}")
+            for path in (temporary_path, self.path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _new() -> int:
+        """
+        :return: A version no other write stores, of any process
+        """
+        with DataVersion._lock:
+            DataVersion._last = max(time.time_ns(), DataVersion._last + 1)
+            return DataVersion._last * _PID_LIMIT + os.getpid()
@@ -3,9 +3,15 @@ import os
 import shutil
 from typing import Dict
 import pandas as pd
+from backend.database_endpoints.data_management import PolicyManagement
+from backend.database_endpoints.group_commit import SETTINGS_FILE_NAME
+from backend.database_endpoints.request_schema import RequestSchema
+from backend.database_endpoints.storage import EntityStorage
+from backend.policies.artifact import PolicyArtifact
 from backend.policies.factory import PolicyFactory
+from backend.policies.policy import Policy
 from backend.requests.requests import Request
-from utils.constants import TEMPORARY_DATA_ROOT
+from utils.constants import TEMPORARY_DATA_ROOT, DURABILITY_MODES
 from utils.errors import AssociationAlreadyExistsError, MalformedEntityError
 
 
@@ -32,11 +38,14 @@ class EntityEntryDataManagement:
         shutil.rmtree(f"{TEMPORARY_DATA_ROOT}/organization_{name}")
 
     @staticmethod
-    def _validate_valid_entity_create_request(entity_definition: Dict, org_name: str):
+    def _validate_valid_entity_create_request(entity_definition: Dict, org_name: str, parent_path: str = None,
+                                              compiled: Dict[str, Policy] = None):
         """
         Recursively verifies that when creating an entity, it be workin
         :param entity_definition:
         :param org_name:
+        :param parent_path: Dotted path of the parent entity, the organization name for top level entities
+        :param compiled: Filled with dotted entity path -> compiled policy
         :return:
         """
         if "Entity_Name" not in entity_definition:
@@ -49,11 +58,14 @@ class EntityEntryDataManagement:
             raise MalformedEntityError("Must define Available in ticketed entities.")
         if entity_definition["Type"] == "Slotted" and ("StartKey" not in entity_definition or "EndKey" not in entity_definition):
             raise MalformedEntityError("Must define StartKey and EndKey in slotted entities.")
-        if "Policy" in entity_definition:
-            PolicyFactory.get_policy_from_argument(entity_definition["Policy"], org_name=org_name)
+        path = entity_definition["Entity_Name"] if parent_path is None else f"{parent_path}.{entity_definition['Entity_Name']}"
+        policy = PolicyFactory.get_policy_from_argument(entity_definition.get("Policy", "FullApproval"), org_name=org_name)
+        PolicyFactory.check_complexity(policy)
+        if compiled is not None:
+            compiled[path] = policy
         if "Children" in entity_definition:
             for child in entity_definition["Children"]:
-                EntityEntryDataManagement._validate_valid_entity_create_request(child, org_name)
+                EntityEntryDataManagement._validate_valid_entity_create_request(child, org_name, path, compiled)
 
     @staticmethod
     def _generate_data_sheet(entity_definition: Dict, org_name: str) -> None:
@@ -86,11 +98,9 @@ class EntityEntryDataManagement:
         info_sheet.update(
             {f"header::{key}": [collect[key]] for key in collect}
         )
-        info_sheet = pd.DataFrame(info_sheet)
-        info_sheet.to_csv(f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{name}_resources_info.csv", index=False)
-        # Create the empty expended sheet
-        expended = pd.DataFrame({key: [] for key in collect})
-        expended.to_csv(f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{name}_resources_expended.csv", index=False)
+        # Create the empty expended table, with a column for everything a request stores
+        schema = RequestSchema.from_definition(entity_definition)
+        EntityStorage.for_new_entity(org_name, name).create(pd.DataFrame(info_sheet), schema.columns, schema.indexes)
 
     def build_new(self) -> bool:
         """
@@ -106,12 +116,19 @@ class EntityEntryDataManagement:
         # Now we make sure we can actually build every defined policy
         try:
             # We open into a try so we can deallocate an association if something goes wrong
-            policies = {}
+            if "Durability" in requested:
+                # how registrations of this organization are flushed, before anything is written
+                if requested["Durability"] not in DURABILITY_MODES:
+                    raise MalformedEntityError(f"Durability must be one of {list(DURABILITY_MODES)}.")
+                with open(f"{TEMPORARY_DATA_ROOT}/organization_{requested['OrganizationName']}/{SETTINGS_FILE_NAME}", "w+") as file:
+                    json.dump({"durability": requested["Durability"]}, file, indent=4)
+            policies, compiled_policies = {}, {}
             if "Policies" in requested:
                 for name, policy_definition in requested["Policies"].items():
                     # Prepare these policies if they are well-defined
                     # This may throw an error which will go back to the client
-                    PolicyFactory.get_policy_from_dict(policy_definition)
+                    compiled_policies[name] = PolicyFactory.memoize(PolicyFactory.get_policy_from_dict(policy_definition))
+                    PolicyFactory.check_complexity(compiled_policies[name])
                     policies[name] = policy_definition
             # Policy build success! Let us start writing shit
             if len(policies) > 0:
@@ -120,13 +137,19 @@ class EntityEntryDataManagement:
                     with open(f"{TEMPORARY_DATA_ROOT}/organization_{requested['OrganizationName']}/policies/{policy_name}.json",
                               "w+") as file:
                         json.dump(policy, file, indent=4)
+            # Entities naming a policy look it up, so they share the instances the artifact stores
+            PolicyManagement.set_policy_catalog(requested["OrganizationName"], compiled_policies)
             # The root may have a policy. In this case, make sure it is valid
-            if "Policy" in requested:
-                # We do this after policy file writes, because maybe it calls on one by name
-                PolicyFactory.get_policy_from_argument(requested["Policy"], org_name=requested["OrganizationName"])
+            # We do this after policy file writes, because maybe it calls on one by name
+            entity_policies = {
+                requested["OrganizationName"]: PolicyFactory.get_policy_from_argument(requested.get("Policy", "FullApproval"),
+                                                                                      org_name=requested["OrganizationName"])
+            }
+            PolicyFactory.check_complexity(entity_policies[requested["OrganizationName"]])
             # Check on entities
             for entity_definition in requested["Entities"]:
-                EntityEntryDataManagement._validate_valid_entity_create_request(entity_definition, requested["OrganizationName"])
+                EntityEntryDataManagement._validate_valid_entity_create_request(entity_definition, requested["OrganizationName"],
+                                                                                requested["OrganizationName"], entity_policies)
             # If we get here, all entities and policies are valid! Wonderful.
             # Now build the fucking tree - and the datasets while we are at it.
             """
@@ -190,6 +213,8 @@ class EntityEntryDataManagement:
             # fuckkkkkkkkkkkkk
             with open(f"{TEMPORARY_DATA_ROOT}/organization_{requested['OrganizationName']}/entity_definition.json", "w+") as file:
                 json.dump(entity_definition, file, indent=4)
+            # Keep what we compiled, so that serving processes do not compile it again
+            PolicyArtifact.write(requested["OrganizationName"], compiled_policies, entity_policies)
             return True
 
         except Exception as e:
@@ -0,0 +1,176 @@
+import base64
+import binascii
+import json
+from typing import Dict, List, Any, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from backend.utils.utils import validate_iso8601, iso8601_to_microseconds
+from utils.errors import InvalidRequestError, ValidationError
+
+# expended rows read at once while scanning for the rows of a page
+QUERY_SCAN_ROWS = 65536
+# from and until of a time range not given, in microseconds
+UNBOUNDED = (int(np.iinfo(np.int64).min) + 1, int(np.iinfo(np.int64).max))
+
+
+def _microseconds(value: Any) -> Union[int, None]:
+    if isinstance(value, str) and validate_iso8601(value):
+        return iso8601_to_microseconds(value)
+    return None
+
+
+class ExpendedQuery:
+    """
+    Which expended rows of an entity a GET returns: rows whose collected columns equal one of the accepted values,
+    whose time slot overlaps [from, until], projected on some columns, and a page of them after a cursor.
+
+    A request without filters, columns or limit is every row, as before queries existed.
+    """
+
+    def __init__(self, equals: Dict[str, List[Any]] = None, overlapping: Tuple[int, int] = None,
+                 columns: List[str] = None, limit: int = None, after: int = 0):
+        """
+        :param equals: Column -> accepted values
+        :param overlapping: (from, until) as microseconds since the epoch
+        :param columns: Columns returned, every column if None
+        :param limit: Most rows returned
+        :param after: Position of the first row considered, from a cursor
+        """
+        self.equals = equals or {}
+        self.overlapping = overlapping
+        self.columns = columns
+        self.limit = limit
+        self.after = after
+        # the time slot columns of the entity queried, see for_schema
+        self.slot_columns: Union[Tuple[str, str], None] = None
+
+    @staticmethod
+    def validate_request(data: Dict) -> None:
+        """
+        Checks the query keys of a GET request
+        :param data: The raw request
+        :return:
+        """
+        filters = data.get("filters", {})
+        if not isinstance(filters, dict) or not all(isinstance(column, str) for column in filters):
+            raise ValidationError("filters must map collected columns to a value or a list of values.")
+        for key in ("from", "until"):
+            if key in data and not (isinstance(data[key], str) and validate_iso8601(data[key])):
+                raise ValidationError(f"{key} must be an ISO 8601 time.")
+        columns = data.get("columns", [])
+        if not isinstance(columns, list) or not all(isinstance(column, str) for column in columns):
+            raise ValidationError("columns must be a list of column names.")
+        limit = data.get("limit", 1)
+        if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+            raise ValidationError("limit must be a positive integer.")
+        if "cursor" in data:
+            ExpendedQuery.decode_cursor(data["cursor"])
+
+    @staticmethod
+    def from_request(data: Dict) -> "ExpendedQuery":
+        """
+        :param data: A validated GET request
+        :return:
+        """
+        equals = {column: values if isinstance(values, list) else [values]
+                  for column, values in data.get("filters", {}).items()}
+        overlapping = None
+        if "from" in data or "until" in data:
+            overlapping = (iso8601_to_microseconds(data["from"]) if "from" in data else UNBOUNDED[0],
+                           iso8601_to_microseconds(data["until"]) if "until" in data else UNBOUNDED[1])
+        after = ExpendedQuery.decode_cursor(data["cursor"])[1] if "cursor" in data else 0
+        return ExpendedQuery(equals, overlapping, data.get("columns"), data.get("limit"), after)
+
+    @staticmethod
+    def encode_cursor(entity_name: str, after: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps([entity_name, after]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: Any) -> Tuple[str, int]:
+        """
+        :param cursor: As returned with a page
+        :return: (entity name, position of the next row)
+        """
+        try:
+            entity_name, after = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if isinstance(entity_name, str) and isinstance(after, int) and after >= 0:
+                return entity_name, after
+        except (AttributeError, ValueError, TypeError, binascii.Error):
+            pass
+        raise ValidationError("cursor is not one returned by a previous query.")
+
+    @property
+    def filtered(self) -> bool:
+        return len(self.equals) > 0 or self.overlapping is not None
+
+    @property
+    def everything(self) -> bool:
+        """
+        :return: Whether this is every column of every row
+        """
+        return not self.filtered and self.columns is None and self.limit is None and self.after == 0
+
+    def for_schema(self, schema) -> "ExpendedQuery":
+        """
+        :param schema: RequestSchema of the entity queried
+        :return: This query, checked against the columns of the entity
+        """
+        unknown = [column for column in self.equals if column not in [field.column for field in schema.collected]]
+        if len(unknown) > 0:
+            raise InvalidRequestError(f"Can only filter on collected columns, {unknown} are not.")
+        if self.overlapping is not None and schema.start is None:
+            raise InvalidRequestError("Can only filter on time on a Slotted entity.")
+        unknown = [column for column in self.columns or [] if column not in schema.columns]
+        if len(unknown) > 0:
+            raise InvalidRequestError(f"Can only return the columns of the entity, {unknown} are not.")
+        query = ExpendedQuery(self.equals, self.overlapping, self.columns, self.limit, self.after)
+        if schema.start is not None:
+            query.slot_columns = (schema.start.column, schema.end.column)
+        return query
+
+    @property
+    def filter_columns(self) -> List[str]:
+        columns = list(self.equals)
+        if self.overlapping is not None:
+            columns.extend(self.slot_columns)
+        return list(dict.fromkeys(columns))
+
+    def matches(self, frame: pd.DataFrame) -> np.ndarray:
+        """
+        :param frame: Expended rows, with the filter columns
+        :return: Which rows the filters accept
+        """
+        mask = np.ones(len(frame), dtype=bool)
+        for column, values in self.equals.items():
+            mask &= frame[column].isin(values).to_numpy() if column in frame.columns else False
+        if self.overlapping is not None:
+            mask &= self.overlaps(frame)
+        return mask
+
+    def overlaps(self, frame: pd.DataFrame) -> np.ndarray:
+        """
+        :param frame: Expended rows, with the time slot columns
+        :return: Which rows hold a time slot overlapping [from, until]
+        """
+        low, high = self.overlapping
+        start_column, end_column = self.slot_columns
+        if start_column not in frame.columns or end_column not in frame.columns:
+            return np.zeros(len(frame), dtype=bool)
+        slots = zip((_microseconds(value) for value in frame[start_column]), (_microseconds(value) for value in frame[end_column]))
+        return np.fromiter((start is not None and end is not None and start <= high and end >= low
+                            for start, end in slots), dtype=bool, count=len(frame))
+
+    def page(self, frame: pd.DataFrame) -> Tuple[pd.DataFrame, Union[int, None]]:
+        """
+        :param frame: The matching rows from after, or at least limit + 1 of them, indexed by position
+        :return: The rows of the page with the requested columns, and the position to continue from, None if it is the last
+        """
+        after = None
+        if self.limit is not None and len(frame) > self.limit:
+            frame = frame.iloc[:self.limit]
+            after = int(frame.index[-1]) + 1
+        if self.columns is not None:
+            frame = frame.reindex(columns=self.columns)
+        return frame, after
@@ -0,0 +1,180 @@
+import fcntl
+import glob
+import json
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Tuple, Union
+
+from utils.constants import TEMPORARY_DATA_ROOT, DURABILITY, DURABILITY_MODES, DURABILITY_BATCH_MS
+
+# written sequence, synced sequence, time of the last flush in nanoseconds
+_STATE = struct.Struct("<qqq")
+STATE_SUFFIX = ".commit"
+SETTINGS_FILE_NAME = "storage.json"
+
+
+def fsync_path(path: str, directory: bool = False) -> None:
+    """
+    fsync of a file, or of a directory once entries are created or renamed in it. Missing files are skipped.
+    :param path:
+    :param directory:
+    :return:
+    """
+    try:
+        descriptor = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def organization_durability(org_name: str) -> str:
+    """
+    :param org_name:
+    :return: The durability mode an organization was created with, or the default
+    """
+    settings_path = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{SETTINGS_FILE_NAME}"
+    try:
+        with open(settings_path, "r") as file:
+            return json.load(file).get("durability", DURABILITY)
+    except (FileNotFoundError, ValueError):
+        return DURABILITY
+
+
+class GroupCommit:
+    """
+    Makes writes to a file durable, with one flush for every writer waiting at the same time, across worker processes.
+
+    A writer that finished writing (its data is in the page cache) takes the next write sequence number. Then, by mode:
+        commit: it waits to be durable. The first waiter becomes the leader: it notes the last sequence written,
+            flushes once, and records that sequence as synced. Writers that queued while it flushed find themselves synced,
+            or elect the next leader, which flushes all of them together. Under contention, this is one fsync per group.
+        batched: it does not wait. Writes are flushed at most interval after they are made, by the writer that finds
+            the last flush older than that, or by a DurabilityFlusher when no one writes.
+        os: it does not flush, the OS writes the page cache back when it wants to.
+    The sequences live in {path}.commit, so every process writing the file shares them.
+    """
+
+    def __init__(self, path: str, mode: str = DURABILITY, interval: float = DURABILITY_BATCH_MS / 1000):
+        """
+        :param path: The file written, ex. a log
+        :param mode: commit, batched or os
+        :param interval: Seconds a batched write may wait for its flush
+        """
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode {mode}, expected one of {list(DURABILITY_MODES)}.")
+        self.path = path
+        self.mode = mode
+        self._interval_ns = int(interval * 1e9)
+        self._state_path = f"{path}{STATE_SUFFIX}"
+        self._leader_path = f"{path}{STATE_SUFFIX}.leader"
+
+    @staticmethod
+    @contextmanager
+    def _flocked(path: str, blocking: bool = True):
+        """
+        :return: Context with the locked descriptor, or None if not blocking and the lock is held elsewhere
+        """
+        descriptor = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+            try:
+                yield descriptor
+            finally:
+                fcntl.flock(descriptor, fcntl.LOCK_UN)
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def _read(descriptor: int) -> Tuple[int, int, int]:
+        data = os.pread(descriptor, _STATE.size, 0)
+        return _STATE.unpack(data) if len(data) == _STATE.size else (0, 0, 0)
+
+    def _state(self) -> Tuple[int, int, int]:
+        with GroupCommit._flocked(self._state_path) as descriptor:
+            return GroupCommit._read(descriptor)
+
+    def _written(self) -> int:
+        """
+        :return: The sequence number of a write that just completed
+        """
+        with GroupCommit._flocked(self._state_path) as descriptor:
+            written, synced, synced_at = GroupCommit._read(descriptor)
+            os.pwrite(descriptor, _STATE.pack(written + 1, synced, synced_at), 0)
+            return written + 1
+
+    def _sync(self, sequence: Union[int, None], blocking: bool) -> None:
+        """
+        Flushes as the leader, unless already flushed
+        :param sequence: Sequence that must be synced, None for every write
+        :param blocking: Wait for the current leader, otherwise leave it the flush
+        :return:
+        """
+        with GroupCommit._flocked(self._leader_path, blocking) as leader:
+            if leader is None:
+                return
+            written, synced, _ = self._state()
+            if synced >= (written if sequence is None else sequence):
+                # flushed by the previous leader
+                return
+            # every write up to written is in the page cache, and is made durable by this flush
+            fsync_path(self.path)
+            with GroupCommit._flocked(self._state_path) as descriptor:
+                current_written, synced, _ = GroupCommit._read(descriptor)
+                os.pwrite(descriptor, _STATE.pack(current_written, max(synced, written), time.time_ns()), 0)
+
+    def commit(self) -> None:
+        """
+        Call once a write to the file completed. Returns once it is as durable as the mode requires.
+        :return:
+        """
+        if self.mode == "os":
+            return
+        sequence = self._written()
+        if self.mode == "commit":
+            self._sync(sequence, blocking=True)
+            return
+        _, _, synced_at = self._state()
+        if time.time_ns() - synced_at >= self._interval_ns:
+            self._sync(None, blocking=False)
+
+    def flush_pending(self) -> None:
+        """
+        Flushes writes not flushed yet, if no leader is flushing them already
+        :return:
+        """
+        self._sync(None, blocking=False)
+
+
+class DurabilityFlusher(threading.Thread):
+    """
+    Background thread flushing batched writes that no later writer flushed
+    """
+
+    def __init__(self, interval: float = DURABILITY_BATCH_MS / 1000):
+        super().__init__(daemon=True, name="DurabilityFlusher")
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def flush_all(self) -> None:
+        for state_path in glob.glob(f"{TEMPORARY_DATA_ROOT}/organization_*/*{STATE_SUFFIX}"):
+            try:
+                GroupCommit(state_path[:-len(STATE_SUFFIX)], "batched").flush_pending()
+            except Exception as e:
+                print(f"Could not flush {state_path}: {e}")
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.flush_all()
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,97 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Tuple, Iterable
+
+from backend.utils.utils import iso8601_to_microseconds
+
+
+class IntervalIndex:
+    """
+    Closed time slots [start, end] as microseconds since the epoch, for counting the slots that overlap a new one.
+
+    Starts and ends are kept in two sorted lists. A stored slot overlaps [start, end] when it starts at or before end and
+    ends at or after start. Every slot ending before start also starts before end, so the overlapping slots are counted as
+    (slots starting at or before end) - (slots ending before start), with two bisects, whether or not stored slots overlap
+    each other. Inserting is a bisect and a shift of the lists.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def starts(self) -> List[int]:
+        return self._starts
+
+    @property
+    def ends(self) -> List[int]:
+        return self._ends
+
+    def add(self, start: int, end: int) -> None:
+        insort(self._starts, start)
+        insort(self._ends, end)
+
+    def extend(self, slots: Iterable[Tuple[int, int]]) -> None:
+        for start, end in slots:
+            self._starts.append(start)
+            self._ends.append(end)
+        # the lists are a sorted run followed by the new slots, which sorts in about linear time
+        self._starts.sort()
+        self._ends.sort()
+
+    def count_overlapping(self, start: int, end: int) -> int:
+        return bisect_right(self._starts, end) - bisect_left(self._ends, start)
+
+    def clear(self) -> None:
+        self._starts.clear()
+        self._ends.clear()
+
+
+class EntitySlots:
+    """
+    The interval index of the expended slots of an entity, built once per process from its storage and
+    then extended with the rows appended since, by this worker or any other.
+    """
+    # (organization name, entity name, start column, end column) -> slots of this process
+    _loaded: Dict[Tuple[str, str, str, str], "EntitySlots"] = {}
+
+    def __init__(self, start_column: str, end_column: str):
+        self.start_column = start_column
+        self.end_column = end_column
+        self.index = IntervalIndex()
+        # number of expended rows indexed
+        self.position = 0
+
+    @staticmethod
+    def of(storage, start_column: str, end_column: str) -> "EntitySlots":
+        """
+        :param storage: EntityStorage of the entity
+        :param start_column:
+        :param end_column:
+        :return: The up-to-date slots of the entity
+        """
+        key = (storage.org_name, storage.entity_name, start_column, end_column)
+        slots = EntitySlots._loaded.get(key)
+        if slots is None:
+            slots = EntitySlots(start_column, end_column)
+            EntitySlots._loaded[key] = slots
+        slots.refresh(storage)
+        return slots
+
+    def refresh(self, storage) -> None:
+        if storage.count() < self.position:
+            # the table was recreated, index it again
+            self.index.clear()
+            self.position = 0
+        rows, self.position = storage.expended_since(self.position)
+        slots = []
+        for row in rows:
+            try:
+                slots.append((iso8601_to_microseconds(row[self.start_column]), iso8601_to_microseconds(row[self.end_column])))
+            except (KeyError, TypeError, ValueError):
+                # not a time slot, ex. a row stored before the entity had these columns
+                continue
+        if len(slots) > 0:
+            self.index.extend(slots)
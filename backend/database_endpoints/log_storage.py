@@ -0,0 +1,524 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Any, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from backend.database_endpoints.columnar import ColumnarTable
+from backend.database_endpoints.data_version import DataVersion
+from backend.database_endpoints.expended_query import ExpendedQuery, QUERY_SCAN_ROWS
+from backend.database_endpoints.group_commit import GroupCommit, fsync_path, organization_durability
+from utils.constants import TEMPORARY_DATA_ROOT, LOG_COMPACTION_BYTES, LOG_COMPACTION_INTERVAL
+
+LOG_SUFFIX = "_resources_expended.log"
+
+
+class _MaterializedView:
+    """
+    The rows of an entity as of some log offset: its snapshot, and the log rows appended after it.
+    The snapshot is either a frame, or a memory-mapped ColumnarTable that is only turned into one when every row is needed.
+    """
+
+    def __init__(self, signature: Tuple, snapshot: pd.DataFrame = None, table: ColumnarTable = None):
+        self.signature = signature
+        self.table = table
+        self._snapshot = snapshot
+        self.log_rows: List[Dict[str, Any]] = []
+        self.offset = 0
+        self._frame = snapshot
+
+    def extend(self, rows: List[Dict[str, Any]], offset: int) -> None:
+        self.log_rows.extend(rows)
+        self.offset = offset
+        if len(rows) > 0:
+            self._frame = None
+
+    @property
+    def snapshot(self) -> pd.DataFrame:
+        if self._snapshot is None:
+            self._snapshot = self.table.to_frame()
+        return self._snapshot
+
+    @property
+    def snapshot_length(self) -> int:
+        return len(self.table) if self._snapshot is None else len(self._snapshot)
+
+    def snapshot_since(self, position: int) -> pd.DataFrame:
+        """
+        :return: The snapshot rows after position, without reading those before it from a table
+        """
+        if self._snapshot is None:
+            return self.table.to_frame(start=position)
+        return self._snapshot.iloc[position:]
+
+    def __len__(self):
+        return self.snapshot_length + len(self.log_rows)
+
+    @property
+    def columns(self) -> List[str]:
+        snapshot_columns = self.table.columns if self._snapshot is None else list(self._snapshot.columns)
+        return list(dict.fromkeys(snapshot_columns + [column for row in self.log_rows for column in row]))
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            if len(self.log_rows) == 0:
+                self._frame = self.snapshot
+            elif self.snapshot_length == 0:
+                self._frame = pd.DataFrame(self.log_rows).reindex(columns=self.columns)
+            else:
+                self._frame = pd.concat([self.snapshot, pd.DataFrame(self.log_rows)], ignore_index=True)
+        return self._frame
+
+    def select(self, columns: List[str] = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """
+        :param columns: Columns to read, every column if None
+        :param start:
+        :param stop:
+        :return: Rows [start, stop), indexed by their position. Only those rows and columns of a table are read.
+        """
+        length = len(self)
+        stop = length if stop is None else max(min(stop, length), 0)
+        start = min(max(start, 0), stop)
+        if self._frame is not None or self.table is None:
+            frame = self.frame.iloc[start:stop]
+            return frame if columns is None else frame.reindex(columns=columns)
+        columns = self.columns if columns is None else columns
+        snapshot_length = self.snapshot_length
+        parts = []
+        if start < snapshot_length:
+            parts.append(self.table.to_frame(columns, start, min(stop, snapshot_length)))
+        if stop > snapshot_length:
+            log_start = max(start, snapshot_length)
+            parts.append(pd.DataFrame(self.log_rows[log_start - snapshot_length:stop - snapshot_length],
+                                      index=pd.RangeIndex(log_start, stop)))
+        if len(parts) == 0:
+            return pd.DataFrame(columns=columns, index=pd.RangeIndex(start, stop))
+        frame = parts[0] if len(parts) == 1 else pd.concat(parts)
+        return frame.reindex(columns=columns)
+
+    def query(self, query: ExpendedQuery) -> Tuple[pd.DataFrame, Union[int, None]]:
+        """
+        Scans from query.after for the rows of a page. The rows of a table are filtered on its codes and times,
+        and only the matching ones are read.
+        :param query:
+        :return: See EntityStorage.query
+        """
+        needed = None if query.limit is None else query.limit + 1
+        columns = self.columns if query.columns is None else query.columns
+        read = list(dict.fromkeys(query.filter_columns + columns))
+        parts, matched, position, length = [], 0, max(query.after, 0), len(self)
+        while position < length and (needed is None or matched < needed):
+            stop = min(position + QUERY_SCAN_ROWS, length)
+            if self.table is not None and self._frame is None and position < self.snapshot_length:
+                stop = min(stop, self.snapshot_length)
+                rows = np.flatnonzero(self._table_matches(query, position, stop)) + position
+                part = self.table.take(columns, rows if needed is None else rows[:needed - matched])
+            else:
+                chunk = self.select(read, position, stop)
+                part = chunk[query.matches(chunk)]
+                part = part if needed is None else part.iloc[:needed - matched]
+            parts.append(part)
+            matched += len(part)
+            position = stop
+        if len(parts) == 0:
+            return query.page(pd.DataFrame(columns=columns))
+        return query.page((parts[0] if len(parts) == 1 else pd.concat(parts)).reindex(columns=columns))
+
+    def _table_matches(self, query: ExpendedQuery, start: int, stop: int) -> np.ndarray:
+        """
+        :return: Which rows [start, stop) of the table the filters of the query accept
+        """
+        table_columns = set(self.table.columns)
+        mask = np.ones(stop - start, dtype=bool)
+        for column, values in query.equals.items():
+            mask &= self.table.equals(column, values, start, stop) if column in table_columns else False
+        if query.overlapping is not None:
+            overlapping = self.table.overlapping(*query.slot_columns, *query.overlapping, start, stop)
+            if overlapping is None:
+                # not stored as times, ex. a column with some invalid times
+                overlapping = query.overlaps(self.table.to_frame(list(query.slot_columns), start, stop))
+            mask &= overlapping
+        return mask
+
+
+class EntityLog:
+    """
+    Append-only storage of the expended rows of an entity.
+
+    Registrations are appended as JSON lines to {entity}_resources_expended.log, so a write costs the same however
+    large the table is. The existing {entity}_resources_expended.csv is the snapshot, also stored as a ColumnarTable
+    in {entity}_resources_expended.columns, which readers map instead of parsing the CSV. Readers keep a materialized
+    view (snapshot + log) per process, and only read the part of the log appended since they last looked.
+    Compaction folds the log into a new snapshot. Every operation holds an flock on {entity}_resources_expended.lock,
+    so appends, reads and compaction are consistent across the forked worker processes.
+    """
+    # log path -> materialized view of this process
+    _views: Dict[str, _MaterializedView] = {}
+    # lock path -> nesting depth, for the locks held by the current thread
+    _held = threading.local()
+
+    def __init__(self, org_name: str, entity_name: str):
+        base_path = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{entity_name}_resources_expended"
+        self.snapshot_path = f"{base_path}.csv"
+        self.log_path = f"{base_path}.log"
+        self._lock_path = f"{base_path}.lock"
+        self._compacting_path = f"{base_path}.log.compacting"
+        self._new_snapshot_path = f"{base_path}.csv.tmp"
+        self.counter_path = f"{base_path}.counter"
+        self.columns_path = f"{base_path}.columns"
+        self._group_commit = GroupCommit(self.log_path, organization_durability(org_name))
+        self._data_version = DataVersion(org_name, entity_name)
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        depths = EntityLog._held.__dict__.setdefault("depths", {})
+        if depths.get(self._lock_path, 0) > 0:
+            # this thread is inside a transaction, which holds the lock exclusively
+            depths[self._lock_path] += 1
+            try:
+                yield
+            finally:
+                depths[self._lock_path] -= 1
+            return
+        descriptor = os.open(self._lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            depths[self._lock_path] = 1
+            yield
+        finally:
+            depths[self._lock_path] = 0
+            fcntl.flock(descriptor, fcntl.LOCK_UN)
+            os.close(descriptor)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Holds the lock exclusively, so that reads and appends of this thread inside it are not interleaved with others.
+        Appends are durable once it exits.
+        :return: Context manager
+        """
+        with self._locked(True):
+            yield
+        self._make_durable()
+
+    def _make_durable(self) -> None:
+        """
+        Waits for the appends of this thread to be flushed, once it released the lock so that others can append meanwhile,
+        and gives the rows, now visible to readers, a new data version
+        :return:
+        """
+        unsynced = EntityLog._held.__dict__.setdefault("unsynced", set())
+        if self.log_path in unsynced and EntityLog._held.__dict__.setdefault("depths", {}).get(self._lock_path, 0) == 0:
+            unsynced.discard(self.log_path)
+            try:
+                self._group_commit.commit()
+            finally:
+                self._data_version.bump()
+
+    def _needs_recovery(self) -> bool:
+        return os.path.exists(self._compacting_path) or os.path.exists(self._new_snapshot_path)
+
+    def _recover(self) -> None:
+        """
+        Finishes or rolls back a compaction that was interrupted. Must hold the exclusive lock.
+        :return:
+        """
+        if os.path.exists(self._compacting_path):
+            if os.path.exists(self._new_snapshot_path):
+                # the new snapshot was never installed, the old snapshot and the log are authoritative
+                os.remove(self._new_snapshot_path)
+                os.rename(self._compacting_path, self.log_path)
+            else:
+                # the new snapshot holds the compacted rows
+                os.remove(self._compacting_path)
+        elif os.path.exists(self._new_snapshot_path):
+            os.remove(self._new_snapshot_path)
+
+    def _snapshot_signature(self) -> Tuple:
+        stat = os.stat(self.snapshot_path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self) -> _MaterializedView:
+        """
+        Brings the view of this process up-to-date. Must hold a lock.
+        :return:
+        """
+        signature = self._snapshot_signature()
+        view = EntityLog._views.get(self.log_path)
+        if view is None or view.signature != signature:
+            table = ColumnarTable.load(self.columns_path, signature)
+            if table is None:
+                view = _MaterializedView(signature, pd.read_csv(self.snapshot_path))
+            else:
+                view = _MaterializedView(signature, table=table)
+            EntityLog._views[self.log_path] = view
+        try:
+            size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            size = 0
+        if size < view.offset:
+            # the log was compacted into a snapshot with the same signature, start over
+            EntityLog._views.pop(self.log_path)
+            return self._refresh()
+        if size > view.offset:
+            with open(self.log_path, "rb") as file:
+                file.seek(view.offset)
+                appended = file.read(size - view.offset)
+            # a line without its newline is still being written, or was torn by a crash
+            complete = appended.rfind(b"\n") + 1
+            view.extend([json.loads(line) for line in appended[:complete].splitlines() if line.strip()],
+                        view.offset + complete)
+        return view
+
+    def _truncate_torn_tail(self) -> None:
+        """
+        Removes a last line left without its newline by a crash during an append, so that later appends do not extend
+        it into an invalid line. Must hold the exclusive lock, so that no append is in progress.
+        :return:
+        """
+        try:
+            descriptor = os.open(self.log_path, os.O_RDWR)
+        except FileNotFoundError:
+            return
+        try:
+            end = os.lseek(descriptor, 0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - 65536, 0)
+                newline = os.pread(descriptor, position - start, start).rfind(b"\n")
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position < end:
+                print(f"Truncating {end - position} bytes of a torn line at the end of {self.log_path}")
+                os.ftruncate(descriptor, position)
+                os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def repair(self) -> None:
+        """
+        Recovers an interrupted compaction and truncates a torn last line
+        :return:
+        """
+        with self._locked(True):
+            if self._needs_recovery():
+                self._recover()
+            self._truncate_torn_tail()
+
+    def view(self) -> pd.DataFrame:
+        """
+        :return: Every expended row, the snapshot followed by the log
+        """
+        return self._current().frame
+
+    def select(self, columns: List[str] = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """
+        :param columns: Columns to read, every column if None
+        :param start:
+        :param stop:
+        :return: Expended rows [start, stop), indexed by their position
+        """
+        return self._current().select(columns, start, stop)
+
+    def query(self, query: ExpendedQuery) -> Tuple[pd.DataFrame, Union[int, None]]:
+        """
+        :param query:
+        :return: See EntityStorage.query
+        """
+        return self._current().query(query)
+
+    def count(self) -> int:
+        """
+        :return: Number of expended rows, without building the frame
+        """
+        return len(self._current())
+
+    def rows_since(self, position: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Rows are only ever appended, and compaction keeps their order, so a position stays valid across compactions.
+        :param position: Number of rows already seen
+        :return: The rows after position, and the new position
+        """
+        view = self._current()
+        snapshot_length = view.snapshot_length
+        rows = view.snapshot_since(position).to_dict("records") if position < snapshot_length else []
+        rows.extend(view.log_rows[max(position - snapshot_length, 0):])
+        return rows, len(view)
+
+    def _current(self) -> _MaterializedView:
+        if self._needs_recovery():
+            with self._locked(True):
+                self._recover()
+                return self._refresh()
+        with self._locked(False):
+            return self._refresh()
+
+    def append(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Appends rows to the log
+        :param rows:
+        :return:
+        """
+        if len(rows) == 0:
+            return
+        data = "".join(json.dumps(row, default=str) + "\n" for row in rows).encode()
+        with self._locked(True):
+            if self._needs_recovery():
+                self._recover()
+            self._truncate_torn_tail()
+            created = not os.path.exists(self.log_path)
+            descriptor = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(descriptor, data)
+            finally:
+                os.close(descriptor)
+            if created:
+                fsync_path(os.path.dirname(self.log_path), directory=True)
+            EntityLog._held.__dict__.setdefault("unsynced", set()).add(self.log_path)
+        self._make_durable()
+
+    def compact(self) -> bool:
+        """
+        Writes the view as the new snapshot and empties the log.
+        The log is renamed aside before the snapshot is replaced, so an interrupted compaction can be recovered.
+        :return: Whether there was anything to compact
+        """
+        with self._locked(True):
+            if self._needs_recovery():
+                self._recover()
+            if not os.path.exists(self.log_path) or os.path.getsize(self.log_path) == 0:
+                return False
+            counter = self.read_counter()
+            frame = self._refresh().frame
+            frame.to_csv(self._new_snapshot_path, index=False)
+            # the snapshot must be durable before the log it replaces is removed
+            fsync_path(self._new_snapshot_path)
+            os.rename(self.log_path, self._compacting_path)
+            os.replace(self._new_snapshot_path, self.snapshot_path)
+            fsync_path(os.path.dirname(self.snapshot_path), directory=True)
+            os.remove(self._compacting_path)
+            view = _MaterializedView(self._snapshot_signature(), frame)
+            EntityLog._views[self.log_path] = view
+            self._write_columns(frame, view.signature)
+            if os.path.exists(self.counter_path) and not counter[2]:
+                # the rows did not change, so a current counter still is
+                self._write_counter({"total": counter[0], "position": counter[1], "log_size": 0,
+                                     "snapshot": list(view.signature)})
+            return True
+
+    def write_columns(self) -> bool:
+        """
+        Stores the snapshot as a ColumnarTable, unless it already is, ex. for snapshots written before tables were kept
+        :return: Whether a table was written
+        """
+        with self._locked(True):
+            if self._needs_recovery():
+                self._recover()
+            signature = self._snapshot_signature()
+            if ColumnarTable.load(self.columns_path, signature) is not None:
+                return False
+            return self._write_columns(pd.read_csv(self.snapshot_path), signature)
+
+    def _write_columns(self, frame: pd.DataFrame, signature: Tuple) -> bool:
+        """
+        Must hold the exclusive lock. The CSV snapshot stays authoritative, so readers fall back to it if this fails.
+        """
+        try:
+            ColumnarTable.write(self.columns_path, frame, signature)
+            return True
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Could not write the columnar table {self.columns_path}: {e}")
+            return False
+
+    def _log_size(self) -> int:
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    def read_counter(self) -> Tuple[int, int, bool]:
+        """
+        A counter kept beside the log, see write_counter
+        :return: (total, position, whether rows may have been appended after position)
+        """
+        with self._locked(False):
+            try:
+                with open(self.counter_path, "r") as file:
+                    counter = json.load(file)
+            except (FileNotFoundError, ValueError):
+                return 0, 0, True
+            # the counter is current while the files are as they were when it was written
+            current = counter["log_size"] == self._log_size() and tuple(counter["snapshot"]) == self._snapshot_signature()
+            return counter["total"], counter["position"], not current
+
+    def write_counter(self, total: int, position: int) -> None:
+        """
+        Stores a running total of the first position rows, ex. tickets taken. Call it in a transaction, after appending.
+        :param total:
+        :param position:
+        :return:
+        """
+        with self._locked(True):
+            self._write_counter({"total": total, "position": position, "log_size": self._log_size(),
+                                 "snapshot": list(self._snapshot_signature())})
+
+    def _write_counter(self, counter: Dict[str, Any]) -> None:
+        temporary_path = f"{self.counter_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(counter, file)
+        os.replace(temporary_path, self.counter_path)
+
+    @staticmethod
+    def from_log_path(log_path: str) -> "EntityLog":
+        organization_path, file_name = os.path.split(log_path)
+        org_name = os.path.basename(organization_path)[len("organization_"):]
+        return EntityLog(org_name, file_name[:-len(LOG_SUFFIX)])
+
+
+class LogCompactor(threading.Thread):
+    """
+    Background thread compacting every entity log, and checkpointing every SQLite WAL, above a size threshold
+    """
+
+    def __init__(self, interval: float = LOG_COMPACTION_INTERVAL, threshold: int = LOG_COMPACTION_BYTES):
+        super().__init__(daemon=True, name="LogCompactor")
+        self._interval = interval
+        self._threshold = threshold
+        self._stopped = threading.Event()
+
+    def compact_all(self) -> int:
+        """
+        Compacts the entity logs, and checkpoints the WAL of SQLite databases, above the threshold
+        :return: Number of logs compacted or checkpointed
+        """
+        from backend.database_endpoints.sqlite_storage import SqliteStorage, DATABASE_FILE_NAME
+
+        compacted = 0
+        for log_path in glob.glob(f"{TEMPORARY_DATA_ROOT}/organization_*/*{LOG_SUFFIX}"):
+            try:
+                if os.path.getsize(log_path) >= self._threshold and EntityLog.from_log_path(log_path).compact():
+                    compacted += 1
+            except Exception as e:
+                print(f"Could not compact {log_path}: {e}")
+        for wal_path in glob.glob(f"{TEMPORARY_DATA_ROOT}/organization_*/{DATABASE_FILE_NAME}-wal"):
+            try:
+                if os.path.getsize(wal_path) >= self._threshold and SqliteStorage.checkpoint(wal_path[:-len("-wal")]):
+                    compacted += 1
+            except Exception as e:
+                print(f"Could not checkpoint {wal_path}: {e}")
+        return compacted
+
+    def run(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.compact_all()
+
+    def stop(self) -> None:
+        self._stopped.set()
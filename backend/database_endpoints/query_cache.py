@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Any, Tuple, Union
+
+from utils.constants import TEMPORARY_DATA_ROOT, QUERY_CACHE_ENTRIES
+
+# keys of a GET request which its results depend on
+QUERY_KEYS = ("entity", "recursive", "filters", "from", "until", "columns", "limit", "cursor", "aggregate")
+# keys which choose the entities of a query, rather than the result of each
+SUBTREE_KEYS = ("entity", "recursive")
+CACHE_DIRECTORY_NAME = "query_cache"
+
+
+class QueryCache:
+    """
+    The GET results of the entities of an organization, stored on disk so that every worker shares them, in
+    {organization}/query_cache. An entry is the result of one entity for one query, with the data version of the entity
+    it was read at, and is only used while the entity is at that version. A subtree query is made of the entries of its
+    entities, so queries of overlapping subtrees share them.
+
+    Versions are read before the data, so an entry never holds data older than its version.
+    The ETag of a query is a digest of the query and of the versions of the entities it covers.
+    """
+
+    def __init__(self, org_name: str, data: Dict):
+        """
+        :param org_name:
+        :param data: The raw GET request
+        """
+        self._directory = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{CACHE_DIRECTORY_NAME}"
+        query = {key: data[key] for key in QUERY_KEYS if key in data}
+        self.signature = json.dumps(query, sort_keys=True)
+        self._entity_signature = json.dumps({key: value for key, value in query.items() if key not in SUBTREE_KEYS},
+                                            sort_keys=True)
+
+    @staticmethod
+    def etag(signature: str, versions: List[Tuple[str, int]]) -> str:
+        """
+        :param signature: Of the query
+        :param versions: (entity name, data version) of each entity of the query, in tree order
+        :return: Quoted entity tag
+        """
+        return f'"{hashlib.sha1(json.dumps([signature, versions]).encode()).hexdigest()}"'
+
+    @staticmethod
+    def matches(if_none_match: Union[str, None], etag: str) -> bool:
+        """
+        :param if_none_match: The If-None-Match header of a request
+        :param etag:
+        :return: Whether the client already has the response of etag
+        """
+        if if_none_match is None:
+            return False
+        # weak comparison, which is what If-None-Match uses
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+    def _path(self, entity_name: str) -> str:
+        digest = hashlib.sha1(json.dumps([entity_name, self._entity_signature]).encode()).hexdigest()
+        return f"{self._directory}/{digest}.json"
+
+    def load(self, entity_name: str, version: int) -> Union[Any, None]:
+        """
+        :param entity_name:
+        :param version: Current data version of the entity
+        :return: The cached result of the entity, or None if there is none at this version
+        """
+        if QUERY_CACHE_ENTRIES <= 0:
+            return None
+        try:
+            with open(self._path(entity_name), "r") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if entry.get("entity") != entity_name or entry.get("query") != self._entity_signature or entry.get("version") != version:
+            return None
+        return entry["result"]
+
+    def store(self, entity_name: str, version: int, result: Any) -> None:
+        """
+        :param entity_name:
+        :param version: Data version of the entity, read before the result
+        :param result:
+        :return:
+        """
+        if QUERY_CACHE_ENTRIES <= 0:
+            return
+        path = self._path(entity_name)
+        temporary_path = f"{path}.{os.getpid()}.{id(result)}.tmp"
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            with open(temporary_path, "w") as file:
+                json.dump({"entity": entity_name, "query": self._entity_signature, "version": version, "result": result}, file)
+            os.replace(temporary_path, path)
+            self._evict()
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Could not cache the query result of {entity_name}: {e}")
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+
+    def _evict(self) -> None:
+        """
+        Removes the least recently written entries above QUERY_CACHE_ENTRIES
+        :return:
+        """
+        entries = [entry for entry in os.scandir(self._directory) if entry.name.endswith(".json")]
+        if len(entries) <= QUERY_CACHE_ENTRIES:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in entries[:len(entries) - QUERY_CACHE_ENTRIES]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                # removed by another worker
+                pass
@@ -0,0 +1,138 @@
+from typing import Dict, List, Tuple, Union, Any
+
+import pandas as pd
+
+from backend.database_endpoints.storage import EntityStorage
+from backend.utils.utils import FlatKeyIndex
+from utils.errors import DatabaseWriteError
+
+HEADER_PREFIX = "header::"
+
+
+class SchemaField:
+    """
+    One value extracted from a request into a storage row
+    """
+
+    def __init__(self, column: str, path: str, expected_type: Union[type, None] = None):
+        """
+        :param column: Column of the storage row
+        :param path: Dotted key of the value in the request
+        :param expected_type: Type the value must have, None for any
+        """
+        self.column = column
+        self.path = path
+        self.expected_type = expected_type
+
+    def accepts(self, value: Any) -> bool:
+        if self.expected_type is None:
+            return True
+        # bool is an int to isinstance, but never a valid quantity
+        return isinstance(value, self.expected_type) and not (self.expected_type is int and isinstance(value, bool))
+
+
+class RequestSchema:
+    """
+    What a Ticketed or Slotted entity stores for each request, compiled from its Collect, StartKey and EndKey.
+    Extraction is a single pass over a fixed list of fields, producing the storage row.
+    """
+    # (organization name, entity name) -> schema, the collected headers of an entity never change once created
+    _compiled: Dict[Tuple[str, str], "RequestSchema"] = {}
+
+    def __init__(self, collected: List[SchemaField], start: SchemaField = None, end: SchemaField = None):
+        self.collected = collected
+        self.start = start
+        self.end = end
+        self.fields = collected + [field for field in (start, end) if field is not None]
+
+    @property
+    def columns(self) -> List[str]:
+        return [field.column for field in self.fields]
+
+    @property
+    def indexes(self) -> List[Tuple[str, ...]]:
+        """
+        :return: Column groups that registrations query: the time slot, and each collected column
+        """
+        indexes = [(field.column,) for field in self.collected]
+        if self.start is not None:
+            indexes.insert(0, (self.start.column, self.end.column))
+        return indexes
+
+    @property
+    def headers_map(self) -> Dict[str, str]:
+        """
+        :return: Collected column -> dotted request key
+        """
+        return {field.column: field.path for field in self.collected}
+
+    @staticmethod
+    def _build(collect: Dict[str, str], ticketed: bool, start_key: str = None, end_key: str = None) -> "RequestSchema":
+        collected = [SchemaField(column, path, int if ticketed and column == "quantity" else None)
+                     for column, path in collect.items()]
+        if ticketed:
+            return RequestSchema(collected)
+        # time slots are stored under the last part of their key
+        return RequestSchema(collected, SchemaField(start_key.split(".")[-1], start_key, str),
+                             SchemaField(end_key.split(".")[-1], end_key, str))
+
+    @staticmethod
+    def from_definition(entity_definition: Dict) -> "RequestSchema":
+        """
+        :param entity_definition: Definition of a Ticketed or Slotted entity, as given when it is created
+        :return:
+        """
+        return RequestSchema._build(entity_definition["Collect"], entity_definition["Type"] == "Ticketed",
+                                    entity_definition.get("StartKey"), entity_definition.get("EndKey"))
+
+    @staticmethod
+    def from_information(data_information: pd.DataFrame) -> "RequestSchema":
+        """
+        :param data_information: The resources info sheet of an entity
+        :return:
+        """
+        first_row = data_information.iloc[0]
+        collect = {column[len(HEADER_PREFIX):]: first_row[column]
+                   for column in data_information.columns if column.startswith(HEADER_PREFIX)}
+        ticketed = "start_key" not in data_information.columns
+        if ticketed:
+            return RequestSchema._build(collect, True)
+        return RequestSchema._build(collect, False, first_row["start_key"], first_row["end_key"])
+
+    @staticmethod
+    def for_entity(org_name: str, entity_name: str, data_information: pd.DataFrame = None) -> "RequestSchema":
+        """
+        The schema of an entity, compiled from its info sheet on first use in this process
+        :param org_name:
+        :param entity_name:
+        :param data_information: The info sheet if already read, otherwise it is read here
+        :return:
+        """
+        key = (org_name, entity_name)
+        if key not in RequestSchema._compiled:
+            if data_information is None:
+                data_information = EntityStorage.for_entity(org_name, entity_name).information()
+            RequestSchema._compiled[key] = RequestSchema.from_information(data_information)
+        return RequestSchema._compiled[key]
+
+    def extract(self, key_index: FlatKeyIndex) -> Dict[str, Any]:
+        """
+        Extracts and type checks every field of a request
+        :param key_index: Flat key index of the request
+        :return: The storage row, column -> value
+        """
+        row, missing, mistyped = {}, [], []
+        for field in self.fields:
+            try:
+                value = key_index.lookup(field.path)
+            except KeyError:
+                missing.append(field.path)
+                continue
+            if not field.accepts(value):
+                mistyped.append(f"{field.path} must be {field.expected_type.__name__}")
+            row[field.column] = value
+        if len(missing) > 0:
+            raise DatabaseWriteError(f"Tracking {[field.path for field in self.fields]} but {missing} not provided.")
+        if len(mistyped) > 0:
+            raise DatabaseWriteError(f"Invalid values: {', '.join(mistyped)}.")
+        return row
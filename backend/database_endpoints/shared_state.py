@@ -0,0 +1,297 @@
+import hashlib
+import os
+from multiprocessing import shared_memory
+from typing import Dict, List, Callable, Tuple, Union, Any
+
+import numpy as np
+
+from utils.constants import SHARED_ENTITY_STATE
+
+# fields of the header of a state segment, as int64
+_SEQUENCE, _VALID, _ROWS, _TICKETS, _SLOTS, _CAPACITY = range(6)
+_HEADER = 8
+# reads retried while the writer is updating the segment, before falling back to the storage
+_READ_ATTEMPTS = 64
+SEGMENT_PREFIX = "sus"
+
+
+def _unlink(name: str) -> None:
+    try:
+        segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+class SharedEntityState:
+    """
+    The allocation state of an entity in shared memory, so that any worker answers registrations without reading its
+    storage: the number of expended rows, the tickets taken, and the sorted starts and ends of its expended slots.
+
+    Each state is a segment {prefix}_{session}_{entity hash}_{generation}: a header followed by two int64 arrays of
+    capacity slots, which readers count overlaps on in place. A small segment {prefix}_{session}_{entity hash} names the
+    current generation, a new one is made when the arrays are full. The session is the server process, so segments
+    left behind by a previous server are never read.
+
+    There is a single writer per entity: the worker holding the storage transaction of the entity, which updates the
+    state after writing the storage. It marks the sequence odd while it updates, and readers, which take no lock,
+    retry when the sequence was odd or changed while they read. If a write fails, the state is invalidated, and
+    readers fall back to the storage until the next writer rebuilds it. The storage stays the only durable copy.
+    """
+    # pid of the server, which names the segments of its session. None outside of a server, which disables the states.
+    session: Union[int, None] = None
+    # (organization name, entity name) -> state attached by this process
+    _attached: Dict[Tuple[str, str], "SharedEntityState"] = {}
+
+    def __init__(self, org_name: str, entity_name: str):
+        digest = hashlib.sha1(f"{org_name}/{entity_name}".encode()).hexdigest()[:16]
+        self._name = f"{SEGMENT_PREFIX}_{SharedEntityState.session}_{digest}"
+        self._pointer = None
+        self._segment = None
+        self._values = None
+        self._generation = -1
+
+    @staticmethod
+    def start_session() -> None:
+        """
+        Enables the states for this process and the workers it forks. Call in the server, before replaying the storage.
+        :return:
+        """
+        if SHARED_ENTITY_STATE:
+            SharedEntityState.session = os.getpid()
+
+    @staticmethod
+    def end_session() -> None:
+        """
+        Removes the segments of the session
+        :return:
+        """
+        if SharedEntityState.session is None:
+            return
+        prefix = f"{SEGMENT_PREFIX}_{SharedEntityState.session}_"
+        try:
+            names = [name for name in os.listdir("/dev/shm") if name.startswith(prefix)]
+        except FileNotFoundError:
+            names = []
+        for state in SharedEntityState._attached.values():
+            state._detach()
+            if state._pointer is not None:
+                state._pointer.close()
+                state._pointer = None
+        for name in names:
+            _unlink(name)
+        SharedEntityState._attached.clear()
+        SharedEntityState.session = None
+
+    @staticmethod
+    def of(org_name: str, entity_name: str) -> Union["SharedEntityState", None]:
+        """
+        :param org_name:
+        :param entity_name:
+        :return: The state of the entity, or None if states are disabled
+        """
+        if SharedEntityState.session is None:
+            return None
+        key = (org_name, entity_name)
+        state = SharedEntityState._attached.get(key)
+        if state is None:
+            state = SharedEntityState(org_name, entity_name)
+            SharedEntityState._attached[key] = state
+        return state
+
+    def _current_generation(self) -> int:
+        """
+        :return: The generation named by the pointer segment, -1 if there is none yet
+        """
+        if self._pointer is None:
+            try:
+                self._pointer = shared_memory.SharedMemory(self._name)
+            except FileNotFoundError:
+                return -1
+        return int(np.ndarray((1,), dtype=np.int64, buffer=self._pointer.buf)[0])
+
+    def _attach(self) -> bool:
+        """
+        Maps the current generation, if it is not mapped already
+        :return: Whether there is a state to read
+        """
+        generation = self._current_generation()
+        if generation < 0:
+            return False
+        if generation != self._generation:
+            try:
+                segment = shared_memory.SharedMemory(f"{self._name}_{generation}")
+            except FileNotFoundError:
+                return False
+            self._detach()
+            self._segment = segment
+            self._values = np.ndarray((segment.size // 8,), dtype=np.int64, buffer=segment.buf)
+            self._generation = generation
+        return True
+
+    def _detach(self) -> None:
+        if self._segment is not None:
+            # views of the buffer must be released before it is closed
+            self._values = None
+            self._segment.close()
+            self._segment = None
+            self._generation = -1
+
+    def _read(self, read: Callable[[np.ndarray], Any]) -> Any:
+        """
+        Reads a consistent state without locking
+        :param read: Reads from the values of the segment
+        :return: What read returned, or None if there is no valid state
+        """
+        for _ in range(_READ_ATTEMPTS):
+            if not self._attach():
+                return None
+            done, result = self._read_once(read)
+            if done:
+                return result
+        return None
+
+    def _read_once(self, read: Callable[[np.ndarray], Any]) -> Tuple[bool, Any]:
+        """
+        :return: (False, None) if the read must be retried. The views of the segment are released on return,
+            so that it can be closed if the next attempt moves to a new generation.
+        """
+        values = self._values
+        sequence = int(values[_SEQUENCE])
+        if sequence % 2 == 1:
+            # the writer is updating it
+            return False, None
+        if values[_VALID] == 0:
+            # retried if it was replaced by a larger segment
+            return self._current_generation() == self._generation, None
+        result = read(values)
+        return int(values[_SEQUENCE]) == sequence, result
+
+    def tickets(self) -> Union[Tuple[int, int], None]:
+        """
+        :return: (tickets taken, number of expended rows), or None if the state does not hold them
+        """
+        counter = self._read(lambda values: (int(values[_TICKETS]), int(values[_ROWS])))
+        return None if counter is None or counter[0] < 0 else counter
+
+    def rows(self) -> Union[int, None]:
+        """
+        :return: Number of expended rows, or None if there is no valid state
+        """
+        return self._read(lambda values: int(values[_ROWS]))
+
+    def count_overlapping(self, start: int, end: int) -> Union[int, None]:
+        """
+        Same as IntervalIndex.count_overlapping, on the arrays of the segment
+        :param start: Microseconds since the epoch
+        :param end:
+        :return: The number of expended slots overlapping [start, end], or None if the state does not hold them
+        """
+
+        def count(values: np.ndarray) -> Union[int, None]:
+            slots, capacity = int(values[_SLOTS]), int(values[_CAPACITY])
+            if slots < 0:
+                return None
+            starts = values[_HEADER:_HEADER + slots]
+            ends = values[_HEADER + capacity:_HEADER + capacity + slots]
+            return int(np.searchsorted(starts, end, side="right") - np.searchsorted(ends, start, side="left"))
+
+        return self._read(count)
+
+    @property
+    def valid(self) -> bool:
+        return self._read(lambda values: True) is not None
+
+    def publish(self, rows: int, tickets: int = -1, starts: List[int] = None, ends: List[int] = None) -> None:
+        """
+        Replaces the state. Must hold the storage transaction of the entity, after writing the storage.
+        :param rows: Number of expended rows
+        :param tickets: Tickets taken, -1 if not a Ticketed entity
+        :param starts: Sorted starts of the expended slots, None if not a Slotted entity
+        :param ends: Sorted ends
+        :return:
+        """
+        slots = -1 if starts is None else len(starts)
+        if not self._attach() or self._values[_CAPACITY] < slots:
+            self._grow(max(slots, 0))
+        values = self._values
+        capacity = int(values[_CAPACITY])
+        values[_SEQUENCE] += 1
+        values[_ROWS], values[_TICKETS], values[_SLOTS] = rows, tickets, slots
+        if slots > 0:
+            values[_HEADER:_HEADER + slots] = starts
+            values[_HEADER + capacity:_HEADER + capacity + slots] = ends
+        values[_VALID] = 1
+        values[_SEQUENCE] += 1
+
+    def add_slots(self, rows: int, starts: List[int], ends: List[int]) -> bool:
+        """
+        Adds expended slots to a valid state. Must hold the storage transaction of the entity, after writing the storage.
+        :param rows: Number of expended rows added
+        :param starts: Starts of the slots added, sorted
+        :param ends: Ends of the slots added, sorted
+        :return: False if there is no valid state of the slots to add to, it must be published again
+        """
+        if not self._attach() or self._values[_VALID] == 0 or self._values[_SLOTS] < 0:
+            return False
+        slots = int(self._values[_SLOTS])
+        if self._values[_CAPACITY] < slots + len(starts):
+            self._grow(slots + len(starts))
+        values = self._values
+        capacity = int(values[_CAPACITY])
+        values[_SEQUENCE] += 1
+        for offset, added in ((_HEADER, starts), (_HEADER + capacity, ends)):
+            # both runs are sorted, so this sort is about linear
+            merged = np.concatenate([values[offset:offset + slots], np.asarray(added, dtype=np.int64)])
+            merged.sort(kind="stable")
+            values[offset:offset + len(merged)] = merged
+        values[_ROWS] += rows
+        values[_SLOTS] = slots + len(starts)
+        values[_SEQUENCE] += 1
+        return True
+
+    def invalidate(self) -> None:
+        """
+        Readers fall back to the storage until the state is published again. Safe without the storage transaction.
+        :return:
+        """
+        if self._attach():
+            self._values[_VALID] = 0
+
+    def _grow(self, slots: int) -> None:
+        """
+        Makes a new generation able to hold slots, with the state of the current one
+        :param slots:
+        :return:
+        """
+        previous = self._values if self._generation >= 0 else None
+        generation = max(self._generation, self._current_generation()) + 1
+        capacity = max(64, 2 * slots)
+        name = f"{self._name}_{generation}"
+        # a segment of that name would be left by a writer that failed before naming it
+        _unlink(name)
+        segment = shared_memory.SharedMemory(name, create=True, size=8 * (_HEADER + 2 * capacity))
+        values = np.ndarray((segment.size // 8,), dtype=np.int64, buffer=segment.buf)
+        values[:_HEADER] = 0
+        values[_CAPACITY] = capacity
+        if previous is not None and previous[_VALID] == 1:
+            values[_ROWS], values[_TICKETS], values[_SLOTS] = previous[_ROWS], previous[_TICKETS], previous[_SLOTS]
+            old_capacity, old_slots = int(previous[_CAPACITY]), max(int(previous[_SLOTS]), 0)
+            values[_HEADER:_HEADER + old_slots] = previous[_HEADER:_HEADER + old_slots]
+            values[_HEADER + capacity:_HEADER + capacity + old_slots] = \
+                previous[_HEADER + old_capacity:_HEADER + old_capacity + old_slots]
+            values[_VALID] = 1
+        if self._pointer is None:
+            self._pointer = shared_memory.SharedMemory(self._name, create=True, size=8)
+        old_name = f"{self._name}_{self._generation}" if previous is not None else None
+        if previous is not None:
+            # readers of the old generation find it invalid, and move to the new one
+            previous[_VALID] = 0
+            del previous
+        np.ndarray((1,), dtype=np.int64, buffer=self._pointer.buf)[0] = generation
+        self._detach()
+        self._segment, self._values, self._generation = segment, values, generation
+        if old_name is not None:
+            # workers that mapped it keep their mapping until they move on
+            _unlink(old_name)
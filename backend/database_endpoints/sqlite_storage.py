@@ -0,0 +1,245 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Tuple, Union
+
+import pandas as pd
+
+from backend.database_endpoints.data_version import DataVersion
+from backend.database_endpoints.expended_query import ExpendedQuery, UNBOUNDED
+from backend.database_endpoints.group_commit import GroupCommit, organization_durability
+from backend.database_endpoints.shared_state import SharedEntityState
+from backend.database_endpoints.storage import EntityStorage
+from backend.utils.utils import validate_iso8601, iso8601_to_microseconds
+from utils.constants import TEMPORARY_DATA_ROOT, SQLITE_BUSY_TIMEOUT
+
+DATABASE_FILE_NAME = "resources.sqlite3"
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _value(value: Any) -> Any:
+    """
+    A request value as SQLite stores it. Nested values are stored as JSON.
+    :param value:
+    :return:
+    """
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    return json.dumps(value, default=str)
+
+
+def _microseconds(time: Any) -> Union[int, None]:
+    """
+    SQL function microseconds(time), NULL unless time is ISO 8601
+    """
+    if isinstance(time, str) and validate_iso8601(time):
+        return iso8601_to_microseconds(time)
+    return None
+
+
+def _local_time_bound(microseconds: int, days: int) -> Union[str, None]:
+    """
+    :return: YYYY-MM-DDTHH:MM:SS of a UTC time moved by days, which ISO 8601 times of any offset compare to as text.
+        None if out of the years 1 to 9999.
+    """
+    try:
+        return (datetime(1970, 1, 1) + timedelta(microseconds=microseconds, days=days)).strftime("%Y-%m-%dT%H:%M:%S")
+    except OverflowError:
+        return None
+
+
+class SqliteStorage(EntityStorage):
+    """
+    One SQLite database per organization, organization_{org}/resources.sqlite3, with tables per entity: {entity}_info,
+    {entity}_expended, and {entity}_counter for a running total of the expended rows.
+    The expended table is indexed on its time slot and collected columns.
+    The database runs in WAL mode, so readers do not block the writer, and each worker holds its own connection.
+    """
+    # (process id, thread id, database path) -> connection. Connections are not shared with forked workers.
+    _connections: Dict[Tuple[int, int, str], sqlite3.Connection] = {}
+
+    def __init__(self, org_name: str, entity_name: str):
+        super().__init__(org_name, entity_name)
+        self.database_path = SqliteStorage.database_path(org_name)
+        self.information_table = _quote(f"{entity_name}_info")
+        self.expended_table = _quote(f"{entity_name}_expended")
+        self.counter_table = _quote(f"{entity_name}_counter")
+        # commits do not fsync the WAL themselves, it is flushed as the durability mode of the organization requires
+        self._group_commit = GroupCommit(f"{self.database_path}-wal", organization_durability(org_name))
+
+    @staticmethod
+    def database_path(org_name: str) -> str:
+        return f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{DATABASE_FILE_NAME}"
+
+    @staticmethod
+    def checkpoint(database_path: str) -> bool:
+        """
+        Copies the WAL into the database, and truncates it
+        :param database_path:
+        :return: Whether the WAL was fully checkpointed, it is not while a reader is using it
+        """
+        connection = sqlite3.connect(database_path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+        try:
+            busy, _, _ = connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            return busy == 0
+        finally:
+            connection.close()
+
+    def _connection(self) -> sqlite3.Connection:
+        key = (os.getpid(), threading.get_ident(), self.database_path)
+        connection = SqliteStorage._connections.get(key)
+        if connection is None:
+            # transactions are managed explicitly, see transaction
+            connection = sqlite3.connect(self.database_path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.create_function("microseconds", 1, _microseconds, deterministic=True)
+            SqliteStorage._connections[key] = connection
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self._connection()
+        if connection.in_transaction:
+            # nested in a transaction of this worker
+            yield
+            return
+        # take the write lock up front, so that what is read inside is still true when the rows are written
+        connection.execute("BEGIN IMMEDIATE")
+        changes = connection.total_changes
+        try:
+            yield
+            connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            shared = SharedEntityState.of(self.org_name, self.entity_name)
+            if shared is not None and connection.total_changes != changes:
+                # the shared state may hold rows that were rolled back
+                shared.invalidate()
+            raise
+        if connection.total_changes != changes:
+            self._group_commit.commit()
+            DataVersion(self.org_name, self.entity_name).bump()
+
+    def create(self, information: pd.DataFrame, columns: List[str], indexes: List[Tuple[str, ...]]) -> None:
+        connection = self._connection()
+        with self.transaction():
+            connection.execute(f"CREATE TABLE {self.information_table} "
+                               f"({', '.join(_quote(column) for column in information.columns)})")
+            connection.executemany(
+                f"INSERT INTO {self.information_table} VALUES ({', '.join('?' * len(information.columns))})",
+                [[_value(value.item() if hasattr(value, "item") else value) for value in row]
+                 for row in information.itertuples(index=False)]
+            )
+            connection.execute(f"CREATE TABLE {self.expended_table} ({', '.join(_quote(column) for column in columns)})")
+            for index in indexes:
+                index_name = _quote(f"{self.entity_name}_expended_{'_'.join(index)}")
+                connection.execute(f"CREATE INDEX {index_name} ON {self.expended_table} "
+                                   f"({', '.join(_quote(column) for column in index)})")
+
+    def information(self) -> pd.DataFrame:
+        return pd.read_sql_query(f"SELECT * FROM {self.information_table}", self._connection())
+
+    def expended(self, columns: List[str] = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        connection = self._connection()
+        start = max(start, 0)
+        selected = "*"
+        if columns is not None:
+            existing = self._columns()
+            selected = ", ".join(_quote(column) for column in columns if column in existing) or "NULL"
+        # rows are never deleted, so the rowid of a row is its position + 1
+        query, parameters = f"SELECT {selected} FROM {self.expended_table} WHERE rowid > ?", [start]
+        if stop is not None:
+            query, parameters = f"{query} AND rowid <= ?", parameters + [stop]
+        frame = pd.read_sql_query(f"{query} ORDER BY rowid", connection, params=parameters)
+        frame.index = pd.RangeIndex(start, start + len(frame))
+        return frame if columns is None else frame.reindex(columns=columns)
+
+    def _columns(self) -> List[str]:
+        cursor = self._connection().execute(f"SELECT * FROM {self.expended_table} LIMIT 0")
+        return [description[0] for description in cursor.description]
+
+    def query(self, query: ExpendedQuery) -> Tuple[pd.DataFrame, Union[int, None]]:
+        """
+        Filters and pages in SQL, so collected columns are looked up in their indexes, and time ranges on the
+        (start, end) index. Times are stored as text with their offset, so the index only narrows the rows down to
+        those within a day of the range, and their times are then compared exactly.
+        """
+        existing = self._columns()
+        columns = existing if query.columns is None else query.columns
+        conditions, parameters = ["rowid > ?"], [query.after]
+        for column, values in query.equals.items():
+            if column not in existing:
+                return query.page(pd.DataFrame(columns=columns))
+            conditions.append(f"{_quote(column)} IN ({', '.join('?' * len(values))})")
+            parameters.extend(_value(value) for value in values)
+        if query.overlapping is not None:
+            low, high = query.overlapping
+            start, end = (_quote(column) for column in query.slot_columns)
+            # an offset moves a local time by less than a day
+            start_bound = _local_time_bound(high, 1) if high != UNBOUNDED[1] else None
+            if start_bound is not None:
+                conditions.append(f"{start} <= ?")
+                parameters.append(start_bound)
+            end_bound = _local_time_bound(low, -1) if low != UNBOUNDED[0] else None
+            if end_bound is not None:
+                # years past 9999 do not compare as text
+                conditions.append(f"({end} >= ? OR {end} NOT GLOB '[0-9][0-9][0-9][0-9]-*')")
+                parameters.append(end_bound)
+            conditions.append(f"microseconds({start}) <= ? AND microseconds({end}) >= ?")
+            parameters.extend([high, low])
+        selected = ", ".join(_quote(column) for column in columns if column in existing)
+        sql = (f"SELECT rowid AS __position{', ' + selected if selected else ''} FROM {self.expended_table} "
+               f"WHERE {' AND '.join(conditions)} ORDER BY rowid")
+        if query.limit is not None:
+            sql, parameters = f"{sql} LIMIT ?", parameters + [query.limit + 1]
+        frame = pd.read_sql_query(sql, self._connection(), params=parameters)
+        # rowid is the position + 1
+        frame.index = pd.Index(frame.pop("__position") - 1)
+        return query.page(frame.reindex(columns=columns))
+
+    def count(self) -> int:
+        # rows are never deleted, so the last rowid is the count, without scanning the table
+        return self._connection().execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {self.expended_table}").fetchone()[0]
+
+    def expended_since(self, position: int) -> Tuple[List[Dict[str, Any]], int]:
+        cursor = self._connection().execute(f"SELECT * FROM {self.expended_table} WHERE rowid > ? ORDER BY rowid", (position,))
+        columns = [description[0] for description in cursor.description]
+        rows = [dict(zip(columns, values)) for values in cursor.fetchall()]
+        return rows, position + len(rows)
+
+    def append(self, rows: List[Dict[str, Any]]) -> None:
+        if len(rows) == 0:
+            return
+        connection = self._connection()
+        with self.transaction():
+            for row in rows:
+                connection.execute(
+                    f"INSERT INTO {self.expended_table} ({', '.join(_quote(column) for column in row)}) "
+                    f"VALUES ({', '.join('?' * len(row))})",
+                    [_value(value) for value in row.values()]
+                )
+
+    def read_counter(self) -> Tuple[int, int, bool]:
+        try:
+            counter = self._connection().execute(f"SELECT total, position FROM {self.counter_table}").fetchone()
+        except sqlite3.OperationalError:
+            # created before counters were kept
+            counter = None
+        if counter is None:
+            return 0, 0, True
+        return counter[0], counter[1], self.count() != counter[1]
+
+    def write_counter(self, total: int, position: int) -> None:
+        connection = self._connection()
+        with self.transaction():
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.counter_table} (total INTEGER, position INTEGER)")
+            connection.execute(f"DELETE FROM {self.counter_table}")
+            connection.execute(f"INSERT INTO {self.counter_table} VALUES (?, ?)", (total, position))
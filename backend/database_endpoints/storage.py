@@ -0,0 +1,256 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List, Any, Tuple, ContextManager, Union
+
+import pandas as pd
+
+from backend.database_endpoints.data_version import DataVersion
+from backend.database_endpoints.expended_query import ExpendedQuery, QUERY_SCAN_ROWS
+from backend.database_endpoints.interval_index import EntitySlots
+from backend.database_endpoints.log_storage import EntityLog
+from backend.database_endpoints.shared_state import SharedEntityState
+from backend.utils.utils import iso8601_to_microseconds
+from utils.constants import TEMPORARY_DATA_ROOT, STORAGE_BACKEND
+
+
+class EntityStorage(ABC):
+    """
+    Where the resource tables of a Ticketed or Slotted entity live: its info sheet (available, strict, collected headers...),
+    and the expended rows handed out so far.
+    """
+
+    def __init__(self, org_name: str, entity_name: str):
+        self.org_name = org_name
+        self.entity_name = entity_name
+
+    @abstractmethod
+    def create(self, information: pd.DataFrame, columns: List[str], indexes: List[Tuple[str, ...]]) -> None:
+        """
+        Creates the tables of a new entity
+        :param information: The info sheet, one row
+        :param columns: Columns of the expended table
+        :param indexes: Column groups of the expended table that are queried, for backends that index them
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def information(self) -> pd.DataFrame:
+        pass
+
+    @abstractmethod
+    def expended(self, columns: List[str] = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        """
+        :param columns: Columns to read, every column if None
+        :param start:
+        :param stop:
+        :return: Expended rows [start, stop) in the order they were appended, indexed by their position
+        """
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        """
+        :return: Number of expended rows
+        """
+        pass
+
+    @abstractmethod
+    def append(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Adds expended rows, all or none of them
+        :param rows:
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def transaction(self) -> ContextManager:
+        """
+        Reads and appends inside the returned context are isolated from other workers, and committed together
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def read_counter(self) -> Tuple[int, int, bool]:
+        """
+        A running total over the expended rows, stored with them, ex. tickets taken
+        :return: (total, position, whether rows may have been appended after position). (0, 0, True) if there is none.
+        """
+        pass
+
+    @abstractmethod
+    def write_counter(self, total: int, position: int) -> None:
+        """
+        :param total: Total of the first position expended rows
+        :param position:
+        :return:
+        """
+        pass
+
+    def replay(self) -> None:
+        """
+        Recovers the storage after a crash, and loads what this process keeps in memory
+        :return:
+        """
+        self.count()
+        # a crash may have lost the version of the last writes
+        DataVersion(self.org_name, self.entity_name).bump()
+
+    def expended_since(self, position: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        :param position: Number of expended rows already seen
+        :return: The expended rows after position, and the new position
+        """
+        expended = self.expended()
+        return expended.iloc[position:].to_dict("records"), len(expended)
+
+    def query(self, query: ExpendedQuery) -> Tuple[pd.DataFrame, Union[int, None]]:
+        """
+        Reads the expended rows a GET asked for, scanning from query.after in blocks of QUERY_SCAN_ROWS
+        until the page is full. Backends override it to filter with what they index.
+        :param query: Checked against the schema of the entity, see ExpendedQuery.for_schema
+        :return: The rows of the page indexed by their position, and the position the next page starts from,
+            None if there are no more rows
+        """
+        needed = None if query.limit is None else query.limit + 1
+        if not query.filtered:
+            return query.page(self.expended(query.columns, query.after, None if needed is None else query.after + needed))
+        read = None if query.columns is None else list(dict.fromkeys(query.filter_columns + query.columns))
+        parts, matched, position, count = [], 0, query.after, self.count()
+        while position < count and (needed is None or matched < needed):
+            chunk = self.expended(read, position, position + QUERY_SCAN_ROWS)
+            if len(chunk) == 0:
+                break
+            part = chunk[query.matches(chunk)]
+            parts.append(part if needed is None else part.iloc[:needed - matched])
+            matched += len(parts[-1])
+            position += len(chunk)
+        if len(parts) == 0:
+            return query.page(self.expended(read, position, position))
+        return query.page(parts[0] if len(parts) == 1 else pd.concat(parts))
+
+    def count_overlapping(self, start_column: str, end_column: str, start: str, end: str) -> int:
+        """
+        Number of expended slots that overlap [start, end], ends included
+        :param start_column:
+        :param end_column:
+        :param start: ISO 8601 time
+        :param end: ISO 8601 time
+        :return:
+        """
+        start, end = iso8601_to_microseconds(start), iso8601_to_microseconds(end)
+        shared = SharedEntityState.of(self.org_name, self.entity_name)
+        count = shared.count_overlapping(start, end) if shared is not None else None
+        if count is not None:
+            return count
+        return EntitySlots.of(self, start_column, end_column).index.count_overlapping(start, end)
+
+    def data_version(self) -> int:
+        """
+        Version of the expended rows, which every committed write changes, see DataVersion.
+        Entities without a stored version fall back to the number of rows, as rows are only ever appended,
+        read from the shared state of the entity when there is one.
+        :return:
+        """
+        version = DataVersion(self.org_name, self.entity_name).read()
+        if version is not None:
+            return version
+        shared = SharedEntityState.of(self.org_name, self.entity_name)
+        rows = shared.rows() if shared is not None else None
+        return rows if rows is not None else self.count()
+
+    @staticmethod
+    def for_entity(org_name: str, entity_name: str) -> "EntityStorage":
+        """
+        The storage of an existing entity, in whichever backend its organization was created with
+        :param org_name:
+        :param entity_name:
+        :return:
+        """
+        from backend.database_endpoints.sqlite_storage import SqliteStorage
+
+        if os.path.exists(SqliteStorage.database_path(org_name)):
+            return SqliteStorage(org_name, entity_name)
+        return CsvStorage(org_name, entity_name)
+
+    @staticmethod
+    def for_new_entity(org_name: str, entity_name: str, backend: str = STORAGE_BACKEND) -> "EntityStorage":
+        """
+        The storage of an entity being created, in the configured backend
+        :param org_name:
+        :param entity_name:
+        :param backend: csv or sqlite
+        :return:
+        """
+        from backend.database_endpoints.sqlite_storage import SqliteStorage
+
+        backends = {"csv": CsvStorage, "sqlite": SqliteStorage}
+        if backend not in backends:
+            raise ValueError(f"Unknown storage backend {backend}, expected one of {list(backends)}.")
+        return backends[backend](org_name, entity_name)
+
+
+class CsvStorage(EntityStorage):
+    """
+    CSV files in the organization folder: {entity}_resources_info.csv, and the expended rows as an EntityLog
+    """
+    # info sheet path -> (modification time and size, frame). Info sheets are not modified by registrations.
+    _information: Dict[str, Tuple[Tuple[int, int], pd.DataFrame]] = {}
+
+    def __init__(self, org_name: str, entity_name: str):
+        super().__init__(org_name, entity_name)
+        self.information_path = f"{TEMPORARY_DATA_ROOT}/organization_{org_name}/{entity_name}_resources_info.csv"
+        self.log = EntityLog(org_name, entity_name)
+
+    def create(self, information: pd.DataFrame, columns: List[str], indexes: List[Tuple[str, ...]]) -> None:
+        information.to_csv(self.information_path, index=False)
+        pd.DataFrame({column: [] for column in columns}).to_csv(self.log.snapshot_path, index=False)
+
+    def information(self) -> pd.DataFrame:
+        """
+        The info sheet, read again only when it changes
+        :return:
+        """
+        stat = os.stat(self.information_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = CsvStorage._information.get(self.information_path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, pd.read_csv(self.information_path))
+            CsvStorage._information[self.information_path] = cached
+        return cached[1]
+
+    def expended(self, columns: List[str] = None, start: int = 0, stop: int = None) -> pd.DataFrame:
+        if columns is None and start == 0 and stop is None:
+            return self.log.view()
+        return self.log.select(columns, start, stop)
+
+    def count(self) -> int:
+        return self.log.count()
+
+    def expended_since(self, position: int) -> Tuple[List[Dict[str, Any]], int]:
+        return self.log.rows_since(position)
+
+    def query(self, query: ExpendedQuery) -> Tuple[pd.DataFrame, Union[int, None]]:
+        return self.log.query(query)
+
+    def replay(self) -> None:
+        # finishes an interrupted compaction and drops a torn last line, stores the snapshot as columns,
+        # and maps it into the materialized view
+        self.log.repair()
+        self.log.write_columns()
+        self.log.count()
+        DataVersion(self.org_name, self.entity_name).bump()
+
+    def append(self, rows: List[Dict[str, Any]]) -> None:
+        self.log.append(rows)
+
+    def read_counter(self) -> Tuple[int, int, bool]:
+        return self.log.read_counter()
+
+    def write_counter(self, total: int, position: int) -> None:
+        self.log.write_counter(total, position)
+
+    def transaction(self) -> ContextManager:
+        return self.log.transaction()
@@ -1,10 +1,12 @@
 from abc import abstractmethod
 from typing import Union, Dict, List, Tuple, Any
 
+from backend.database_endpoints.request_schema import RequestSchema
 from backend.database_endpoints.data_management import TicketDataManagement, TimeslotDataManagement, DataQueryManagement
 from backend.requests.requests import Request, BottomOfRequestError
+from backend.policies.cache import ResidualPolicies
 from backend.policies.policy import Policy
-from utils.errors import RoutingError, RejectedRequestError, InvalidRequestError
+from utils.errors import RoutingError, RejectedRequestError, InvalidRequestError, EvaluationBudgetExceededError
 
 
 class Entity:
@@ -49,9 +51,20 @@ class Entity:
         :param request:
         :return:
         """
+        return self.route(request).handle_bottom_of_tree(request)
+
+    def route(self, request: Request) -> "Entity":
+        """
+        Validates the request at this node and every node on its path below
+        :param request:
+        :return: The entity at the bottom of the request path
+        """
         assert self._children is not None, "Entity not fully initialized, set children"
-        # Validate
-        validated, reason = self.validate_request(request)
+        # Validate. A policy which ran out of time is undecided, so the request is rejected without remembering it
+        try:
+            validated, reason = self.validate_request(request)
+        except EvaluationBudgetExceededError as e:
+            raise RejectedRequestError(f"{e}")
         if not validated:
             raise RejectedRequestError(f"{reason}")
         # Next route
@@ -59,16 +72,74 @@ class Entity:
             next_route_name = request.extract_next_route()
         except BottomOfRequestError:
             # Tree leaf
-            return self.handle_bottom_of_tree(request)
+            return self
 
         # Pass request forward
         if next_route_name not in self._children:
             raise RoutingError(f"No route named {next_route_name} in the children of {self._name}")
 
-        return self._children[next_route_name](request)
+        return self._children[next_route_name].route(request)
+
+    def route_batch(self, requests: List[Request]) -> List[Union["Entity", Exception]]:
+        """
+        Routes requests as route does, evaluating the policy of each node once for all the requests reaching it,
+        see BatchPolicyEvaluator
+        :param requests: Requests whose route continues at this node
+        :return: The entity at the bottom of the path of each request, or why it was not routed
+        """
+        from backend.policies.batch import BatchPolicyEvaluator
+
+        assert self._children is not None, "Entity not fully initialized, set children"
+        routed: List[Union[Entity, Exception, None]] = [None] * len(requests)
+        # requests sharing a residual policy are evaluated together
+        residuals: Dict[int, Tuple[Policy, List[int]]] = {}
+        for index, request in enumerate(requests):
+            residual = self.residual_policy(request)
+            residuals.setdefault(id(residual), (residual, []))[1].append(index)
+        children: Dict[str, List[int]] = {}
+        for residual, indices in residuals.values():
+            validated, reasons = BatchPolicyEvaluator(residual).evaluate([requests[index] for index in indices])
+            for position, index in enumerate(indices):
+                if not validated[position]:
+                    routed[index] = RejectedRequestError(f"{reasons[position]}")
+                    continue
+                try:
+                    next_route_name = requests[index].extract_next_route()
+                except BottomOfRequestError:
+                    routed[index] = self
+                    continue
+                if next_route_name not in self._children:
+                    routed[index] = RoutingError(f"No route named {next_route_name} in the children of {self._name}")
+                    continue
+                children.setdefault(next_route_name, []).append(index)
+        for name, indices in children.items():
+            for index, entity in zip(indices, self._children[name].route_batch([requests[index] for index in indices])):
+                routed[index] = entity
+        return routed
 
     @abstractmethod
-    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict]: ...
+    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict, Union[str, None]]:
+        """
+        :param filters: ExpendedQuery of the expended rows to read, all of them if None
+        :return: (info, expended, cursor of the next page)
+        """
+        ...
+
+    @abstractmethod
+    def aggregate_data(self, filters: Any, aggregation: Any) -> Dict:
+        """
+        :param filters: ExpendedQuery of the expended rows aggregated
+        :param aggregation: ExpendedAggregation to compute
+        :return: Name of the aggregate -> its value
+        """
+        ...
+
+    @abstractmethod
+    def data_version(self) -> Union[int, None]:
+        """
+        :return: Version of the data of this entity, increased by every registration. None if it has no data.
+        """
+        ...
 
     @abstractmethod
     def handle_bottom_of_tree(self, request: Request) -> Dict:
@@ -78,6 +149,21 @@ class Entity:
     def validate_request(self, request: Request) -> Union[bool, str]:
         raise NotImplementedError("Create entity subclass")
 
+    @abstractmethod
+    def data_management(self):
+        """
+        :return: A data manager for the tables of this entity
+        """
+        raise NotImplementedError("Create entity subclass")
+
+    def residual_policy(self, request: Request) -> Policy:
+        """
+        The policy of this entity partially evaluated on the route of the request
+        :param request:
+        :return:
+        """
+        return ResidualPolicies.of(self._policy).for_request(request)
+
     @property
     def name(self):
         return self._name
@@ -95,27 +181,53 @@ class RoutingEntity(Entity):
     def __init__(self, name, policy, children, org_name):
         super().__init__(name, policy, children, org_name)
 
-    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict]:
+    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict, Union[str, None]]:
         raise InvalidRequestError("Cannot query data from a routing entity :`(")
 
+    def aggregate_data(self, filters: Any, aggregation: Any) -> Dict:
+        raise InvalidRequestError("Cannot aggregate data from a routing entity.")
+
+    def data_version(self) -> Union[int, None]:
+        return None
+
     def handle_bottom_of_tree(self, request: Request) -> Dict:
         raise RoutingError(f"{self.name} is a routing entity, and should not be a leaf")
 
+    def data_management(self):
+        raise RoutingError(f"{self.name} is a routing entity, and has no data")
+
     def validate_request(self, request: Request) -> Tuple[bool, str]:
-        return self.policy.validate(request)
+        return self.residual_policy(request).validate(request)
 
 
 class SlottedEntity(Entity):
     def __init__(self, name, policy, children, org_name):
         super().__init__(name, policy, children, org_name)
 
-    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict]:
-        return DataQueryManagement.read_data_from_entity_and_organization_name(self.org_name, self.name)
+    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict, Union[str, None]]:
+        return DataQueryManagement.read_data_from_entity_and_organization_name(self.org_name, self.name, filters)
+
+    def aggregate_data(self, filters: Any, aggregation: Any) -> Dict:
+        return DataQueryManagement.aggregate_entity_and_organization_name(self.org_name, self.name, filters, aggregation)
+
+    def data_version(self) -> Union[int, None]:
+        return DataQueryManagement.data_version_of_entity_and_organization_name(self.org_name, self.name)
+
+    @property
+    def schema(self) -> RequestSchema:
+        """
+        What this entity stores for each request
+        :return:
+        """
+        return RequestSchema.for_entity(self.org_name, self.name)
+
+    def data_management(self) -> TimeslotDataManagement:
+        return TimeslotDataManagement(self.org_name, self.name)
 
     @staticmethod
     def _manage_slot_request(request: Request) -> Dict:
         database_manager = TimeslotDataManagement(request.root_name, request.current_name)
-        database_manager.register(request.raw_request)
+        database_manager.register(request.raw_request, key_index=request.key_index)
 
         return {
             "result": "ok"
@@ -126,20 +238,37 @@ class SlottedEntity(Entity):
         return result
 
     def validate_request(self, request: Request) -> Tuple[bool, str]:
-        return self.policy.validate(request)
+        return self.residual_policy(request).validate(request)
 
 
 class TicketedEntity(Entity):
     def __init__(self, name, policy, children, org_name):
         super().__init__(name, policy, children, org_name)
 
-    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict]:
-        return DataQueryManagement.read_data_from_entity_and_organization_name(self.org_name, self.name)
+    def query_data(self, filters: Any = None) -> Tuple[Dict, Dict, Union[str, None]]:
+        return DataQueryManagement.read_data_from_entity_and_organization_name(self.org_name, self.name, filters)
+
+    def aggregate_data(self, filters: Any, aggregation: Any) -> Dict:
+        return DataQueryManagement.aggregate_entity_and_organization_name(self.org_name, self.name, filters, aggregation)
+
+    def data_version(self) -> Union[int, None]:
+        return DataQueryManagement.data_version_of_entity_and_organization_name(self.org_name, self.name)
+
+    @property
+    def schema(self) -> RequestSchema:
+        """
+        What this entity stores for each request
+        :return:
+        """
+        return RequestSchema.for_entity(self.org_name, self.name)
+
+    def data_management(self) -> TicketDataManagement:
+        return TicketDataManagement(self.org_name, self.name)
 
     @staticmethod
     def _manage_ticket_request(request: Request) -> Dict:
         database_manager = TicketDataManagement(request.root_name, request.current_name)
-        database_manager.register(data=request.raw_request)
+        database_manager.register(data=request.raw_request, key_index=request.key_index)
 
         return {
             "result": "ok"
@@ -150,7 +279,7 @@ class TicketedEntity(Entity):
         return result
 
     def validate_request(self, request: Request) -> Tuple[bool, str]:
-        return self.policy.validate(request)
+        return self.residual_policy(request).validate(request)
 
 
 def get_entity_class_from_type_string(type_string: str) -> Entity:
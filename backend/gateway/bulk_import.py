@@ -0,0 +1,214 @@
+import json
+import os
+import socket
+from typing import Dict, Iterator, Union, Tuple, Any, List
+
+from backend.entity.entities import Entity
+from backend.requests.requests import Request
+from backend.routing.generate_entities import GenerateEntities
+from utils.constants import TEMPORARY_DATA_ROOT, BULK_GROUP_SIZE, BULK_MAX_RECORD_BYTES
+from utils.errors import ValidationError, RoutingError
+
+READ_SIZE = 65536
+
+
+class BulkImport:
+    """
+    Registers a stream of newline delimited JSON allocation requests for one organization.
+
+    The body may use chunked transfer encoding or a Content-Length. It is parsed incrementally, so memory is bounded
+    by the largest record rather than the stream. Records are taken in groups of group_size, routed together through
+    the organization's entity tree, built once with its cached policies, and their registrations are written together.
+    The response is a chunked stream of NDJSON lines: an error line per failed record, a progress line per group
+    commit, and a final summary.
+    """
+
+    def __init__(self, connection: socket.socket, received: bytearray, org_name: str, headers: Dict[str, str],
+                 body_start: int, group_size: int = BULK_GROUP_SIZE, max_record_bytes: int = BULK_MAX_RECORD_BYTES):
+        self._socket = connection
+        self._org_name = org_name
+        self._headers = headers
+        self._pending = bytearray(received[body_start:])
+        self._group_size = max(group_size, 1)
+        self._max_record_bytes = max_record_bytes
+        # (record number, registration, request) of the parsed records of the current group
+        self._group: List[Tuple[int, Dict, Request]] = []
+        # entity name -> (data manager holding registrations not yet written, record number of each registration)
+        self._managers: Dict[str, Tuple[Any, List[int]]] = {}
+        self._processed, self._committed, self._failed = 0, 0, 0
+
+    def _receive(self) -> bytes:
+        return self._socket.recv(READ_SIZE)
+
+    def _body(self) -> Iterator[bytes]:
+        """
+        Decoded body, piece by piece
+        :return:
+        """
+        if self._headers.get("transfer-encoding", "").lower() == "chunked":
+            yield from self._chunked_body()
+            return
+        remaining = int(self._headers["content-length"]) if "content-length" in self._headers else None
+        while remaining is None or remaining > 0:
+            piece = bytes(self._pending) if len(self._pending) > 0 else self._receive()
+            self._pending.clear()
+            if not piece:
+                return
+            if remaining is not None:
+                piece = piece[:remaining]
+                remaining -= len(piece)
+            yield piece
+
+    def _fill(self, size: int) -> None:
+        while len(self._pending) < size:
+            received = self._receive()
+            if not received:
+                raise ValidationError("Stream ended inside a chunk.")
+            self._pending += received
+
+    def _chunked_body(self) -> Iterator[bytes]:
+        while True:
+            line_end = self._pending.find(b"\r\n")
+            while line_end == -1:
+                if len(self._pending) > 1024:
+                    raise ValidationError("Malformed chunk size.")
+                self._fill(len(self._pending) + 1)
+                line_end = self._pending.find(b"\r\n")
+            try:
+                size = int(bytes(self._pending[:line_end]).split(b";")[0], 16)
+            except ValueError:
+                raise ValidationError("Malformed chunk size.")
+            del self._pending[:line_end + 2]
+            if size == 0:
+                return
+            self._fill(size + 2)
+            yield bytes(self._pending[:size])
+            del self._pending[:size + 2]
+
+    def _records(self) -> Iterator[Union[bytes, None]]:
+        """
+        Lines of the body. None stands for a record above the size limit, which is skipped.
+        :return:
+        """
+        line, discarding = bytearray(), False
+        for piece in self._body():
+            start = 0
+            while True:
+                newline = piece.find(b"\n", start)
+                end = len(piece) if newline == -1 else newline
+                if not discarding:
+                    line += piece[start:end]
+                    if len(line) > self._max_record_bytes:
+                        line.clear()
+                        discarding = True
+                if newline == -1:
+                    break
+                if discarding:
+                    yield None
+                elif line.strip():
+                    yield bytes(line)
+                line.clear()
+                discarding, start = False, newline + 1
+        if discarding:
+            yield None
+        elif line.strip():
+            yield bytes(line)
+
+    def _send(self, message: Dict) -> None:
+        data = (json.dumps(message) + "\n").encode()
+        self._socket.sendall(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    def _parse(self, record: Union[bytes, None]) -> Tuple[Dict, Request]:
+        """
+        :param record: A line of the body
+        :return: The registration and its request, routed up to the organization
+        """
+        if record is None:
+            raise ValidationError(f"Record is larger than {self._max_record_bytes} bytes.")
+        try:
+            data = json.loads(record)
+        except ValueError:
+            raise ValidationError("Record is not valid JSON.")
+        if not isinstance(data, dict):
+            raise ValidationError("Record must be a JSON object.")
+        request = Request.from_dict(data)
+        request.validate()
+        if request.extract_next_route() != self._org_name:
+            raise RoutingError(f"Record is not for organization {self._org_name}.")
+        return data, request
+
+    def _register_group(self, root: Entity) -> None:
+        """
+        Routes the records of the current group together, so that the policy of each entity is evaluated once for
+        all the records reaching it, then registers them in order.
+        :param root:
+        :return:
+        """
+        routed = root.route_batch([request for _, _, request in self._group])
+        for (record, data, request), entity in zip(self._group, routed):
+            try:
+                if isinstance(entity, Exception):
+                    raise entity
+                if entity.name not in self._managers:
+                    self._managers[entity.name] = entity.data_management(), []
+                manager, records = self._managers[entity.name]
+                manager.register(data, key_index=request.key_index, commit=False)
+                records.append(record)
+            except Exception as e:
+                self._failed += 1
+                self._send({"record": record, "error": str(e)})
+        self._group = []
+
+    def _commit(self) -> None:
+        """
+        Writes the registrations of the current group, one transaction per entity, and reports progress.
+        Registrations another worker conflicted with since they were checked, and those of an entity whose write failed,
+        are reported as failed records, and the import goes on.
+        :return:
+        """
+        for manager, records in self._managers.values():
+            try:
+                rejected = manager.write_updates()
+            except Exception as e:
+                rejected = {position: e for position in range(len(records))}
+            for position, error in sorted(rejected.items()):
+                self._send({"record": records[position], "error": str(error)})
+            self._failed += len(rejected)
+            self._committed += len(records) - len(rejected)
+        self._managers = {}
+        self._send({"progress": self._summary()})
+
+    def _summary(self) -> Dict[str, int]:
+        return {"processed": self._processed, "committed": self._committed, "failed": self._failed}
+
+    def run(self) -> Tuple[int, int, int]:
+        """
+        Imports the stream, writing the response as it goes
+        :return: Records processed, committed and failed
+        """
+        self._socket.sendall(b"HTTP/1.1 200 OK\r\nServer: Epic Resource Scheduler\r\nConnection: close\r\n"
+                             b"Content-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n")
+        try:
+            if not os.path.exists(f"{TEMPORARY_DATA_ROOT}/organization_{self._org_name}/entity_definition.json"):
+                raise RoutingError(f"Root {self._org_name} does not exist")
+            root = GenerateEntities.generate_entity_from_json_path(
+                f"{TEMPORARY_DATA_ROOT}/organization_{self._org_name}/entity_definition.json")
+            for record in self._records():
+                self._processed += 1
+                try:
+                    self._group.append((self._processed, *self._parse(record)))
+                except Exception as e:
+                    self._failed += 1
+                    self._send({"record": self._processed, "error": str(e)})
+                if len(self._group) >= self._group_size:
+                    self._register_group(root)
+                    self._commit()
+            if len(self._group) > 0:
+                self._register_group(root)
+                self._commit()
+            self._send({"summary": self._summary()})
+        except Exception as e:
+            # registrations of the current group are not written
+            self._send({"summary": self._summary(), "error": str(e)})
+        self._socket.sendall(b"0\r\n\r\n")
+        return self._processed, self._committed, self._failed
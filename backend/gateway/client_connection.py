@@ -1,11 +1,13 @@
-import json
 import socket
-from typing import Dict
+from typing import Union
 
 from backend.database_endpoints.data_management import DataQueryManagement
+from backend.database_endpoints.query_cache import QueryCache
 from backend.database_endpoints.entity_creation import EntityEntryDataManagement
-from backend.gateway.response_formats import Response
-from backend.requests.requests import Request
+from backend.gateway.bulk_import import BulkImport
+from backend.gateway.response_formats import Response, StreamedResponse
+from backend.policies.cache import CachedPolicy
+from backend.requests.requests import Request, HEADER_TERMINATOR, MAX_HEADER_LENGTH
 from backend.routing.root_authority import RootAuthority
 from utils.constants import *
 from utils.errors import ValidationError, RejectedRequestError, RoutingError, DatabaseWriteError, InvalidRequestError
@@ -91,31 +93,94 @@ class ClientConnection:
                 error=str(e)
             )
 
-    def _get(self, request: Request) -> Response:
+    def _get(self, request: Request) -> Union[Response, None]:
         """
-        Method for getting data related to an entity.
+        Method for getting data related to an entity. The data of each entity is streamed as soon as it is read,
+        unless the client already has it, as told by If-None-Match.
         :param request:
-        :return:
+        :return: The response if the query failed or the data did not change, None once the data was streamed
         """
         try:
             request.validate()
-            result = DataQueryManagement(request).query()
-            # success !!
-            return Response(status_code=SUCCESS, data=json.dumps(result, indent=4))
+            query = DataQueryManagement(request)
+            results = query.stream()
         except Exception as e:
             return Response(
                 status_code=POOR_FORMAT,
                 error=str(e)
             )
+        if QueryCache.matches(request.http_headers.get("if-none-match"), query.etag):
+            # no entity was read
+            return Response(status_code=NOT_MODIFIED, etag=query.etag)
+        # success !!
+        response = StreamedResponse(results, query.etag)
+        response.send(self._socket)
+        print(f"Streamed the data of {response.sent_items} entities")
+        return None
 
-    def _do_task(self) -> Response:
+    def _receive_head(self, data: bytearray) -> bytearray:
         """
-        Starts communicating with client
+        Receives until the headers of a request are complete, or MAX_HEADER_LENGTH bytes arrived without them
+        :param data: What has been received so far
         :return:
         """
-        data = self._socket.recv(self._buffer_size)
-        print(f"Received {data.decode()}\nProcessing request")
-        request_parser = Request(data)
+        while data.find(HEADER_TERMINATOR, 0, MAX_HEADER_LENGTH) == -1 and len(data) < MAX_HEADER_LENGTH:
+            chunk = self._socket.recv(self._buffer_size)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _receive(self, data: bytearray) -> bytearray:
+        """
+        Receives the rest of a request. When it has a Content-Length, reads until the whole body has arrived.
+        :param data: What has been received so far
+        :return:
+        """
+        length = Request.message_length(data)
+        while length is not None and len(data) < length:
+            chunk = self._socket.recv(max(self._buffer_size, length - len(data)))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _bulk_import(self, data: bytearray) -> bool:
+        """
+        Runs a bulk import if the request is one. The import streams its own response.
+        :param data:
+        :return: Whether the request was a bulk import
+        """
+        head = Request.decode_head(data)
+        if head is None:
+            return False
+        request_line, headers, body_start = head
+        if len(request_line) != 3 or request_line[0] != "POST" or not request_line[1].startswith(f"{BULK_IMPORT_PATH}/"):
+            return False
+        org_name = request_line[1][len(BULK_IMPORT_PATH) + 1:]
+        print(f"Bulk import into {org_name}")
+        processed, committed, failed = BulkImport(self._socket, data, org_name, headers, body_start).run()
+        print(f"Bulk import into {org_name} processed {processed}, committed {committed}, failed {failed}")
+        return True
+
+    def _do_task(self) -> Union[Response, None]:
+        """
+        Starts communicating with client
+        :return: The response, or None if it was already streamed
+        """
+        data = self._receive_head(bytearray(self._socket.recv(self._buffer_size)))
+        # a bulk import reads its body as a stream
+        if self._bulk_import(data):
+            return None
+        data = self._receive(data)
+        # only the request line is logged, bodies may be large, private or not UTF-8
+        line_end = data.find(b"\r\n", 0, 1024)
+        request_line = bytes(data[:line_end if line_end != -1 else 1024]).decode(errors="replace")
+        print(f"Received {request_line} ({len(data)} bytes)\nProcessing request")
+        try:
+            request_parser = Request(data)
+        except ValidationError as e:
+            return Response(status_code=POOR_FORMAT, error=str(e))
         method = request_parser.request_method
         if method == "POST":
             return self._post(request_parser)
@@ -132,10 +197,12 @@ class ClientConnection:
         except Exception as e:
             response = Response(500, error=f"Server Error: {e}")
             print(f"Server Error: {e}")
-        print(f"Response:\n{response.get_bytes().decode()}")
-        print(f"Errors: {traceback.format_exc()}")
-        self._socket.sendall(response.get_bytes())
+        if response is not None:
+            print(f"Response:\n{response.get_bytes().decode()}")
+            print(f"Errors: {traceback.format_exc()}")
+            self._socket.sendall(response.get_bytes())
         self._socket.close()
+        CachedPolicy.send_decisions()
         print(f"=====Process connected to {self._address} is closed=====")
 
     def __del__(self):
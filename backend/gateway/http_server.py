@@ -3,7 +3,12 @@ sys.path.append("/home/andrewheschl/PycharmProjects/ResourceScheduler")
 sys.path.append("/home/ubuntu/ResourceScheduler")
 from multiprocessing import Process
 
+from backend.database_endpoints.data_management import PolicyManagement, DataManagement
+from backend.database_endpoints.group_commit import DurabilityFlusher
+from backend.database_endpoints.log_storage import LogCompactor
+from backend.database_endpoints.shared_state import SharedEntityState
 from backend.gateway.client_connection import ClientConnection
+from backend.policies.cache import CachedPolicy, PolicyDecisionCollector
 from backend.utils.constants import *
 import socket
 from utils.constants import BUFFER_SIZE, DEFAULT_IP, DEFAULT_PORT
@@ -38,6 +43,20 @@ class TCPServer:
         Launches client connection off main process with a socket
         :return: None
         """
+        # workers are forked from here, so they start with compiled policies, and with the storage replayed in memory
+        PolicyManagement.preload_catalogs()
+        SharedEntityState.start_session()
+        DataManagement.replay_organizations()
+        # folds the expended logs written by workers into their snapshots
+        compactor = LogCompactor()
+        compactor.start()
+        # flushes registrations of organizations with batched durability
+        flusher = DurabilityFlusher()
+        flusher.start()
+        # keeps the policy decisions of workers, which the workers forked next inherit
+        CachedPolicy.start_session()
+        collector = PolicyDecisionCollector()
+        collector.start()
         print(f"Listening on {self._ip}:{self._port}")
         try:
             with self._socket:
@@ -58,6 +77,10 @@ class TCPServer:
             print(f"Server crash: {e}")
             self._socket.close()
 
+        compactor.stop()
+        flusher.stop()
+        collector.stop()
+        SharedEntityState.end_session()
         print("Server terminated")
 
     def _instantiate_socket(self):
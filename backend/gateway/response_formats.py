@@ -1,5 +1,6 @@
 import sys
 from datetime import datetime
+from typing import Iterator, Tuple, Any, Union
 
 from utils.constants import *
 from utils.errors import InternalResponseError
@@ -11,7 +12,7 @@ class Response:
     Manages responses, and ensures that they are formatted uniformly
     """
     def __init__(self, status_code, **kwargs):
-        if status_code not in [SUCCESS, POOR_FORMAT, REJECTED_BY_ENTITY, ROUTE_DNE, INVALID_REQUEST, UNKNOWN, 500]:
+        if status_code not in [SUCCESS, NOT_MODIFIED, POOR_FORMAT, REJECTED_BY_ENTITY, ROUTE_DNE, INVALID_REQUEST, UNKNOWN, 500]:
             raise InternalResponseError("Status code used is invalid in response")
 
         self.status_code = status_code
@@ -25,21 +26,94 @@ class Response:
         if self.status_code in [POOR_FORMAT, REJECTED_BY_ENTITY, ROUTE_DNE]:
             if "error" not in self.kwargs:
                 raise InternalResponseError("Missing error in a error response")
+        if self.status_code == NOT_MODIFIED:
+            if "etag" not in self.kwargs:
+                raise InternalResponseError("Missing etag in a not modified response")
 
     def get_bytes(self) -> bytes:
+        if self.status_code == NOT_MODIFIED:
+            # the client keeps the body it has
+            etag = self.kwargs["etag"]
+            return f"{Response.header(self.status_code, f'ETag: {etag}')}\r\n".encode()
         _response = {
             "statusCode": self.status_code,
             **self.kwargs
         }
         data = json.dumps(_response, indent=4)
-        header = f"HTTP/1.1 {self.status_code} SEE_BODY\r\n"
+        return f"{Response.header(self.status_code, f'Content-Length: {len(data)}')}\r\n{data}".encode()
+
+    @staticmethod
+    def header(status_code: int, *lines: str) -> str:
+        """
+        :param status_code:
+        :param lines: Headers of this response, ex. how the length of the body is given
+        :return: The status line and headers of a response
+        """
+        header = f"HTTP/1.1 {status_code} SEE_BODY\r\n"
         header += f"Date: {datetime.utcnow().isoformat()}\r\n"
         header += "Server: Epic Resource Scheduler\r\n"
-        header += f"Content-Length: {len(data)}\r\n"
+        header += "".join(f"{line}\r\n" for line in lines)
         header += "Connection: close\r\n"
         header += "Access-Control-Allow-Origin: *\r\n"
         header += "Content-Type: application/json\r\n"
-        return f"{header}\r\n{data}".encode()
+        return header
+
+
+class StreamedResponse:
+    """
+    A success response whose data is a JSON object serialized as a string, as Response(SUCCESS, data=json.dumps(data, indent=4))
+    sends it, written with chunked transfer encoding one item of the object at a time as the items are produced.
+    The body is the same as that of Response, but only one item is held serialized at once.
+
+    Escaping a JSON string is done character by character, so the escaped data is the concatenation of its escaped parts.
+    If producing an item fails once the response started, the data ends there and the body gets an error key.
+    A response with an entity tag then also lacks the last chunk, so that clients see it incomplete and do not keep
+    it under the tag.
+    """
+
+    def __init__(self, items: Iterator[Tuple[str, Any]], etag: Union[str, None] = None):
+        """
+        :param items: (key, value) of the data, in order
+        :param etag: Entity tag of the data, if it has one
+        """
+        self._items = items
+        self._etag = etag
+        self.sent_items = 0
+
+    @staticmethod
+    def _escaped(text: str) -> str:
+        return json.dumps(text)[1:-1]
+
+    @staticmethod
+    def _chunk(text: str) -> bytes:
+        data = text.encode()
+        return f"{len(data):X}\r\n".encode() + data + b"\r\n"
+
+    def send(self, connection) -> None:
+        """
+        :param connection: Socket of the client
+        :return:
+        """
+        headers = ["Transfer-Encoding: chunked"] + ([] if self._etag is None else [f"ETag: {self._etag}"])
+        connection.sendall(f"{Response.header(SUCCESS, *headers)}\r\n".encode())
+        # the indentation of the body, then of the data
+        connection.sendall(StreamedResponse._chunk(f'{{\n    "statusCode": {SUCCESS},\n    "data": "'))
+        error = None
+        try:
+            for key, value in self._items:
+                item = f"    {json.dumps(key)}: {json.dumps(value, indent=4)}".replace("\n", "\n    ")
+                prefix = "{\n" if self.sent_items == 0 else ",\n"
+                connection.sendall(StreamedResponse._chunk(StreamedResponse._escaped(prefix + item)))
+                self.sent_items += 1
+        except Exception as e:
+            error = str(e)
+        # partial data is left unterminated, the error says why
+        end = "" if error is not None else "{}" if self.sent_items == 0 else "\n}"
+        body_end = StreamedResponse._escaped(end) + '"'
+        if error is not None:
+            body_end += f",\n    \"error\": {json.dumps(error)}"
+        last_chunk = b"" if error is not None and self._etag is not None else b"0\r\n\r\n"
+        connection.sendall(StreamedResponse._chunk(body_end + "\n}") + last_chunk)
 
 
 if __name__ == "__main__":
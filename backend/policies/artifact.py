@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import pickle
+from typing import Dict, Tuple, Union, Any
+
+from backend.policies.factory import PolicyFactory
+from backend.policies.policy import Policy
+from utils.constants import TEMPORARY_DATA_ROOT
+
+# Bump when the pickled layout or the policy classes change incompatibly. Older artifacts are ignored.
+ARTIFACT_VERSION = 1
+ARTIFACT_FILE_NAME = "compiled_policies.pickle"
+ANALYSIS_FILE_NAME = "policy_analysis.json"
+
+
+class PolicyArtifact:
+    """
+    Compiled policies of an organization, stored next to entity_definition.json when it is built.
+    The artifact holds the named policies and the policy of every entity (by dotted entity path), so that
+    serving processes load them instead of recompiling the JSON definitions on every request.
+    The artifact records a digest of the definitions it was compiled from, and is ignored once they change.
+    """
+    # organization name -> (signature of the artifact and its sources, loaded artifact or None)
+    _loaded: Dict[str, Tuple[Tuple, Union[Dict[str, Any], None]]] = {}
+
+    @staticmethod
+    def _organization_path(org_name: str) -> str:
+        return f"{TEMPORARY_DATA_ROOT}/organization_{org_name}"
+
+    @staticmethod
+    def _source_files(org_name: str) -> list:
+        """
+        :param org_name:
+        :return: The definition files an artifact is compiled from, in a stable order
+        """
+        organization_path = PolicyArtifact._organization_path(org_name)
+        files = [f"{organization_path}/entity_definition.json"]
+        try:
+            files.extend(sorted(
+                entry.path for entry in os.scandir(f"{organization_path}/policies") if entry.name.endswith(".json")
+            ))
+        except FileNotFoundError:
+            pass
+        return files
+
+    @staticmethod
+    def _source_digest(org_name: str) -> str:
+        digest = hashlib.sha256()
+        for path in PolicyArtifact._source_files(org_name):
+            digest.update(os.path.basename(path).encode())
+            with open(path, "rb") as file:
+                digest.update(file.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _signature(org_name: str) -> Tuple:
+        """
+        Identifies the state of the artifact and its sources without reading them.
+        :param org_name:
+        :return:
+        """
+        organization_path = PolicyArtifact._organization_path(org_name)
+        signature = []
+        for path in [f"{organization_path}/{ARTIFACT_FILE_NAME}"] + PolicyArtifact._source_files(org_name):
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    @staticmethod
+    def analyze(policy: Policy) -> Dict[str, Any]:
+        """
+        Static analysis of a compiled policy
+        :param policy:
+        :return:
+        """
+        keys = policy.referenced_keys()
+        return {
+            "policy": str(policy),
+            "referenced_keys": None if keys is None else list(keys),
+            "complexity": policy.estimate_complexity(),
+            "memoizable": keys is not None and len(keys) > 0
+        }
+
+    @staticmethod
+    def write(org_name: str, policies: Dict[str, Policy], entities: Dict[str, Policy]) -> Dict[str, Any]:
+        """
+        Stores the compiled policies of an organization. Must be called once its definition files are written.
+        Named and entity policies are pickled as one graph, so an entity which names a policy loads the same instance.
+        :param org_name:
+        :param policies: Named policy -> compiled policy
+        :param entities: Dotted entity path -> compiled policy
+        :return: The static analysis that was written beside the artifact
+        """
+        organization_path = PolicyArtifact._organization_path(org_name)
+        analysis = {
+            "version": ARTIFACT_VERSION,
+            "policies": {name: PolicyArtifact.analyze(policy) for name, policy in policies.items()},
+            "entities": {path: PolicyArtifact.analyze(policy) for path, policy in entities.items()}
+        }
+        artifact = {
+            "version": ARTIFACT_VERSION,
+            "source_digest": PolicyArtifact._source_digest(org_name),
+            "policies": policies,
+            "entities": entities,
+            "analysis": analysis
+        }
+        # write then rename, so that a serving process never reads a partial artifact
+        temporary_path = f"{organization_path}/{ARTIFACT_FILE_NAME}.tmp"
+        with open(temporary_path, "wb") as file:
+            pickle.dump(artifact, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, f"{organization_path}/{ARTIFACT_FILE_NAME}")
+        with open(f"{organization_path}/{ANALYSIS_FILE_NAME}", "w+") as file:
+            json.dump(analysis, file, indent=4)
+        return analysis
+
+    @staticmethod
+    def _read(org_name: str) -> Union[Dict[str, Any], None]:
+        artifact_path = f"{PolicyArtifact._organization_path(org_name)}/{ARTIFACT_FILE_NAME}"
+        if not os.path.exists(artifact_path):
+            return None
+        try:
+            with open(artifact_path, "rb") as file:
+                artifact = pickle.load(file)
+        except Exception as e:
+            print(f"Could not load compiled policies of {org_name}, they will be compiled from their definitions: {e}")
+            return None
+        if not isinstance(artifact, dict) or artifact.get("version") != ARTIFACT_VERSION:
+            print(f"Compiled policies of {org_name} are from another version, they will be compiled from their definitions.")
+            return None
+        if artifact["source_digest"] != PolicyArtifact._source_digest(org_name):
+            print(f"Compiled policies of {org_name} are out of date, they will be compiled from their definitions.")
+            return None
+        # memoize once per process, so decisions are shared by every request this process serves.
+        # Loaded cached policies join CachedPolicy._instances as they are unpickled, see CachedPolicy.__setstate__
+        memoized = {}
+
+        def memoize(policy: Policy) -> Policy:
+            if id(policy) not in memoized:
+                memoized[id(policy)] = PolicyFactory.memoize(policy)
+            return memoized[id(policy)]
+
+        artifact["policies"] = {name: memoize(policy) for name, policy in artifact["policies"].items()}
+        artifact["entities"] = {path: memoize(policy) for path, policy in artifact["entities"].items()}
+        return artifact
+
+    @staticmethod
+    def load(org_name: str) -> Union[Dict[str, Any], None]:
+        """
+        The compiled policies of an organization, loaded once per process and reloaded when rewritten.
+        :param org_name:
+        :return: The artifact, or None if there is no usable artifact and definitions must be compiled
+        """
+        signature = PolicyArtifact._signature(org_name)
+        cached = PolicyArtifact._loaded.get(org_name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        artifact = PolicyArtifact._read(org_name)
+        PolicyArtifact._loaded[org_name] = (signature, artifact)
+        return artifact
@@ -0,0 +1,264 @@
+import json
+import operator
+from typing import List, Tuple, Dict, Any, Callable, Sequence
+
+import numpy as np
+
+from backend.policies import factory
+from backend.policies.cache import CachedPolicy
+from backend.policies.difference_policies.policies import GreaterThanPolicy, LesserThanPolicy, GreaterThanEQPolicy, \
+    LesserThanEQPolicy, GreaterThanPolicyK, LesserThanPolicyK, GreaterThanEQPolicyK, LesserThanEQPolicyK
+from backend.policies.equality_policies.policies import MatchPolicy, EqualityPolicy
+from backend.policies.fol_policies import policy as fol
+from backend.policies.highlevel_policies.policies import TicketedPolicy
+from backend.policies.policy import Policy, ResolvedPolicy
+from backend.policies.request_control_policies.policies import RequiredHeaderPolicy
+from backend.requests.requests import Request
+
+_COMPARISONS = {
+    GreaterThanPolicy: operator.gt,
+    LesserThanPolicy: operator.lt,
+    GreaterThanEQPolicy: operator.ge,
+    LesserThanEQPolicy: operator.le
+}
+_KEY_COMPARISONS = {
+    GreaterThanPolicyK: operator.gt,
+    LesserThanPolicyK: operator.lt,
+    GreaterThanEQPolicyK: operator.ge,
+    LesserThanEQPolicyK: operator.le
+}
+_ATOMIC_OPERATIONS = {
+    "<": operator.lt,
+    ">": operator.gt,
+    "=": operator.eq,
+    "<=": operator.le,
+    ">=": operator.ge
+}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Column:
+    """
+    The values of one request key across the batch, split into typed NumPy arrays.
+    Values which are neither numbers nor strings are only kept as objects, and rows holding them fall back.
+    """
+
+    def __init__(self, values: List[Any], present: np.ndarray):
+        self.values = values
+        self.present = present
+        self.is_number = np.array([p and _is_number(v) for p, v in zip(present, values)], dtype=bool)
+        self.is_str = np.array([p and isinstance(v, str) for p, v in zip(present, values)], dtype=bool)
+        self.numbers = np.array([v if n else np.nan for v, n in zip(values, self.is_number)], dtype=np.float64)
+        self.strings = np.array([v if s else "" for v, s in zip(values, self.is_str)], dtype=str)
+        self._as_text = None
+
+    @property
+    def typed(self) -> np.ndarray:
+        return self.is_number | self.is_str
+
+    @property
+    def as_text(self) -> np.ndarray:
+        """
+        str() of every present value, as compared by FOL atoms
+        :return:
+        """
+        if self._as_text is None:
+            self._as_text = np.array([str(v) if p else "" for v, p in zip(self.values, self.present)], dtype=str)
+        return self._as_text
+
+
+class BatchPolicyEvaluator:
+    """
+    Evaluates one compiled policy against many requests at once.
+    The keys the policy reads are extracted into columns, and the simple behaviors (match, equality, comparisons,
+    required headers and FOL comparison atoms) run as vectorized operations. Every other policy, and every row
+    the vectorized path can not decide (missing keys, unexpected types), is evaluated individually.
+    """
+
+    def __init__(self, policy: Policy):
+        self._policy = policy
+        self._columns: Dict[str, _Column] = {}
+        self._requests: Sequence[Request] = []
+        self._size = 0
+        self._handlers: Dict[type, Callable[[Policy], Tuple[np.ndarray, np.ndarray]]] = {
+            Policy: self._base,
+            ResolvedPolicy: self._resolved,
+            CachedPolicy: lambda p: self._node(p.policy),
+            fol.FolWrapper: lambda p: self._node(p.policy),
+            TicketedPolicy: lambda p: self._node(p._structure_policy),
+            factory.AndPolicy: self._and,
+            factory.OrPolicy: lambda p: self._connective(p.cascaded_policies, True),
+            fol.AndPolicy: lambda p: self._connective(p._policies, False),
+            fol.OrPolicy: lambda p: self._connective(p._policies, True),
+            fol.NotPolicy: self._not,
+            fol.AtomicPolicy: self._atomic,
+            MatchPolicy: self._match,
+            EqualityPolicy: self._equality,
+            RequiredHeaderPolicy: self._required_headers,
+            **{policy_class: self._comparison for policy_class in _COMPARISONS},
+            **{policy_class: self._key_comparison for policy_class in _KEY_COMPARISONS}
+        }
+
+    def evaluate(self, requests: Sequence[Request]) -> Tuple[np.ndarray, Dict[int, str]]:
+        """
+        :param requests:
+        :return: Boolean mask of approved requests, and the reason for each rejected row index
+        """
+        self._size = len(requests)
+        self._columns = {}
+        self._requests = requests
+        mask, fallback = self._node(self._policy)
+        mask = mask.copy()
+        reasons = {}
+        for row in np.flatnonzero(fallback):
+            mask[row], reason = self._evaluate_row(requests[row])
+            if not mask[row]:
+                reasons[int(row)] = reason
+        for row in np.flatnonzero(~mask & ~fallback):
+            reasons[int(row)] = self._evaluate_row(requests[row])[1]
+        self._columns, self._requests = {}, []
+        return mask, reasons
+
+    def _evaluate_row(self, request: Request) -> Tuple[bool, str]:
+        try:
+            result = self._policy.validate(request)
+        except Exception as e:
+            # the reason routing a single request gives
+            return False, str(e)
+        if isinstance(result, tuple):
+            return bool(result[0]), result[1]
+        return bool(result), json.dumps("Sentence satisfied" if result else "Sentence not satisfied", indent=4)
+
+    def _column(self, key: str) -> _Column:
+        if key not in self._columns:
+            values, present = [], np.ones(self._size, dtype=bool)
+            for row, request in enumerate(self._requests):
+                try:
+                    values.append(request.lookup(key))
+                except KeyError:
+                    values.append(None)
+                    present[row] = False
+            self._columns[key] = _Column(values, present)
+        return self._columns[key]
+
+    def _everything_falls_back(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.zeros(self._size, dtype=bool), np.ones(self._size, dtype=bool)
+
+    def _node(self, policy: Policy) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param policy:
+        :return: (result mask, fallback mask). Rows in the fallback mask have no meaningful result.
+        """
+        handler = self._handlers.get(type(policy))
+        if handler is None:
+            return self._everything_falls_back()
+        return handler(policy)
+
+    def _base(self, policy: Policy) -> Tuple[np.ndarray, np.ndarray]:
+        return np.full(self._size, policy.full_approval, dtype=bool), np.zeros(self._size, dtype=bool)
+
+    def _resolved(self, policy: ResolvedPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        return np.full(self._size, policy.outcome, dtype=bool), np.zeros(self._size, dtype=bool)
+
+    def _connective(self, policies: Sequence[Policy], decisive_outcome: bool, short_circuit: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Combines children as an And (decisive outcome False) or Or (decisive outcome True).
+        When the connective short circuits, a child that can not be decided only matters for rows which
+        are still undecided by the children before it.
+        :param policies:
+        :param decisive_outcome:
+        :param short_circuit:
+        :return:
+        """
+        mask = np.full(self._size, not decisive_outcome, dtype=bool)
+        fallback, running = np.zeros(self._size, dtype=bool), np.ones(self._size, dtype=bool)
+        for policy in policies:
+            child_mask, child_fallback = self._node(policy)
+            fallback |= (running if short_circuit else True) & child_fallback
+            decided = running & ~child_fallback & (child_mask == decisive_outcome)
+            mask[decided] = decisive_outcome
+            if short_circuit:
+                running &= ~decided & ~child_fallback
+        return mask, fallback
+
+    def _and(self, policy: factory.AndPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        # in declaration order every child is evaluated, and any of them may raise
+        return self._connective(policy.cascaded_policies, False, short_circuit=False)
+
+    def _not(self, policy: fol.NotPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        mask, fallback = self._node(policy._policy)
+        return ~mask, fallback
+
+    def _match(self, policy: MatchPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        mask, fallback = np.ones(self._size, dtype=bool), np.zeros(self._size, dtype=bool)
+        for key, allowable in policy.arguments.items():
+            column = self._column(key)
+            numbers = [value for value in allowable if isinstance(value, (int, float))]
+            strings = [value for value in allowable if isinstance(value, str)]
+            allowed = (column.is_number & np.isin(column.numbers, numbers)) | (column.is_str & np.isin(column.strings, strings))
+            mask &= allowed
+            fallback |= ~column.typed
+        return mask, fallback
+
+    def _equality(self, policy: EqualityPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        mask, fallback = np.ones(self._size, dtype=bool), np.zeros(self._size, dtype=bool)
+        columns = [self._column(key) for key in policy.required_equality_keys]
+        for column in columns:
+            fallback |= ~column.typed
+        for previous, current in zip(columns, columns[1:]):
+            mask &= ((previous.is_number & current.is_number & (previous.numbers == current.numbers)) |
+                     (previous.is_str & current.is_str & (previous.strings == current.strings)))
+        return mask, fallback
+
+    def _comparison(self, policy: Policy) -> Tuple[np.ndarray, np.ndarray]:
+        compare = _COMPARISONS[type(policy)]
+        mask, fallback = np.ones(self._size, dtype=bool), np.zeros(self._size, dtype=bool)
+        for key, value in policy.arguments.items():
+            column = self._column(key)
+            if _is_number(value):
+                decided = column.is_number
+                mask &= compare(column.numbers, value)
+            elif isinstance(value, str):
+                decided = column.is_str
+                mask &= compare(column.strings, value)
+            else:
+                return self._everything_falls_back()
+            fallback |= ~decided
+        return mask, fallback
+
+    def _key_comparison(self, policy: Policy) -> Tuple[np.ndarray, np.ndarray]:
+        compare = _KEY_COMPARISONS[type(policy)]
+        mask, fallback = np.ones(self._size, dtype=bool), np.zeros(self._size, dtype=bool)
+        for key1, key2 in policy.arguments.items():
+            first, second = self._column(key1), self._column(key2)
+            numeric, textual = first.is_number & second.is_number, first.is_str & second.is_str
+            mask &= np.where(numeric, compare(first.numbers, second.numbers), compare(first.strings, second.strings))
+            fallback |= ~(numeric | textual)
+        return mask, fallback
+
+    def _required_headers(self, policy: RequiredHeaderPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        if policy.strict:
+            return self._everything_falls_back()
+        mask = np.ones(self._size, dtype=bool)
+        for header in policy.required_headers:
+            mask &= self._column(header).present
+        return mask, np.zeros(self._size, dtype=bool)
+
+    def _atomic(self, policy: fol.AtomicPolicy) -> Tuple[np.ndarray, np.ndarray]:
+        if policy._operation not in _ATOMIC_OPERATIONS:
+            return self._everything_falls_back()
+        present, operands = np.ones(self._size, dtype=bool), []
+        for constant in (policy._c1, policy._c2):
+            if constant.key is not None:
+                column = self._column(constant.key)
+                present &= column.present
+                operands.append(column.as_text)
+            elif str(constant)[0] in ["*", "^"]:
+                return self._everything_falls_back()
+            else:
+                operands.append(str(constant))
+        # a missing key makes the atom False, as in AtomicPolicy
+        return present & _ATOMIC_OPERATIONS[policy._operation](*operands), np.zeros(self._size, dtype=bool)
@@ -0,0 +1,318 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Tuple, Any, Dict, Hashable, List, Union
+
+from backend.policies.ordering import AdaptiveOrdering
+from backend.policies.policy import Policy
+from backend.requests.requests import Request
+from utils.constants import POLICY_CACHE_SIZE, PARTIAL_EVALUATION_KEYS, POLICY_CATALOG_REFRESH_SECONDS
+
+# cache key value of a key the request does not have. Frozen values are (type, value), so it is never one of them,
+# and it is the same once decisions are sent to another process.
+_MISSING = None
+
+
+def _freeze(value: Any) -> Hashable:
+    """
+    Converts a request value into something hashable.
+    The type is kept with the value so that 1, 1.0 and True do not share a decision.
+    :param value:
+    :return:
+    """
+    if isinstance(value, dict):
+        return dict, tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return list, tuple(_freeze(item) for item in value)
+    return type(value), value
+
+
+class CachedPolicy(Policy):
+    """
+    Memoizes the decisions of a policy in a bounded LRU.
+    The cache key is the tuple of values at the keys the policy reads, so the wrapped policy
+    must be able to determine its referenced keys statically.
+
+    A worker is forked per connection, so the decisions it adds die with it. Under a server, workers send the decisions
+    they added to the policies they inherited back to it, see PolicyDecisionCollector, so the workers forked next
+    start with them.
+    """
+    # (process id, number) of every live cached policy of this process
+    _instances = weakref.WeakValueDictionary()
+    _numbers = itertools.count()
+    # pid of the server and the queue its workers send decisions through. None outside of a server.
+    _server: Union[Tuple[int, Any], None] = None
+
+    def __init__(self, policy: Policy, max_size: int = POLICY_CACHE_SIZE):
+        super().__init__(False)
+        keys = policy.referenced_keys()
+        if keys is None:
+            raise ValueError(f"Policy {policy} does not have statically known keys, and can not be cached.")
+        self.policy = policy
+        self.max_size = max_size
+        self._keys = keys
+        self._cache: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._register()
+
+    def _register(self) -> None:
+        self._id = (os.getpid(), next(CachedPolicy._numbers))
+        # keys decided by this worker, when the policy was inherited from the server, as many as the cache holds
+        self._added: OrderedDict = OrderedDict()
+        CachedPolicy._instances[self._id] = self
+
+    def _cache_key(self, request: Request) -> Tuple:
+        values = []
+        for key in self._keys:
+            try:
+                value = request.lookup(key)
+            except KeyError:
+                values.append(_MISSING)
+                continue
+            values.append(_freeze(value))
+        return tuple(values)
+
+    def validate(self, request: Request) -> Tuple[bool, str]:
+        key = self._cache_key(request)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        self.misses += 1
+        # exceptions are not cached, they propagate as they would without the cache
+        result = self.policy.validate(request)
+        self._remember(key, result)
+        if CachedPolicy._server is not None and self._id[0] == CachedPolicy._server[0] != os.getpid():
+            self._added[key] = None
+            if len(self._added) > self.max_size:
+                self._added.popitem(last=False)
+        return result
+
+    def _remember(self, key: Tuple, result: Tuple[bool, str]) -> None:
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return self._keys
+
+    def estimate_complexity(self) -> int:
+        return self.policy.estimate_complexity()
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        residual = self.policy.partially_evaluate(known)
+        if residual is self.policy:
+            return self
+        keys = residual.referenced_keys()
+        if keys is None or len(keys) == 0:
+            return residual
+        # the residual reads fewer keys, so its decisions are shared by more requests
+        return CachedPolicy(residual, max_size=self.max_size)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # decisions are specific to a process, only the configuration is persisted
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        state["hits"], state["misses"] = 0, 0
+        del state["_id"], state["_added"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._register()
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self.hits, self.misses = 0, 0
+
+    def cache_info(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "policy": str(self.policy),
+            "keys": list(self._keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._cache),
+            "max_size": self.max_size,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.
+        }
+
+    @staticmethod
+    def statistics(used_only: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        Cache statistics of every live cached policy in this process.
+        :param used_only: Only the policies looked up since they were created or cleared
+        :return: Mapping of policy id to its cache info
+        """
+        return {f"{cached.policy}@{id(cached):x}": cached.cache_info() for cached in list(CachedPolicy._instances.values())
+                if not used_only or cached.hits + cached.misses > 0}
+
+    @staticmethod
+    def start_session() -> None:
+        """
+        Lets the workers this process forks send it their decisions, and what they measured of adaptive orderings.
+        Call in the server, before forking workers.
+        :return:
+        """
+        CachedPolicy._server = (os.getpid(), multiprocessing.Queue())
+        AdaptiveOrdering.server = os.getpid()
+
+    @staticmethod
+    def send_decisions() -> None:
+        """
+        Sends the decisions this worker added to the policies it inherited, the residuals it made of them, and what it
+        measured of the adaptive orderings it inherited, to the server. Call once the request was answered.
+        :return:
+        """
+        if CachedPolicy._server is None or CachedPolicy._server[0] == os.getpid():
+            return
+        decisions = []
+        for cached in list(CachedPolicy._instances.values()):
+            added = [(key, cached._cache[key]) for key in cached._added if key in cached._cache]
+            if cached._id[0] == CachedPolicy._server[0] and len(added) > 0:
+                decisions.append((cached._id, added))
+        residuals = []
+        for policy, residual_policies in list(ResidualPolicies._of_policy.items()):
+            if isinstance(policy, CachedPolicy) and policy._id[0] == CachedPolicy._server[0]:
+                residuals.extend((policy._id, key, (residual, list(added.items())))
+                                 for key, (residual, added) in residual_policies._added.items())
+        measures = AdaptiveOrdering.measured()
+        if len(decisions) > 0 or len(residuals) > 0 or len(measures) > 0:
+            try:
+                CachedPolicy._server[1].put((decisions, residuals, measures))
+            except Exception as e:
+                print(f"Could not send policy decisions to the server: {e}")
+
+    @staticmethod
+    def receive_decisions(decisions: List[Tuple[Tuple[int, int], List[Tuple[Tuple, Tuple[bool, str]]]]],
+                          residuals: List[Tuple[Tuple[int, int], Tuple, Tuple[Policy, List]]]) -> None:
+        """
+        Adds the decisions a worker sent to the policies of the server. Policies the server dropped since are skipped.
+        :param decisions: (policy id, its new (cache key, decision))
+        :param residuals: (policy id, cache key of the residual, (residual, its decisions))
+        :return:
+        """
+        for policy_id, added in decisions:
+            cached = CachedPolicy._instances.get(policy_id)
+            if cached is not None:
+                for key, result in added:
+                    cached._remember(key, result)
+        for policy_id, key, (residual, added) in residuals:
+            policy = CachedPolicy._instances.get(policy_id)
+            if policy is None:
+                continue
+            residual = ResidualPolicies.of(policy).adopt(key, residual)
+            if isinstance(residual, CachedPolicy):
+                for decision_key, result in added:
+                    residual._remember(decision_key, result)
+
+    def __str__(self):
+        return str(self.policy)
+
+
+class ResidualPolicies:
+    """
+    Residuals of a policy partially evaluated on the keys that are fixed for a route, ex. the entity path.
+    One residual is kept per combination of known values in a bounded LRU, and shared by every entity using the policy.
+    """
+    _of_policy = weakref.WeakKeyDictionary()
+
+    def __init__(self, policy: Policy, known_keys: List[str] = PARTIAL_EVALUATION_KEYS, max_size: int = POLICY_CACHE_SIZE):
+        self.policy = policy
+        self.max_size = max_size
+        keys = policy.referenced_keys()
+        # nothing to specialize when the policy is known not to read these keys
+        self.known_keys = [key for key in known_keys if keys is None or key in keys]
+        self._residuals: OrderedDict = OrderedDict()
+        # residuals made by this worker, which it sends to the server with their decisions
+        self._added: Dict[Tuple, Tuple[Policy, List]] = {}
+
+    @staticmethod
+    def of(policy: Policy) -> "ResidualPolicies":
+        """
+        :param policy:
+        :return: The residuals of a policy, created on first use
+        """
+        residuals = ResidualPolicies._of_policy.get(policy)
+        if residuals is None:
+            residuals = ResidualPolicies(policy)
+            ResidualPolicies._of_policy[policy] = residuals
+        return residuals
+
+    def for_request(self, request: Request) -> Policy:
+        """
+        :param request:
+        :return: The residual which decides this request as the policy would
+        """
+        if len(self.known_keys) == 0 or self.max_size <= 0:
+            return self.policy
+        known = {}
+        for key in self.known_keys:
+            try:
+                known[key] = request.lookup(key)
+            except KeyError:
+                continue
+        cache_key = tuple((key, _freeze(value)) for key, value in known.items())
+        if cache_key in self._residuals:
+            self._residuals.move_to_end(cache_key)
+            return self._residuals[cache_key]
+        residual = self.policy.partially_evaluate(known)
+        self._residuals[cache_key] = residual
+        if len(self._residuals) > self.max_size:
+            self._residuals.popitem(last=False)
+        if CachedPolicy._server is not None and CachedPolicy._server[0] != os.getpid():
+            # decisions are read when they are sent, the residual decides requests until then
+            self._added[cache_key] = (residual, residual._cache if isinstance(residual, CachedPolicy) else {})
+        return residual
+
+    def adopt(self, cache_key: Tuple, residual: Policy) -> Policy:
+        """
+        Keeps a residual made by a worker, unless one is already kept for its known values
+        :param cache_key: Known values of the residual
+        :param residual:
+        :return: The residual kept
+        """
+        if cache_key not in self._residuals:
+            self._residuals[cache_key] = residual
+            if len(self._residuals) > self.max_size:
+                self._residuals.popitem(last=False)
+        return self._residuals.get(cache_key, residual)
+
+
+class PolicyDecisionCollector(threading.Thread):
+    """
+    Background thread of the server adding the decisions and ordering measures sent by workers to its policies, and reloading the policy
+    catalogs which changed, so that the workers forked next inherit both
+    """
+
+    def __init__(self, interval: float = POLICY_CATALOG_REFRESH_SECONDS):
+        super().__init__(daemon=True, name="PolicyDecisionCollector")
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        from backend.database_endpoints.data_management import PolicyManagement
+
+        refreshed = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                decisions, residuals, measures = CachedPolicy._server[1].get(timeout=self._interval)
+                CachedPolicy.receive_decisions(decisions, residuals)
+                AdaptiveOrdering.add_measured(measures)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"Could not add policy decisions of a worker: {e}")
+            if time.monotonic() - refreshed >= self._interval:
+                PolicyManagement.preload_catalogs()
+                refreshed = time.monotonic()
+
+    def stop(self) -> None:
+        self._stopped.set()
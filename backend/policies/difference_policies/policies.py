@@ -3,7 +3,6 @@ from typing import Dict, Any, Tuple
 
 from backend.policies.policy import Policy
 from backend.requests.requests import Request
-from backend.utils.utils import hierarchical_dict_lookup
 
 
 class GreaterThanPolicy(Policy):
@@ -17,13 +16,16 @@ class GreaterThanPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, compare in self.arguments.items():
-            value = hierarchical_dict_lookup(request.raw_request, key)
+            value = request.lookup(key)
             gt = value > compare
             reasons.append({key: gt})
             if not gt:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.arguments.keys())
+
 
 class LesserThanPolicy(Policy):
     """
@@ -36,13 +38,16 @@ class LesserThanPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, compare in self.arguments.items():
-            value = hierarchical_dict_lookup(request.raw_request, key)
+            value = request.lookup(key)
             lt = value < compare
             reasons.append({key: lt})
             if not lt:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.arguments.keys())
+
 
 class GreaterThanEQPolicy(Policy):
     """
@@ -55,13 +60,16 @@ class GreaterThanEQPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, compare in self.arguments.items():
-            value = hierarchical_dict_lookup(request.raw_request, key)
+            value = request.lookup(key)
             ge = value >= compare
             reasons.append({key: ge})
             if not ge:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.arguments.keys())
+
 
 class LesserThanEQPolicy(Policy):
     """
@@ -74,13 +82,16 @@ class LesserThanEQPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, compare in self.arguments.items():
-            value = hierarchical_dict_lookup(request.raw_request, key)
+            value = request.lookup(key)
             le = value <= compare
             reasons.append({key: le})
             if not le:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.arguments.keys())
+
 
 class GreaterThanPolicyK(Policy):
     """
@@ -93,14 +104,17 @@ class GreaterThanPolicyK(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key1, key2 in self.arguments.items():
-            value1 = hierarchical_dict_lookup(request.raw_request, key1)
-            value2 = hierarchical_dict_lookup(request.raw_request, key2)
+            value1 = request.lookup(key1)
+            value2 = request.lookup(key2)
             gt = value1 > value2
             reasons.append({key1: gt})
             if not gt:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys([*self.arguments.keys(), *self.arguments.values()]))
+
 
 class LesserThanPolicyK(Policy):
     """
@@ -113,14 +127,17 @@ class LesserThanPolicyK(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key1, key2 in self.arguments.items():
-            value1 = hierarchical_dict_lookup(request.raw_request, key1)
-            value2 = hierarchical_dict_lookup(request.raw_request, key2)
+            value1 = request.lookup(key1)
+            value2 = request.lookup(key2)
             lt = value1 < value2
             reasons.append({key1: lt})
             if not lt:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys([*self.arguments.keys(), *self.arguments.values()]))
+
 
 class GreaterThanEQPolicyK(Policy):
     """
@@ -133,14 +150,17 @@ class GreaterThanEQPolicyK(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key1, key2 in self.arguments.items():
-            value1 = hierarchical_dict_lookup(request.raw_request, key1)
-            value2 = hierarchical_dict_lookup(request.raw_request, key2)
+            value1 = request.lookup(key1)
+            value2 = request.lookup(key2)
             ge = value1 >= value2
             reasons.append({key1: ge})
             if not ge:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys([*self.arguments.keys(), *self.arguments.values()]))
+
 
 class LesserThanEQPolicyK(Policy):
     """
@@ -153,10 +173,13 @@ class LesserThanEQPolicyK(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key1, key2 in self.arguments.items():
-            value1 = hierarchical_dict_lookup(request.raw_request, key1)
-            value2 = hierarchical_dict_lookup(request.raw_request, key2)
+            value1 = request.lookup(key1)
+            value2 = request.lookup(key2)
             le = value1 <= value2
             reasons.append({key1: le})
             if not le:
                 result = False
         return result, json.dumps(reasons, indent=4)
+
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys([*self.arguments.keys(), *self.arguments.values()]))
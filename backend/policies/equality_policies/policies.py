@@ -1,10 +1,10 @@
 import json
-import re
 from typing import List, Tuple, Dict, Any
 
 from backend.policies.policy import Policy
+from backend.policies.regular_expressions import search, check_pattern
 from backend.requests.requests import Request
-from backend.utils.utils import hierarchical_dict_lookup
+from utils.constants import POLICY_REGEX_TIMEOUT_SECONDS
 
 
 class EqualityPolicy(Policy):
@@ -20,7 +20,7 @@ class EqualityPolicy(Policy):
         result, reason = True, "success"
         last_value = None
         for key in self.required_equality_keys:
-            value = hierarchical_dict_lookup(request.raw_request, key)
+            value = request.lookup(key)
             result = last_value is None or value == last_value
             last_value = value
             if not result:
@@ -28,6 +28,9 @@ class EqualityPolicy(Policy):
                 break
         return result, json.dumps(reason, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(self.required_equality_keys))
+
 
 class MatchPolicy(Policy):
     """
@@ -41,13 +44,16 @@ class MatchPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, allowable in self.arguments.items():
-            value = hierarchical_dict_lookup(request.raw_request, key)
+            value = request.lookup(key)
             is_allowed = value in allowable
             reasons.append({key: is_allowed})
             if not is_allowed:
                 result = False
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.arguments.keys())
+
 
 class RegularExpressionPolicy(Policy):
     """
@@ -60,12 +66,17 @@ class RegularExpressionPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, expression in self.arguments.items():
-            value = hierarchical_dict_lookup(request.raw_request, key)
-            try:
-                match = re.search(expression, value) is not None
-            except re.error:
-                match = False
+            value = request.lookup(key)
+            match = search(expression, value, timeout=POLICY_REGEX_TIMEOUT_SECONDS)
             reasons.append({key: match})
             if not match:
                 result = False
         return result, json.dumps(reasons, indent=4)
+
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.arguments.keys())
+
+    def estimate_complexity(self) -> int:
+        for expression in self.arguments.values():
+            check_pattern(expression)
+        return super().estimate_complexity()
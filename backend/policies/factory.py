@@ -1,12 +1,16 @@
-from typing import Tuple, List, Union, Dict
+import copy
+from typing import Tuple, List, Union, Dict, Iterator, Any
 
 from backend.policies.difference_policies.policies import GreaterThanPolicy, GreaterThanEQPolicy, LesserThanPolicy, LesserThanEQPolicy
 from backend.policies.equality_policies.policies import EqualityPolicy, MatchPolicy, RegularExpressionPolicy
 from backend.policies.fol_policies.policy import FolPolicyFactory
-from backend.policies.policy import Policy
+from backend.policies.ordering import AdaptiveOrdering, ORDERING_OPTIONS
+from backend.policies.policy import Policy, ResolvedPolicy, union_referenced_keys
 from backend.policies.request_control_policies.policies import RequiredHeaderPolicy, ArgumentFormatPolicy
 import json
 from backend.requests.requests import Request
+from utils.constants import POLICY_CACHE_SIZE, ADAPTIVE_POLICY_ORDERING, MAX_POLICY_COMPLEXITY
+from utils.errors import PolicyComplexityError
 
 """
 A policy is an object that validates a request.
@@ -39,7 +43,17 @@ Formats:
 
 
 class LogicalPolicy(Policy):
-    def __init__(self, cascaded_policies: Union[Dict, List[Union[str, Policy, List, Dict]]], org_name=None):
+    # The child outcome which decides the result on its own, used to rank children in adaptive mode
+    _decisive_outcome: bool
+
+    def __init__(self, cascaded_policies: Union[Dict, List[Union[str, Policy, List, Dict]]], org_name=None,
+                 adaptive: Union[bool, None] = None, pinned: bool = False):
+        """
+        :param cascaded_policies:
+        :param org_name:
+        :param adaptive: Reorder children by observed cost and selectivity. Defaults to ADAPTIVE_POLICY_ORDERING.
+        :param pinned: Keep declaration order even in adaptive mode.
+        """
         super().__init__(False)
         policies = []
         if not isinstance(cascaded_policies, dict):
@@ -49,31 +63,79 @@ class LogicalPolicy(Policy):
                 else:
                     policies.append(PolicyFactory.get_policy_from_argument(p, org_name))
         else:
+            adaptive = cascaded_policies.get("adaptive", adaptive)
+            pinned = cascaded_policies.get("pinned", pinned)
             policies = PolicyFactory.get_policy_from_dict(cascaded_policies, return_policy_list=True)
         self.cascaded_policies = policies
+        adaptive = ADAPTIVE_POLICY_ORDERING if adaptive is None else adaptive
+        self._ordering = None
+        if adaptive and not pinned:
+            self._ordering = AdaptiveOrdering(str(self), len(policies), decisive_outcome=self._decisive_outcome)
+
+    def _evaluate_children(self, request: Request) -> Iterator[Tuple[Policy, Tuple[bool, str]]]:
+        """
+        Yields each child with its result, in adaptive order if enabled
+        :param request:
+        :return:
+        """
+        if self._ordering is None:
+            for policy in self.cascaded_policies:
+                yield policy, policy.validate(request)
+            return
+        yield from self._ordering.run(self.cascaded_policies, lambda policy: policy.validate(request), lambda result: result[0])
 
     def validate(self, request: Request) -> Tuple[bool]:
         raise NotImplementedError("Server error. CascadePolicy is to be treated as abstract.")
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        return union_referenced_keys(self.cascaded_policies)
+
+    def estimate_complexity(self) -> int:
+        return sum(policy.estimate_complexity() for policy in self.cascaded_policies)
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        """
+        Specializes every child. Decided children stay in place, so that reasons read the same.
+        :param known:
+        :return:
+        """
+        residual = super().partially_evaluate(known)
+        if residual is not self:
+            return residual
+        children = [policy.partially_evaluate(known) for policy in self.cascaded_policies]
+        if all(child is policy for child, policy in zip(children, self.cascaded_policies)):
+            return self
+        residual = copy.copy(self)
+        residual.cascaded_policies = children
+        if self._ordering is not None:
+            residual._ordering = AdaptiveOrdering(str(residual), len(children), decisive_outcome=self._decisive_outcome)
+        return residual
+
 
 class AndPolicy(LogicalPolicy):
+    _decisive_outcome = False
+
     def validate(self, request: Request) -> Tuple[bool, str]:
         """
-        Validated request against a list of cascaded policies
+        Validated request against a list of cascaded policies.
+        In adaptive mode we stop at the first rejection, so only evaluated policies give reasons.
         :param request:
         :return:
         """
         result, reasons = True, []
-        for policy in self.cascaded_policies:
-            p_result, reason = policy.validate(request)
+        for policy, (p_result, reason) in self._evaluate_children(request):
             reason = json.decoder.JSONDecoder().decode(reason)
             reasons.append({f"{str(policy)}": reason})
             if not p_result:
                 result = False
+                if self._ordering is not None:
+                    break
         return result, json.dumps(reasons, indent=4)
 
 
 class OrPolicy(LogicalPolicy):
+    _decisive_outcome = True
+
     def validate(self, request: Request) -> Tuple[bool, str]:
         """
         Validated request against a list of policies.
@@ -82,8 +144,7 @@ class OrPolicy(LogicalPolicy):
         :return:
         """
         result, reasons = False, []
-        for policy in self.cascaded_policies:
-            p_result, reason = policy.validate(request)
+        for policy, (p_result, reason) in self._evaluate_children(request):
             reason = json.decoder.JSONDecoder().decode(reason)
             reasons.append({f"{str(policy)}": reason})
             if p_result:
@@ -92,12 +153,55 @@ class OrPolicy(LogicalPolicy):
 
         return result, json.dumps(reasons, indent=4)
 
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        residual = super().partially_evaluate(known)
+        if not isinstance(residual, OrPolicy) or residual._ordering is not None:
+            return residual
+        # in declaration order, nothing after the first accepting child is evaluated
+        for policy in residual.cascaded_policies:
+            if not isinstance(policy, ResolvedPolicy):
+                return residual
+            if policy.outcome:
+                return ResolvedPolicy(residual.validate(None), str(self))
+        return residual
+
 
 class PolicyFactory:
     @staticmethod
     def create_full_approval_policy() -> Policy:
         return Policy(full_approval=True)
 
+    @staticmethod
+    def memoize(policy: Policy, max_size: int = POLICY_CACHE_SIZE) -> Policy:
+        """
+        Wraps a policy with a decision cache keyed on the request values it reads.
+        Policies whose keys can not be determined statically (or which read no keys) are returned as is.
+        :param policy:
+        :param max_size: Maximum number of cached decisions. <= 0 disables caching.
+        :return:
+        """
+        from backend.policies.cache import CachedPolicy
+        if max_size <= 0 or isinstance(policy, CachedPolicy):
+            return policy
+        keys = policy.referenced_keys()
+        if keys is None or len(keys) == 0:
+            return policy
+        return CachedPolicy(policy, max_size=max_size)
+
+    @staticmethod
+    def check_complexity(policy: Policy, limit: int = MAX_POLICY_COMPLEXITY) -> int:
+        """
+        Rejects policies whose estimated evaluation cost is above the limit, ex. quantifiers nested over all keys,
+        and regular expressions which may backtrack exponentially.
+        :param policy:
+        :param limit:
+        :return: The estimated complexity
+        """
+        complexity = policy.estimate_complexity()
+        if complexity > limit:
+            raise PolicyComplexityError(f"Policy {policy} has an estimated complexity of {complexity}, above the limit of {limit}.")
+        return complexity
+
     @staticmethod
     def get_cascade_policy_from_list(arg: List, org_name=None) -> Policy:
         return AndPolicy(arg, org_name)
@@ -105,7 +209,7 @@ class PolicyFactory:
     @staticmethod
     def get_policy_from_dict(arg: Dict, return_policy_list: bool = False) -> Union[LogicalPolicy | List[Policy]]:
         """
-        :param arg:
+        :param arg: Mapping of behavior name to its arguments. "adaptive" and "pinned" control child ordering.
         :param return_policy_list: If we should return the list of policies instead of the wrapped version.
         :return:
         """
@@ -126,8 +230,12 @@ class PolicyFactory:
 
         policies = []
         for key, value in arg.items():
+            if key in ORDERING_OPTIONS:
+                continue
             policies.append(policy_lookup[key](value))
-        return AndPolicy(policies) if not return_policy_list else policies
+        if return_policy_list:
+            return policies
+        return AndPolicy(policies, adaptive=arg.get("adaptive"), pinned=arg.get("pinned", False))
 
     @staticmethod
     def get_policy_from_argument(arg: Union[str, Dict, List], org_name=None) -> Policy:
@@ -1,11 +1,57 @@
 import json
-import re
+import time
 from abc import abstractmethod
+from contextvars import ContextVar
 from typing import Tuple, Any, Dict, List, Union
 
-from backend.policies.policy import Policy
+from backend.policies.ordering import AdaptiveOrdering
+from backend.policies.policy import Policy, ResolvedPolicy, union_referenced_keys
+from backend.policies.regular_expressions import search, check_pattern
 from backend.requests.requests import Request
-from backend.utils.utils import hierarchical_dict_lookup, hierarchical_keys
+from utils.constants import ADAPTIVE_POLICY_ORDERING, FOL_MAX_EVALUATION_STEPS, FOL_MAX_EVALUATION_SECONDS, \
+    FOL_MAX_REGEX_INPUT_LENGTH, ASSUMED_DOMAIN_WIDTH
+from utils.errors import EvaluationBudgetExceededError
+
+# Cost of a regex match relative to a comparison, for static complexity estimation
+REGEX_COMPLEXITY = 10
+
+
+class EvaluationBudget:
+    """
+    Bounds the work of one evaluation of a sentence.
+    Every atomic check and every quantifier iteration is one step.
+    """
+
+    def __init__(self, max_steps: int = FOL_MAX_EVALUATION_STEPS, max_seconds: float = FOL_MAX_EVALUATION_SECONDS):
+        self.steps = 0
+        self._max_steps = max_steps
+        self._max_seconds = max_seconds
+        self._deadline = time.perf_counter() + max_seconds
+
+    def step(self) -> None:
+        self.steps += 1
+        if self.steps > self._max_steps:
+            raise EvaluationBudgetExceededError(f"Evaluation exceeded {self._max_steps} steps.")
+        if time.perf_counter() > self._deadline:
+            raise EvaluationBudgetExceededError(f"Evaluation exceeded {self._max_seconds} seconds.")
+
+    def remaining_seconds(self) -> float:
+        return self._deadline - time.perf_counter()
+
+
+# The budget of the sentence currently being evaluated, set by FolWrapper
+_current_budget: ContextVar = ContextVar("fol_evaluation_budget", default=None)
+
+
+def _step() -> None:
+    budget = _current_budget.get()
+    if budget is not None:
+        budget.step()
+
+
+def _remaining_seconds() -> float:
+    budget = _current_budget.get()
+    return FOL_MAX_EVALUATION_SECONDS if budget is None else budget.remaining_seconds()
 
 
 class Constant:
@@ -26,12 +72,20 @@ class Constant:
         if self._literal[0] == "*":
             raise NotImplementedError("Key lookup does not yet exist (will be wrapped by existential)")
         if self._literal[0] == "$":
-            return hierarchical_dict_lookup(request.raw_request, self._literal[1:])
+            return request.lookup(self._literal[1:])
         if self._literal[0] == "^":
             return self._extracted_regulars[self._literal[1:]]
         else:
             return self._literal
 
+    @property
+    def key(self) -> Union[str, None]:
+        """
+        The request key this constant reads, if any
+        :return:
+        """
+        return self._literal[1:] if self._literal[0] == "$" else None
+
     def __str__(self):
         return self._literal
 
@@ -73,6 +127,7 @@ class AtomicPolicy(Policy):
         :param request:
         :return:
         """
+        _step()
         try:
             c1, c2 = str(self._c1.extract(request)), str(self._c2.extract(request))
         except KeyError:
@@ -85,34 +140,100 @@ class AtomicPolicy(Policy):
         elif self._operation == "=":
             return c1 == c2
         elif self._operation == "~":
-            try:
-                match = re.search(c2[1:-1], c1) is not None
-            except re.error:
-                match = False
-            return match
+            if len(c1) > FOL_MAX_REGEX_INPUT_LENGTH:
+                raise EvaluationBudgetExceededError(f"Regex input of length {len(c1)} exceeds {FOL_MAX_REGEX_INPUT_LENGTH}.")
+            # the match is stopped when the budget runs out
+            return search(self._pattern(c2), c1, timeout=_remaining_seconds())
         elif self._operation == ">=":
             return c1 >= c2
         elif self._operation == "<=":
             return c1 <= c2
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(dict.fromkeys(c.key for c in (self._c1, self._c2) if c.key is not None))
+
+    def estimate_complexity(self) -> int:
+        if self._operation != "~":
+            return 1
+        # patterns read from the request are only bounded by the evaluation budget
+        if self._c2.key is None:
+            check_pattern(self._pattern(str(self._c2.extract(None))))
+        return REGEX_COMPLEXITY
+
+    @staticmethod
+    def _pattern(literal: str) -> str:
+        """
+        :param literal: Right hand side of a ~ atom
+        :return: The regular expression it matches with
+        """
+        return literal[1:-1]
+
     def __str__(self):
         return self._policy_literal
 
 
-class AndPolicy(Policy):
+class _ConnectivePolicy(Policy):
     """
-    Policy which asserts all policies are True
+    Shared behaviour of the commutative binary connectives
     """
+    # The child outcome which decides the result on its own
+    _decisive_outcome: bool
 
-    def __init__(self, *policies: Policy):
+    def __init__(self, *policies: Policy, adaptive: Union[bool, None] = None, pinned: bool = False):
         super().__init__(False)
         self._policies = policies
+        adaptive = ADAPTIVE_POLICY_ORDERING if adaptive is None else adaptive
+        self._ordering = None
+        if adaptive and not pinned:
+            self._ordering = AdaptiveOrdering(str(self), len(policies), decisive_outcome=self._decisive_outcome)
 
     def validate(self, request: Request):
-        result = True
-        for atomic_policy in self._policies:
-            result = result and atomic_policy(request)
-        return result
+        if self._ordering is None:
+            children = ((policy, policy(request)) for policy in self._policies)
+        else:
+            children = self._ordering.run(list(self._policies), lambda policy: policy(request), bool)
+        for _, result in children:
+            if bool(result) == self._decisive_outcome:
+                return self._decisive_outcome
+        return not self._decisive_outcome
+
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        return union_referenced_keys(self._policies)
+
+    def estimate_complexity(self) -> int:
+        return sum(policy.estimate_complexity() for policy in self._policies)
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        """
+        Drops children decided to the neutral outcome, and decides the connective if a child is decisive
+        :param known:
+        :return:
+        """
+        residual = super().partially_evaluate(known)
+        if residual is not self:
+            return residual
+        children = []
+        for policy in self._policies:
+            child = policy.partially_evaluate(known)
+            if isinstance(child, ResolvedPolicy):
+                if child.outcome == self._decisive_outcome:
+                    return ResolvedPolicy(self._decisive_outcome, str(self))
+                continue
+            children.append(child)
+        if len(children) == 0:
+            return ResolvedPolicy(not self._decisive_outcome, str(self))
+        if len(children) == 1:
+            return children[0]
+        if len(children) == len(self._policies) and all(child is policy for child, policy in zip(children, self._policies)):
+            return self
+        return type(self)(*children, adaptive=self._ordering is not None)
+
+
+class AndPolicy(_ConnectivePolicy):
+    """
+    Policy which asserts all policies are True
+    """
+    _decisive_outcome = False
 
     def __str__(self):
         result = ""
@@ -121,20 +242,11 @@ class AndPolicy(Policy):
         return result[:-1]
 
 
-class OrPolicy(Policy):
+class OrPolicy(_ConnectivePolicy):
     """
     Policy which asserts at least one policy is True
     """
-
-    def __init__(self, *policies: Policy):
-        super().__init__(False)
-        self._policies = policies
-
-    def validate(self, request: Request):
-        result = False
-        for atomic_policy in self._policies:
-            result = result or atomic_policy(request)
-        return result
+    _decisive_outcome = True
 
     def __str__(self):
         result = ""
@@ -156,6 +268,20 @@ class NotPolicy(Policy):
     def validate(self, request: Request):
         return not self._policy(request)
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        return self._policy.referenced_keys()
+
+    def estimate_complexity(self) -> int:
+        return self._policy.estimate_complexity()
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        child = self._policy.partially_evaluate(known)
+        if child is self._policy:
+            return self
+        if isinstance(child, ResolvedPolicy):
+            return ResolvedPolicy(not child.outcome, str(self))
+        return NotPolicy(child)
+
     def __str__(self):
         return f"!({str(self._policy)})"
 
@@ -194,18 +320,45 @@ class QuantifierPolicy(Policy):
         :param request:
         :return:
         """
-        all_keys = hierarchical_keys(request.raw_request) if self._bases is None else []
         if self._bases is None:
-            return all_keys
+            return request.key_index.keys
+        all_keys = []
         for key in self._bases:
             # TODO chance for index out of bounds
             if key[-1] == "*" and key[-2] == ".":
-                key = key[:-2]
-                all_keys.extend(hierarchical_keys(hierarchical_dict_lookup(request.raw_request, key), parent_key=key))
+                all_keys.extend(request.key_index.family(key[:-2]))
             else:
                 all_keys.append(key)
         return all_keys
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        """
+        Only a quantifier over a fixed list of keys can be determined statically.
+        The keys are those read by the sentence for each element of the domain.
+        :return:
+        """
+        if self._bases is None or any(key[-1] == "*" for key in self._bases):
+            return None
+        policies = [
+            FolPolicyFactory.get_policy_from_literal(self._replace_variable(key), reason_wrapper=False, **self._extracted_regulars)
+            for key in self._bases
+        ]
+        return union_referenced_keys(policies)
+
+    def estimate_complexity(self) -> int:
+        """
+        Domain width times the complexity of the quantified sentence.
+        Domains over all keys, or over a key family, are assumed to be ASSUMED_DOMAIN_WIDTH wide.
+        :return:
+        """
+        if self._bases is None:
+            width, placeholder = ASSUMED_DOMAIN_WIDTH, "placeholder"
+        else:
+            width = sum(ASSUMED_DOMAIN_WIDTH if key[-1] == "*" else 1 for key in self._bases)
+            placeholder = self._bases[0] if len(self._bases) > 0 else "placeholder"
+        inner = FolPolicyFactory.get_policy_from_literal(self._replace_variable(placeholder), reason_wrapper=False, **self._extracted_regulars)
+        return width * inner.estimate_complexity()
+
     @abstractmethod
     def validate(self, request: Request):
         ...
@@ -224,6 +377,7 @@ class ExistentialPolicy(QuantifierPolicy):
     def validate(self, request: Request):
         all_keys = self._get_keys_for_check(request)
         for key in all_keys:
+            _step()
             literal_attempt = self._replace_variable(key)
             policy = FolPolicyFactory.get_policy_from_literal(literal_attempt, reason_wrapper=False, **self._extracted_regulars)
             if policy(request):
@@ -245,6 +399,7 @@ class UniversalPolicy(QuantifierPolicy):
         all_keys = self._get_keys_for_check(request)
         result = True
         for key in all_keys:
+            _step()
             literal_attempt = self._replace_variable(key)
             policy = FolPolicyFactory.get_policy_from_literal(literal_attempt, reason_wrapper=False, **self._extracted_regulars)
             result = result and policy(request)
@@ -257,11 +412,39 @@ class FolWrapper(Policy):
         self.policy = policy
 
     def validate(self, request: Request) -> Tuple[bool, str]:
-        result = self.policy.validate(request)
+        """
+        Evaluates the sentence within an EvaluationBudget.
+        Running out of budget raises EvaluationBudgetExceededError instead of failing the sentence, as the sentence is
+        undecided and the outcome must not be memoized.
+        :param request:
+        :return:
+        """
+        token = _current_budget.set(EvaluationBudget()) if _current_budget.get() is None else None
+        try:
+            result = self.policy.validate(request)
+        finally:
+            if token is not None:
+                _current_budget.reset(token)
         if isinstance(result, tuple):
             result = result[0]
         return result, json.dumps("Sentence satisfied" if result else "Sentence not satisfied", indent=4)
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        return self.policy.referenced_keys()
+
+    def estimate_complexity(self) -> int:
+        return self.policy.estimate_complexity()
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        child = self.policy.partially_evaluate(known)
+        if child is self.policy:
+            return self
+        residual = FolWrapper(child)
+        if isinstance(child, ResolvedPolicy):
+            # the decided sentence ignores the request
+            return ResolvedPolicy(residual.validate(None), str(self))
+        return residual
+
 
 class FolPolicyFactory:
 
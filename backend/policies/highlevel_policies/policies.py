@@ -1,7 +1,8 @@
-from typing import Tuple, List
+import copy
+from typing import Tuple, List, Union, Dict, Any
 
 from backend.policies.factory import PolicyFactory
-from backend.policies.policy import Policy
+from backend.policies.policy import Policy, ResolvedPolicy
 from backend.requests.requests import Request
 from backend.utils.utils import validate_iso8601
 import json
@@ -26,6 +27,22 @@ class TicketedPolicy(Policy):
     def validate(self, request: Request) -> Tuple[bool, str]:
         return self._structure_policy(request)
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        return self._structure_policy.referenced_keys()
+
+    def estimate_complexity(self) -> int:
+        return self._structure_policy.estimate_complexity()
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        structure_policy = self._structure_policy.partially_evaluate(known)
+        if structure_policy is self._structure_policy:
+            return self
+        if isinstance(structure_policy, ResolvedPolicy):
+            return ResolvedPolicy(structure_policy.result, str(self))
+        residual = copy.copy(self)
+        residual._structure_policy = structure_policy
+        return residual
+
 
 class TimeslotPolicy(Policy):
     """
@@ -60,6 +77,9 @@ class TimeslotPolicy(Policy):
             return False, f"End time must be greater than start time."
         return True, "success"
 
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return "data.start_time", "data.end_time"
+
 if __name__ == "__main__":
 
     request = {
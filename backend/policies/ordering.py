@@ -0,0 +1,161 @@
+import itertools
+import os
+import time
+import weakref
+from typing import List, Any, Callable, Tuple, Iterator, Union, Dict
+
+from utils.constants import ADAPTIVE_REORDER_INTERVAL
+
+# Keys which may sit beside the cascaded policies of a dictionary And/Or to control ordering
+ORDERING_OPTIONS = ("adaptive", "pinned")
+
+
+class AdaptiveOrdering:
+    """
+    Tracks cost and outcome of the commutative children of a logical policy.
+    Every interval evaluations the children are reordered so that the cheapest child per decisive outcome
+    runs first. A decisive outcome is the one that short circuits: a failure for And, a success for Or.
+
+    A worker is forked per connection and evaluates a policy a few times, so under a server the orderings are kept by
+    the server: workers send what they measured on the orderings they inherited, see CachedPolicy.send_decisions, and
+    the server reorders, so the workers forked next run the new order.
+    """
+    # (process id, number) of every live ordering of this process
+    _instances = weakref.WeakValueDictionary()
+    _numbers = itertools.count()
+    # pid of the server, None outside of a server
+    server: Union[int, None] = None
+
+    def __init__(self, owner: str, size: int, decisive_outcome: bool, interval: int = ADAPTIVE_REORDER_INTERVAL):
+        self.owner = owner
+        self.order = list(range(size))
+        self._decisive_outcome = decisive_outcome
+        self._interval = interval
+        self._elapsed = [0.] * size
+        self._evaluations = [0] * size
+        self._decisive = [0] * size
+        self._since_reorder = 0
+        # evaluations since the ordering was made
+        self._runs = 0
+        self._register()
+
+    def _register(self) -> None:
+        self._id = (os.getpid(), next(AdaptiveOrdering._numbers))
+        # measures when the worker was forked, of an ordering inherited from the server
+        self._inherited: Union[Tuple[int, List[float], List[int], List[int]], None] = None
+        AdaptiveOrdering._instances[self._id] = self
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        del state["_id"], state["_inherited"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._register()
+
+    def run(self, children: List[Any], evaluate: Callable[[Any], Any], outcome: Callable[[Any], bool]) -> Iterator[Tuple[Any, Any]]:
+        """
+        Evaluates children in the current order, recording each evaluation.
+        Yields (child, result) so the caller may stop consuming to short circuit.
+        :param children: The children in declaration order
+        :param evaluate: Evaluates a single child
+        :param outcome: Extracts the boolean outcome from the result of evaluate
+        :return:
+        """
+        try:
+            for index in list(self.order):
+                start = time.perf_counter()
+                result = evaluate(children[index])
+                self._record(index, time.perf_counter() - start, outcome(result))
+                yield children[index], result
+        finally:
+            # runs when the caller short circuits as well
+            self._evaluated()
+
+    def _record(self, index: int, elapsed: float, outcome: bool) -> None:
+        self._elapsed[index] += elapsed
+        self._evaluations[index] += 1
+        if outcome == self._decisive_outcome:
+            self._decisive[index] += 1
+
+    def _score(self, index: int) -> float:
+        """
+        Expected time spent per decisive outcome. Children that have never run score 0 so that they get measured.
+        :param index:
+        :return:
+        """
+        evaluations = self._evaluations[index]
+        if evaluations == 0:
+            return 0.
+        mean_elapsed = self._elapsed[index] / evaluations
+        decisive_rate = self._decisive[index] / evaluations
+        return mean_elapsed / max(decisive_rate, 1e-3)
+
+    def _evaluated(self, evaluations: int = 1) -> None:
+        """
+        Called once the children have been run (or short circuited) for requests
+        :param evaluations: Number of requests
+        :return:
+        """
+        self._runs += evaluations
+        self._since_reorder += evaluations
+        if self._since_reorder < self._interval:
+            return
+        self._since_reorder = 0
+        new_order = sorted(self.order, key=self._score)
+        if new_order != self.order:
+            print(f"Reordered children of {self.owner} from {self.order} to {new_order}")
+            self.order = new_order
+
+    @staticmethod
+    def forked() -> None:
+        """
+        Keeps the measures of the orderings a worker inherits, so that it sends only its own
+        :return:
+        """
+        if AdaptiveOrdering.server is None:
+            return
+        for ordering in list(AdaptiveOrdering._instances.values()):
+            if ordering._id[0] == AdaptiveOrdering.server:
+                ordering._inherited = (ordering._runs, list(ordering._elapsed), list(ordering._evaluations),
+                                       list(ordering._decisive))
+
+    @staticmethod
+    def measured() -> List[Tuple[Tuple[int, int], int, Tuple[List[float], List[int], List[int]]]]:
+        """
+        :return: (ordering id, evaluations, measures) this worker added to the orderings it inherited from the server
+        """
+        measures = []
+        for ordering in list(AdaptiveOrdering._instances.values()):
+            if ordering._inherited is None:
+                continue
+            runs, elapsed, evaluations, decisive = ordering._inherited
+            runs = ordering._runs - runs
+            added = ([now - then for now, then in zip(ordering._elapsed, elapsed)],
+                     [now - then for now, then in zip(ordering._evaluations, evaluations)],
+                     [now - then for now, then in zip(ordering._decisive, decisive)])
+            if runs > 0:
+                measures.append((ordering._id, runs, added))
+        return measures
+
+    @staticmethod
+    def add_measured(measures: List[Tuple[Tuple[int, int], int, Tuple[List[float], List[int], List[int]]]]) -> None:
+        """
+        Adds what a worker measured to the orderings of the server, which reorders them when due.
+        Orderings the server dropped since are skipped.
+        :param measures: See measured
+        :return:
+        """
+        for ordering_id, runs, (elapsed, evaluations, decisive) in measures:
+            ordering = AdaptiveOrdering._instances.get(ordering_id)
+            if ordering is None or len(elapsed) != len(ordering.order):
+                continue
+            for index in range(len(ordering.order)):
+                ordering._elapsed[index] += elapsed[index]
+                ordering._evaluations[index] += evaluations[index]
+                ordering._decisive[index] += decisive[index]
+            ordering._evaluated(runs)
+
+
+os.register_at_fork(after_in_child=AdaptiveOrdering.forked)
@@ -1,5 +1,5 @@
 from abc import abstractmethod
-from typing import Tuple
+from typing import Tuple, Union, Iterable, Dict, Any
 
 from backend.requests.requests import Request
 
@@ -19,8 +19,106 @@ class Policy:
             return False, "Base class policy without full approval auto rejects."
         return True, "success"
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        """
+        Statically determine which request keys this policy reads.
+        Subclasses which override validate must override this, otherwise they are treated as unknown.
+        :return: Tuple of dotted keys, or None if the keys read depend on the request (ex. quantifying over all keys)
+        """
+        # the bare policy only looks at full_approval
+        return () if type(self) is Policy else None
+
+    def estimate_complexity(self) -> int:
+        """
+        Static estimate of the work done by one evaluation, in units of simple checks
+        :return:
+        """
+        return 1
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> "Policy":
+        """
+        Specializes the policy to requests holding the known values.
+        Policies with children override this to specialize their children.
+        :param known: Dotted key -> value, ex. {"entity": "uofc.ARC"}
+        :return: A residual policy checking only the remaining keys. For any request holding the known values,
+        it gives the same result as this policy. This policy itself if nothing could be decided.
+        """
+        keys = self.referenced_keys()
+        if keys is None or any(key not in known for key in keys):
+            return self
+        try:
+            return ResolvedPolicy(self.validate(Request.from_dict(_nest(known), request_method="PUT")), str(self))
+        except Exception:
+            # raised again when a request is evaluated
+            return self
+
     def __str__(self):
         return str(self.__class__.__name__)
 
     def __call__(self, request: Request) -> Tuple[bool, str]:
         return self.validate(request)
+
+
+def union_referenced_keys(policies: Iterable[Policy]) -> Union[Tuple[str, ...], None]:
+    """
+    Combines the referenced keys of several policies, preserving order.
+    :param policies:
+    :return: Tuple of dotted keys, or None if any policy can not be determined statically
+    """
+    keys = {}
+    for policy in policies:
+        policy_keys = policy.referenced_keys()
+        if policy_keys is None:
+            return None
+        keys.update(dict.fromkeys(policy_keys))
+    return tuple(keys)
+
+
+class ResolvedPolicy(Policy):
+    """
+    A policy whose result was decided by partial evaluation
+    """
+
+    def __init__(self, result: Any, name: str):
+        """
+        :param result: What the decided policy returned, a (bool, reason) tuple or a bool for FOL sentences
+        :param name: The name of the decided policy, kept so that reasons read the same
+        """
+        super().__init__(False)
+        self.result = result
+        self.name = name
+
+    @property
+    def outcome(self) -> bool:
+        return bool(self.result[0] if isinstance(self.result, tuple) else self.result)
+
+    def validate(self, request: Request) -> Any:
+        return self.result
+
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return ()
+
+    def estimate_complexity(self) -> int:
+        return 0
+
+    def partially_evaluate(self, known: Dict[str, Any]) -> Policy:
+        return self
+
+    def __str__(self):
+        return self.name
+
+
+def _nest(flat: Dict[str, Any]) -> Dict:
+    """
+    {"a.b": 1} -> {"a": {"b": 1}}
+    :param flat:
+    :return:
+    """
+    nested = {}
+    for key, value in flat.items():
+        *parents, last = key.split(".")
+        level = nested
+        for parent in parents:
+            level = level.setdefault(parent, {})
+        level[last] = value
+    return nested
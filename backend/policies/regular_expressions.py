@@ -0,0 +1,306 @@
+import re
+from typing import FrozenSet, List, Tuple, Any
+
+import regex
+
+from utils.errors import EvaluationBudgetExceededError, PolicyComplexityError
+
+# Characters the first characters of repetitions and alternatives are compared on
+_ALPHABET = [chr(code) for code in range(128)] + ["\u00e9", "\u0663", "\u3000"]
+_ANY = frozenset(_ALPHABET)
+_CLASSES = {
+    letter: frozenset(character for character in _ALPHABET if re.match(f"\\{letter}", character))
+    for letter in "dDsSwW"
+}
+_CONTROLS = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "a": "\a", "e": "\x1b"}
+# zero width escapes
+_ASSERTIONS = "bBAZzG"
+_UNBOUNDED = float("inf")
+
+
+class _Unsupported(Exception):
+    """
+    Syntax the check does not read, ex. backreferences. Such patterns are left to the timeout of search.
+    """
+    ...
+
+
+def search(pattern: str, text: str, timeout: float) -> bool:
+    """
+    Searches text for a pattern, giving up after timeout seconds
+    :param pattern:
+    :param text:
+    :param timeout: Seconds the match may take
+    :return: Whether the pattern matched. An invalid pattern does not match.
+    """
+    if timeout <= 0:
+        raise EvaluationBudgetExceededError("Regex match has no time left to run.")
+    try:
+        return regex.search(pattern, text, timeout=timeout) is not None
+    except regex.error:
+        return False
+    except TimeoutError:
+        raise EvaluationBudgetExceededError(f"Regex {pattern} did not match within {timeout:.3f} seconds.")
+
+
+def check_pattern(pattern: str) -> None:
+    """
+    Rejects patterns which backtrack exponentially, as a repetition can match the same text in more than one way:
+    a repeated body with a quantifier which can also match what follows it, up to the start of the next repetition,
+    ex. (a+)+, (\\w+\\s?)* or (.*,)*, or repeated alternatives which can start with the same character, ex. (a|aa)*.
+    A delimiter between repetitions, ex. ([a-z]+ )*, passes, as do possessive quantifiers and atomic groups, which
+    never backtrack into what they matched.
+    Invalid patterns pass, as they never match, and so do patterns using syntax the check does not read, which are
+    bounded by the timeout of search.
+    :param pattern:
+    :return:
+    """
+    try:
+        regex.compile(pattern)
+        parsed = _Parser(pattern).parse()
+    except (regex.error, _Unsupported):
+        return
+    _check(parsed, pattern)
+
+
+class _Parser:
+    """
+    Reads a pattern into nodes:
+    ("chars", characters), ("empty",) for anchors, ("seq", nodes), ("alt", nodes), ("rep", low, high, node, possessive),
+    ("atomic", node) and ("look", node). Groups are their content.
+    """
+
+    def __init__(self, pattern: str):
+        self._pattern = pattern
+        self._position = 0
+
+    def parse(self) -> Tuple:
+        node = self._alternation()
+        if self._position != len(self._pattern):
+            raise _Unsupported(self._pattern)
+        return node
+
+    def _peek(self, length: int = 1) -> str:
+        return self._pattern[self._position:self._position + length]
+
+    def _next(self) -> str:
+        if self._position >= len(self._pattern):
+            raise _Unsupported(self._pattern)
+        character = self._pattern[self._position]
+        self._position += 1
+        return character
+
+    def _alternation(self) -> Tuple:
+        branches = [self._sequence()]
+        while self._peek() == "|":
+            self._position += 1
+            branches.append(self._sequence())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _sequence(self) -> Tuple:
+        items = []
+        while self._position < len(self._pattern) and self._peek() not in "|)":
+            atom = self._atom()
+            if atom is not None:
+                items.append(self._quantified(atom))
+        return ("seq", items)
+
+    def _quantified(self, atom: Tuple) -> Tuple:
+        character = self._peek()
+        if character in ("*", "+", "?"):
+            self._position += 1
+            low, high = {"*": (0, _UNBOUNDED), "+": (1, _UNBOUNDED), "?": (0, 1)}[character]
+        elif character == "{":
+            bounds = re.match(r"\{(\d*)(,?)(\d*)}", self._pattern[self._position:])
+            if bounds is None or bounds.group(0) in ("{}", "{,}"):
+                # a literal {
+                return atom
+            self._position += len(bounds.group(0))
+            low = int(bounds.group(1) or 0)
+            high = int(bounds.group(3)) if bounds.group(3) else _UNBOUNDED if bounds.group(2) else low
+        else:
+            return atom
+        possessive = self._peek() == "+"
+        if self._peek() in ("+", "?"):
+            self._position += 1
+        return ("rep", low, high, atom, possessive)
+
+    def _atom(self) -> Any:
+        character = self._next()
+        if character == "(":
+            return self._group()
+        if character == "[":
+            return ("chars", self._class())
+        if character == ".":
+            return ("chars", _ANY - {"\n"})
+        if character in ("^", "$"):
+            return ("empty",)
+        if character == "\\":
+            return self._escape(in_class=False)
+        if character in ("*", "+", "?"):
+            raise _Unsupported(self._pattern)
+        return ("chars", frozenset([character]))
+
+    def _group(self) -> Any:
+        kind = "group"
+        if self._peek(2) == "?:":
+            self._position += 2
+        elif self._peek(2) == "?>":
+            self._position += 2
+            kind = "atomic"
+        elif self._peek(2) in ("?=", "?!"):
+            self._position += 2
+            kind = "look"
+        elif self._peek(3) in ("?<=", "?<!"):
+            self._position += 3
+            kind = "look"
+        elif self._peek(3) == "?P<" or self._peek(2) == "?<":
+            self._position = self._pattern.index(">", self._position) + 1
+        elif self._peek() == "?":
+            flags = re.match(r"\?[a-zA-Z\-]*([:)])", self._pattern[self._position:])
+            if flags is None:
+                raise _Unsupported(self._pattern)
+            self._position += len(flags.group(0))
+            if flags.group(1) == ")":
+                # flags of the whole pattern, which match nothing
+                return None
+        node = self._alternation()
+        if self._next() != ")":
+            raise _Unsupported(self._pattern)
+        return node if kind == "group" else (kind, node)
+
+    def _class(self) -> FrozenSet[str]:
+        negate = self._peek() == "^"
+        if negate:
+            self._position += 1
+        characters = set()
+        first = True
+        while True:
+            character = self._next()
+            if character == "]" and not first:
+                break
+            first = False
+            if character == "\\":
+                escaped = self._escape(in_class=True)
+                characters |= escaped[1]
+                continue
+            if self._peek() == "-" and self._peek(2) != "-]" and len(self._peek(2)) == 2:
+                self._position += 1
+                end = self._next()
+                if end == "\\":
+                    end_characters = self._escape(in_class=True)[1]
+                    if len(end_characters) != 1:
+                        raise _Unsupported(self._pattern)
+                    end = next(iter(end_characters))
+                characters |= {candidate for candidate in _ALPHABET if character <= candidate <= end}
+                continue
+            characters.add(character)
+        return _ANY - characters if negate else frozenset(characters)
+
+    def _escape(self, in_class: bool) -> Tuple:
+        character = self._next()
+        if character in _CLASSES:
+            return ("chars", _CLASSES[character])
+        if character in _CONTROLS:
+            return ("chars", frozenset([_CONTROLS[character]]))
+        if character in _ASSERTIONS and not in_class:
+            return ("empty",)
+        if character in ("x", "u", "U"):
+            digits = {"x": 2, "u": 4, "U": 8}[character]
+            code = self._pattern[self._position:self._position + digits]
+            if not re.fullmatch(f"[0-9a-fA-F]{{{digits}}}", code):
+                raise _Unsupported(self._pattern)
+            self._position += digits
+            return ("chars", frozenset([chr(int(code, 16))]))
+        if character.isalnum():
+            # backreferences, properties, named characters...
+            raise _Unsupported(self._pattern)
+        return ("chars", frozenset([character]))
+
+
+def _first(node: Tuple) -> Tuple[FrozenSet[str], bool]:
+    """
+    :param node: Parsed pattern
+    :return: Characters of _ALPHABET the node can start with, and whether it can match the empty string
+    """
+    kind = node[0]
+    if kind == "chars":
+        return node[1], False
+    if kind in ("empty", "look"):
+        return frozenset(), True
+    if kind == "atomic":
+        return _first(node[1])
+    if kind == "rep":
+        characters, nullable = _first(node[3])
+        return characters, nullable or node[1] == 0
+    if kind == "alt":
+        firsts = [_first(branch) for branch in node[1]]
+        return frozenset().union(*(characters for characters, _ in firsts)), any(nullable for _, nullable in firsts)
+    characters = frozenset()
+    for item in node[1]:
+        item_characters, nullable = _first(item)
+        characters |= item_characters
+        if not nullable:
+            return characters, False
+    return characters, True
+
+
+def _followed(node: Tuple, after: FrozenSet[str]) -> List[Tuple[Tuple, FrozenSet[str]]]:
+    """
+    :param node: Parsed pattern
+    :param after: Characters which can follow the node
+    :return: (quantifier, characters which can follow it) of the quantifiers of the node which may backtrack
+    """
+    kind = node[0]
+    if kind == "seq":
+        followed = []
+        for index, item in enumerate(node[1]):
+            rest, nullable = _first(("seq", node[1][index + 1:]))
+            followed.extend(_followed(item, rest | after if nullable else rest))
+        return followed
+    if kind == "alt":
+        return [pair for branch in node[1] for pair in _followed(branch, after)]
+    if kind == "rep" and not node[4]:
+        low, high, body = node[1:4]
+        followed = [(node, after)] if low != high else []
+        return followed + _followed(body, after | _first(body)[0] if high > 1 else after)
+    return []
+
+
+def _check(node: Tuple, pattern: str) -> None:
+    """
+    :param node: Parsed pattern
+    :param pattern: Source, for the error
+    :return:
+    """
+    kind = node[0]
+    if kind == "rep":
+        _, _, high, body, possessive = node
+        if high > 1 and not possessive:
+            _check_repeated(body, pattern)
+        _check(body, pattern)
+    elif kind in ("seq", "alt"):
+        for item in node[1]:
+            _check(item, pattern)
+    elif kind in ("atomic", "look"):
+        _check(node[1], pattern)
+
+
+def _check_repeated(body: Tuple, pattern: str) -> None:
+    """
+    Rejects a repeated body which can match the same text in more than one way
+    :param body: Parsed body of a quantifier matching more than once
+    :param pattern: Source, for the error
+    :return:
+    """
+    for repetition, after in _followed(body, _first(body)[0]):
+        # the quantifier may as well match what follows it, up to the start of the next iteration
+        if len(_first(repetition[3])[0] & after) > 0:
+            raise PolicyComplexityError(f"Regex {pattern} nests quantifiers, which may backtrack exponentially.")
+    if body[0] == "alt":
+        seen = set()
+        for branch in body[1]:
+            first = _first(branch)[0]
+            if len(seen & first) > 0:
+                raise PolicyComplexityError(f"Regex {pattern} repeats overlapping alternatives, which may backtrack exponentially.")
+            seen |= first
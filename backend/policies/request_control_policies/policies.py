@@ -1,9 +1,9 @@
 import json
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Union
 
 from backend.policies.policy import Policy
 from backend.requests.requests import Request
-from backend.utils.utils import hierarchical_dict_lookup, validate_iso8601
+from backend.utils.utils import validate_iso8601
 
 
 class RequiredHeaderPolicy(Policy):
@@ -28,7 +28,7 @@ class RequiredHeaderPolicy(Policy):
         for header in self.required_headers:
             # asked for say data.quantity to exist
             try:
-                hierarchical_dict_lookup(request.raw_request, header)
+                request.lookup(header)
             except KeyError:
                 result = False
                 reasons.append({header: "missing"})
@@ -42,6 +42,36 @@ class RequiredHeaderPolicy(Policy):
 
         return result, json.dumps(reasons, indent=4)
 
+    def referenced_keys(self) -> Union[Tuple[str, ...], None]:
+        # strict mode looks at every top level header
+        return None if self.strict else tuple(dict.fromkeys(self.required_headers))
+
+
+def _is_dict(value) -> bool:
+    return isinstance(value, dict)
+
+
+def _is_str(value) -> bool:
+    return isinstance(value, str)
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int)
+
+
+def _is_float(value) -> bool:
+    return isinstance(value, float)
+
+
+# Module level functions rather than lambdas, so that compiled policies can be pickled
+_FORMATS = {
+    "iso8601": validate_iso8601,
+    "dict": _is_dict,
+    "str": _is_str,
+    "int": _is_int,
+    "float": _is_float
+}
+
 
 class ArgumentFormatPolicy(Policy):
     """
@@ -50,19 +80,13 @@ class ArgumentFormatPolicy(Policy):
     def __init__(self, requirements: Dict[str, str]):
         super().__init__(False)
         self.requirements = requirements
-        self._formats = {
-            "iso8601": validate_iso8601,
-            "dict": lambda x: isinstance(x, dict),
-            "str": lambda x: isinstance(x, str),
-            "int": lambda x: isinstance(x, int),
-            "float": lambda x: isinstance(x, float)
-        }
+        self._formats = _FORMATS
 
     def validate(self, request: Request) -> Tuple[bool, str]:
         result, reasons = True, []
         for key, format_check in self.requirements.items():
             try:
-                value = hierarchical_dict_lookup(request.raw_request, key)
+                value = request.lookup(key)
             except KeyError:
                 result = False
                 reasons.append({key: "missing"})
@@ -80,3 +104,6 @@ class ArgumentFormatPolicy(Policy):
                 result = False
 
         return result, json.dumps(reasons, indent=4)
+
+    def referenced_keys(self) -> Tuple[str, ...]:
+        return tuple(self.requirements.keys())
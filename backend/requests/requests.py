@@ -1,6 +1,7 @@
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Union, List
 import json
 
+from backend.utils.utils import FlatKeyIndex
 from utils.errors import ValidationError, BottomOfRequestError
 import re
 
@@ -19,17 +20,43 @@ def _validate_request_path(path: str) -> bool:
     return regex.match(path) is not None
 
 
+HEADER_TERMINATOR = b"\r\n\r\n"
+# The terminator is only searched for in this many leading bytes
+MAX_HEADER_LENGTH = 65536
+
+
 class Request:
     """
     Handles the validation and transfer of various request types
     """
-    def __init__(self, request_data: bytes):
-        raw_data = request_data.decode()
-        self.request_method, request_data = Request._decode_http(raw_data)
+    def __init__(self, request_data: Union[bytes, bytearray]):
+        self._key_index = None
+        self._http_headers = None
+        self.request_method, self._header_lines, body = Request._decode_http(request_data)
         try:
-            self._request_data = Request._decode_request(request_data)
+            self._request_data = Request._decode_request(body)
         except Exception as _:
             raise ValidationError("Poorly formatted request. Could not parse the request data.")
+        self._initialize_route()
+
+    @classmethod
+    def from_dict(cls, request_data: Dict, request_method: str = "POST") -> "Request":
+        """
+        Builds a request from already decoded data, skipping the HTTP layer.
+        Used for offline replay and bulk evaluation.
+        :param request_data:
+        :param request_method:
+        :return:
+        """
+        request = cls.__new__(cls)
+        request.request_method = request_method
+        request._http_headers = {}
+        request._request_data = request_data
+        request._key_index = None
+        request._initialize_route()
+        return request
+
+    def _initialize_route(self):
         if self.request_method in ["POST", "GET"]:
             if "entity" not in self._request_data:
                 raise ValidationError("Missing entity for your ")
@@ -39,10 +66,67 @@ class Request:
             self._current_fragment = 0
 
     @staticmethod
-    def _decode_http(raw_data: str) -> Tuple[str, str]:
-        lines = raw_data.split("\r\n")
+    def message_length(received: Union[bytes, bytearray]) -> Union[int, None]:
+        """
+        Total length of a request from its Content-Length, once its headers have been received.
+        :param received: The bytes received so far
+        :return: Length in bytes, or None if the headers are incomplete or there is no Content-Length
+        """
+        head = Request.decode_head(received)
+        if head is None:
+            return None
+        _, headers, body_start = head
+        try:
+            return body_start + int(headers["content-length"])
+        except (KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def decode_head(received: Union[bytes, bytearray]) -> Union[Tuple[List[str], Dict[str, str], int], None]:
+        """
+        Request line and headers, without validating them. Used for messages which are not a single JSON request.
+        :param received: The bytes received so far
+        :return: (request line parts, headers, index where the body starts), or None if the headers are incomplete
+        """
+        header_end = received.find(HEADER_TERMINATOR, 0, MAX_HEADER_LENGTH)
+        if header_end == -1:
+            return None
+        lines = bytes(received[:header_end]).decode("latin-1").split("\r\n")
+        return lines[0].split(" "), Request._decode_headers(lines[1:]), header_end + len(HEADER_TERMINATOR)
+
+    @staticmethod
+    def _decode_headers(lines) -> Dict[str, str]:
+        """
+        :param lines: Header lines, without the request line
+        :return: Lower cased header name -> value
+        """
+        headers = {}
+        for line in lines:
+            name, separator, value = line.partition(":")
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    @staticmethod
+    def _decode_http(raw_data: Union[bytes, bytearray]) -> Tuple[str, List[str], memoryview]:
+        """
+        Parses the request line from the received bytes.
+        Only the head is decoded, the body is returned as a view of the received bytes.
+        :param raw_data:
+        :return: Method, header lines, and body
+        """
+        header_end = raw_data.find(HEADER_TERMINATOR, 0, MAX_HEADER_LENGTH)
+        if header_end == -1:
+            # without a terminator nothing is a body, which fails to decode as the data
+            header_end = min(len(raw_data), MAX_HEADER_LENGTH)
+            body = memoryview(b"")
+        else:
+            body = memoryview(raw_data)[header_end + len(HEADER_TERMINATOR):]
+        lines = raw_data[:header_end].decode("latin-1").split("\r\n")
         # assert correct header line
         status_line = lines[0].split(" ")
+        if len(status_line) != 3:
+            raise ValidationError("Poorly formatted request line.")
         if status_line[1] != "/":
             raise ValidationError("Server only supports root HTTP query.")
         if status_line[2] != "HTTP/1.1":
@@ -52,19 +136,18 @@ class Request:
         if method not in ["GET", "POST", "PUT"]:
             raise ValidationError(
                 "Unsupported method. Use GET to query on resources, POST to register a resource, and PUT to create an entity/organization")
-
-        content = raw_data.split("\r\n\r\n")[-1]
-        return method, content
+        return method, lines[1:], body
 
     @staticmethod
-    def _decode_request(req: str) -> Dict:
+    def _decode_request(req: memoryview) -> Dict:
         """
-        Given bytes, returns the dictionary.
+        Given the body, returns the dictionary.
         Throws a json format error
         :param req:
         :return:
         """
-        return json.loads(req)
+        # the JSON decoder reads a str, so the body is copied once, as it is decoded
+        return json.loads(str(req, "utf-8"))
 
     def _post_validation(self):
         if "entity" not in self._request_data:
@@ -132,6 +215,34 @@ class Request:
     def headers(self):
         return list(self._request_data.keys())
 
+    @property
+    def http_headers(self) -> Dict[str, str]:
+        """
+        Lower cased header name -> value, parsed on first use
+        :return:
+        """
+        if self._http_headers is None:
+            self._http_headers = Request._decode_headers(self._header_lines)
+        return self._http_headers
+
+    @property
+    def key_index(self) -> FlatKeyIndex:
+        """
+        Flat index of every dotted key in the request, built on first use and shared by all policies
+        :return:
+        """
+        if self._key_index is None:
+            self._key_index = FlatKeyIndex(self._request_data)
+        return self._key_index
+
+    def lookup(self, key: str):
+        """
+        Value at a dotted key of the request
+        :param key:
+        :return:
+        """
+        return self.key_index.lookup(key)
+
 
 if __name__ == "__main__":
     print(_validate_request_path("a.0aa_.bbbb"))
@@ -2,7 +2,9 @@ import json
 from typing import Dict, Union
 
 from backend.entity.entities import get_entity_class_from_type_string, Entity
+from backend.policies.artifact import PolicyArtifact
 from backend.policies.factory import PolicyFactory
+from backend.policies.policy import Policy
 
 
 class GenerateEntities:
@@ -10,24 +12,35 @@ class GenerateEntities:
     def generate_entity_from_json_path(path: str):
         with open(path, "r") as file:
             data = json.load(file)
-        return GenerateEntities.generate_entity_from_dict(data, data["Entity_Name"])
+        artifact = PolicyArtifact.load(data["Entity_Name"])
+        compiled = None if artifact is None else artifact["entities"]
+        return GenerateEntities.generate_entity_from_dict(data, data["Entity_Name"], compiled_policies=compiled)
 
     @staticmethod
-    def generate_entity_from_dict(data: Dict, association_name: str) -> Union[Entity, dict]:
+    def generate_entity_from_dict(data: Dict, association_name: str, compiled_policies: Dict[str, Policy] = None,
+                                  parent_path: str = None) -> Union[Entity, dict]:
         """
         Create an entity from a dictionary
         :param association_name: The root association name. This will come into play with policies.
         :param data:
+        :param compiled_policies: Dotted entity path -> compiled policy, ex. from the organization's artifact.
+        Entities not in it have their policy compiled from data.
+        :param parent_path: Dotted path of the parent entity
         :return: Entity
         """
         parent_entity_name = data["Entity_Name"]
+        path = parent_entity_name if parent_path is None else f"{parent_path}.{parent_entity_name}"
         parent_type = data["Type"]
         parent_children = data.get("Children", [])
-        parent_children = [GenerateEntities.generate_entity_from_dict(child, association_name) for child in parent_children]
-        parent_policy = data.get("Policy", "FullApproval")
+        parent_children = [GenerateEntities.generate_entity_from_dict(child, association_name, compiled_policies, path)
+                           for child in parent_children]
+        policy = None if compiled_policies is None else compiled_policies.get(path)
+        if policy is None:
+            parent_policy = data.get("Policy", "FullApproval")
+            policy = PolicyFactory.memoize(PolicyFactory.get_policy_from_argument(parent_policy, org_name=association_name))
         return get_entity_class_from_type_string(parent_type)(
             parent_entity_name,
-            PolicyFactory.get_policy_from_argument(parent_policy, org_name=association_name),
+            policy,
             parent_children,
             association_name
         )
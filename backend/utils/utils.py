@@ -1,18 +1,91 @@
 import re
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+_ISO8601 = re.compile(r'^(-?(?:[1-9][0-9]*)?[0-9]{4})-(1[0-2]|0[1-9])-(3[01]|0[1-9]|[12][0-9])T(2[0-3]|[01][0-9]):([0-5][0-9]):([0-5][0-9])(\.[0-9]+)?(Z|[+-](?:2[0-3]|[01][0-9]):[0-5][0-9])?$')
 
 
 def validate_iso8601(time: str):
-    regex = r'^(-?(?:[1-9][0-9]*)?[0-9]{4})-(1[0-2]|0[1-9])-(3[01]|0[1-9]|[12][0-9])T(2[0-3]|[01][0-9]):([0-5][0-9]):([0-5][0-9])(\.[0-9]+)?(Z|[+-](?:2[0-3]|[01][0-9]):[0-5][0-9])?$'
     try:
-        match_iso8601 = re.compile(regex).match
-        if match_iso8601(time) is not None:
+        if _ISO8601.match(time) is not None:
             return True
     except:
         pass
     return False
 
 
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    """
+    Days since 1970-01-01 of a proleptic Gregorian date, for any year
+    """
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def iso8601_to_microseconds(time: str) -> int:
+    """
+    Converts an ISO 8601 time, as accepted by validate_iso8601, to microseconds since the epoch.
+    Times without an offset are UTC, and fractions beyond microseconds are truncated.
+    :param time:
+    :return:
+    """
+    match = _ISO8601.match(time)
+    if match is None:
+        raise ValueError(f"{time} is not an ISO 8601 time.")
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    seconds = (_days_from_civil(int(year), int(month), int(day)) * 86400
+               + int(hour) * 3600 + int(minute) * 60 + int(second))
+    if offset is not None and offset != "Z":
+        sign = 1 if offset[0] == "+" else -1
+        seconds -= sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    microseconds = int((fraction[1:] + "000000")[:6]) if fraction is not None else 0
+    return seconds * 1000000 + microseconds
+
+
+def _days_from_civil_array(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """
+    _days_from_civil of arrays of dates
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def iso8601_series_to_microseconds(times: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    iso8601_to_microseconds for a column of times, parsed with one vectorized pass per field
+    :param times:
+    :return: (microseconds since the epoch, which rows are valid ISO 8601 times). Invalid rows are 0.
+    """
+    parts = times.astype("string").str.extract(_ISO8601)
+    valid = parts[0].notna().to_numpy()
+    parts = parts[valid]
+    fields = [parts[index].astype(np.int64).to_numpy() for index in range(6)]
+    year, month, day, hour, minute, second = fields
+    seconds = _days_from_civil_array(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+    offset = parts[7].fillna("Z")
+    zoned = (offset != "Z").to_numpy()
+    if zoned.any():
+        local = offset[zoned]
+        sign = np.where(local.str[0] == "+", 1, -1)
+        seconds[zoned] -= sign * (local.str[1:3].astype(np.int64).to_numpy() * 3600
+                                  + local.str[4:6].astype(np.int64).to_numpy() * 60)
+    fraction = parts[6].fillna(".").str[1:].str.pad(6, side="right", fillchar="0").str[:6].astype(np.int64).to_numpy()
+    microseconds = np.zeros(len(times), dtype=np.int64)
+    microseconds[valid] = seconds * 1000000 + fraction
+    return microseconds, valid
+
+
 def hierarchical_dict_lookup(dictionary: Dict[str, Any], key: str):
     """
     Looks up multi level keys.
@@ -59,6 +132,56 @@ def hierarchical_keys(dictionary: Dict[str, Any], parent_key=None):
     return non_dict_keys
 
 
+class FlatKeyIndex:
+    """
+    Flattened view of a nested dictionary, built in a single walk.
+    Holds the value at every dotted key, the keys in the same order as hierarchical_keys, and for every
+    nested dictionary the range of its descendants within that key list.
+    """
+
+    def __init__(self, dictionary: Dict[str, Any]):
+        self._values: Dict[str, Any] = {}
+        self._families: Dict[str, Tuple[int, int]] = {}
+        self.keys: List[str] = []
+        self._build(dictionary, None)
+
+    def _build(self, dictionary: Dict[str, Any], parent_key):
+        for key, value in dictionary.items():
+            current_key = key if parent_key is None else f"{parent_key}.{key}"
+            if isinstance(value, dict):
+                # children are listed right before their parent, so they form a contiguous range
+                start = len(self.keys)
+                self._build(value, current_key)
+                self._families[current_key] = (start, len(self.keys))
+            self.keys.append(current_key)
+            self._values[current_key] = value
+
+    def lookup(self, key: str) -> Any:
+        """
+        Same as hierarchical_dict_lookup on the indexed dictionary
+        :param key:
+        :return:
+        """
+        try:
+            return self._values[key]
+        except KeyError:
+            raise KeyError(f"{key} not found in dictionary")
+
+    def family(self, key: str) -> List[str]:
+        """
+        Every key below key, same as hierarchical_keys(lookup(key), parent_key=key)
+        :param key:
+        :return:
+        """
+        if key not in self._families:
+            raise KeyError(f"{key} not found in dictionary, or is not a dictionary")
+        start, end = self._families[key]
+        return self.keys[start:end]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._values
+
+
 if __name__ == "__main__":
     d = {
         "a": "dw",
@@ -0,0 +1,374 @@
+"""
+Micro-benchmarks of the policy engine.
+
+Every case is measured for build time, per-request evaluation time and peak memory.
+Synthetic payloads are generated from a fixed seed, timings are the minimum (and median) of several calibrated
+repeats with the garbage collector disabled, and results are written as JSON so runs on different commits can be
+compared:
+
+python -m benchmarks.policy_benchmarks --output before.json
+python -m benchmarks.policy_benchmarks --compare before.json
+
+With --batch, the cases on wide payloads are also evaluated on BATCH_SIZE payloads by BatchPolicyEvaluator, as bulk
+imports route them, after checking that every decision and reason is the one the policy gives by itself.
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Any, Tuple
+
+from backend.policies.batch import BatchPolicyEvaluator
+from backend.policies.factory import PolicyFactory
+from backend.policies.fol_policies.policy import FolPolicyFactory
+from backend.policies.policy import Policy
+from backend.requests.requests import Request
+
+SEED = 1234
+BATCH_SIZE = 1000
+# cases whose payloads are _wide_payload, which are evaluated in batches
+BATCH_CASES = ("match_wide", "comparisons_wide", "deep_and_or", "fol_deep_connectives", "fol_quantifier_all_keys",
+               "regex_heavy")
+MIN_REPEAT_SECONDS = 0.05
+ISO_REGEX = r'^(-?(?:[1-9][0-9]*)?[0-9]{4})-(1[0-2]|0[1-9])-(3[01]|0[1-9]|[12][0-9])T(2[0-3]|[01][0-9]):([0-5][0-9]):([0-5][0-9])(\.[0-9]+)?(Z|[+-](?:2[0-3]|[01][0-9]):[0-5][0-9])?$'
+
+# The sentences and request of the fol_policies/policy.py examples
+FOL_EXAMPLE_LITERALS = [
+    f"[(($a~\"{ISO_REGEX}\") & ($b~\"{ISO_REGEX}\")) & ($b>$a)]",
+    f"[(($a~\"{ISO_REGEX}\") & ($b~\"{ISO_REGEX}\")) & ($b<$a)]",
+    "($entity=a)",
+    "!($entity=a)",
+    f"[!($entity=a) | [(($a~\"{ISO_REGEX}\") & ($b~\"{ISO_REGEX}\")) & ($b>$a)]]",
+    f"[!($entity=a) & [(($a~\"{ISO_REGEX}\") & ($b~\"{ISO_REGEX}\")) & ($b>$a)]]",
+    f"[(($data.a~\"{ISO_REGEX}\") & ($data.b~\"{ISO_REGEX}\")) & ($data.b>$data.a)]",
+    f"[(($data.a~\"{ISO_REGEX}\") & ($data.b~\"{ISO_REGEX}\")) & ($data.b<$data.a)]",
+    f"[!($entity=a) | [(($data.a~\"{ISO_REGEX}\") & ($data.b~\"{ISO_REGEX}\")) & ($data.b>$data.a)]]",
+    f"[!!!($entity=a) & [(($data.a~\"{ISO_REGEX}\") & ($data.b~\"{ISO_REGEX}\")) & ($data.b>$data.a)]]",
+    "[$c=d]",
+    "![$c=d]",
+    "[$float>$int]",
+    "[$float<$int]",
+    "Ex($x=2.2)",
+    "ExEt[($x=2.2)&($t=exact)]",
+    "!ExEt[($x=2.2)&($t=exact)]",
+    "Ex!Et[($x=2.2)&($t=exacto)]",
+    "!Ex!Et[($x=2.2)&($t=exacto)]",
+    "AxEt[($t>$x)|(t=x)]",
+    "!AxEt[($t>$x)|(t=x)]",
+    "Ax(x>-1)",
+    "Ax($x>3)",
+    f"Ax@['data']($x~\"{ISO_REGEX})\")",
+    f"Ax@['data.*']($x~\"{ISO_REGEX})\")",
+    f"Ax@['data.*', 'data']($x~\"{ISO_REGEX})\")",
+    f"Ax@['data.*']Ey@['a', 'b']([[$x~\"{ISO_REGEX})\"]&[$y~\"{ISO_REGEX})\"]]&($y>$x))",
+    "(2<=3)",
+    "(3<=3)",
+    "(3>=3)",
+    "(4>=3)",
+    "(2>=3)",
+    "!(2>=3)",
+    "(2-1=1)",
+    "Ex@['float', 'int']($x>3-2)",
+    "(3/2>3/3)",
+    "(3//2>3//3)",
+    "($float-$int>2)",
+]
+FOL_EXAMPLE_REQUEST = {
+    "entity": "a",
+    "a": "2024-12-13T12:12:12.000Z",
+    "b": "2024-12-13T12:12:12.002Z",
+    "float": 2.2,
+    "int": 2,
+    "exeact": "exact",
+    "data": {
+        "a": "2024-12-13T12:12:12.000Z",
+        "b": "2024-12-13T12:12:12.001Z"
+    }
+}
+
+# The policy and request of the factory.py example
+FACTORY_EXAMPLE_POLICY = {
+    "formatted_arguments": {
+        "data.date": "iso8601",
+        "data.date2": "iso8601"
+    },
+    "equality": ["data.date", "data.date2"],
+    "lesser_than_eq": {
+        "data.date": "2024-01-12T12:30:16.001Z"
+    },
+    "or": [
+        {"match": {"hello": ["worlds", "world"]}},
+        {"match": {"hello": ["wor2ld", "world"]}}
+    ]
+}
+FACTORY_EXAMPLE_REQUEST = {
+    "header": "hi",
+    "request": "uofc.hi",
+    "entity": "uofc.hi",
+    "data": {
+        "date": "2024-01-12T12:30:16.001Z",
+        "date2": "2024-01-12T12:30:16.001Z"
+    },
+    "hello": "wor2ld"
+}
+
+
+class ExamplePolicySet(Policy):
+    """
+    Evaluates a list of policies one after the other, so a set of examples is measured as one case
+    """
+
+    def __init__(self, policies: List[Policy]):
+        super().__init__(False)
+        self._policies = policies
+
+    def validate(self, request: Request):
+        return [policy(request) for policy in self._policies]
+
+
+class BenchmarkCase:
+    def __init__(self, name: str, build: Callable[[], Policy], requests: List[Dict[str, Any]]):
+        self.name = name
+        self.build = build
+        # decoded payloads, a fresh Request is built for each evaluation so per-request caches are not reused
+        self.requests = requests
+
+
+def _deep_and_or(depth: int, width: int) -> Dict:
+    """
+    Dictionary policy alternating and/or at every level, with match checks as leaves
+    :param depth:
+    :param width:
+    :return:
+    """
+    if depth == 0:
+        return {"match": {f"data.k{width - 1}": ["v1", "v2"]}}
+    connective = "and" if depth % 2 == 0 else "or"
+    return {connective: [_deep_and_or(depth - 1, width) for _ in range(2)] + [
+        {"match": {f"data.k{i}": ["v0", f"v{i}"]}} for i in range(width)
+    ]}
+
+
+def _fol_connective_chain(depth: int) -> str:
+    literal = "($data.k0=v0)"
+    for i in range(1, depth):
+        connective = "&" if i % 2 == 0 else "|"
+        literal = f"[{literal}{connective}($data.k{i % 16}=v{i % 16})]"
+    return literal
+
+
+def _wide_payload(rng: random.Random, width: int) -> Dict:
+    return {
+        "entity": "bench.entity",
+        "user": {"email": "someone@example.com", "id": rng.randint(0, 10 ** 6)},
+        "data": {f"k{i}": f"v{rng.randint(0, 3)}" for i in range(width)}
+    }
+
+
+def build_cases() -> List[BenchmarkCase]:
+    rng = random.Random(SEED)
+    wide = [_wide_payload(rng, 16) for _ in range(8)]
+    wider = [_wide_payload(rng, 48) for _ in range(4)]
+    regex_keys = {f"data.k{i}": r"^v[0-9]+$" for i in range(16)}
+    return [
+        BenchmarkCase("fol_examples", lambda: ExamplePolicySet(
+            [FolPolicyFactory.get_policy_from_literal(literal) for literal in FOL_EXAMPLE_LITERALS]
+        ), [FOL_EXAMPLE_REQUEST]),
+        BenchmarkCase("factory_example", lambda: PolicyFactory.get_policy_from_argument(FACTORY_EXAMPLE_POLICY),
+                      [FACTORY_EXAMPLE_REQUEST]),
+        BenchmarkCase("deep_and_or", lambda: PolicyFactory.get_policy_from_argument(_deep_and_or(4, 8)), wide),
+        BenchmarkCase("fol_deep_connectives", lambda: FolPolicyFactory.get_policy_from_literal(_fol_connective_chain(64)), wide),
+        BenchmarkCase("fol_nested_quantifiers_wide", lambda: FolPolicyFactory.get_policy_from_literal(
+            "Ax@['data.*']Ey@['data.*']([$x=$y]|[$y>$x])"
+        ), wider),
+        BenchmarkCase("fol_quantifier_all_keys", lambda: FolPolicyFactory.get_policy_from_literal(
+            "Ex($x=someone@example.com)"
+        ), wider),
+        BenchmarkCase("match_wide", lambda: PolicyFactory.get_policy_from_argument({
+            "match": {f"data.k{i}": ["v0", "v1", "v2", "v3"] for i in range(8)}
+        }), wide),
+        BenchmarkCase("comparisons_wide", lambda: PolicyFactory.get_policy_from_argument({"and": [
+            {"match": {"data.k0": ["v0", "v1", "v2"]}},
+            {"lesser_than": {"user.id": 10 ** 6}},
+            {"equality": ["data.k1", "data.k1"]}
+        ]}), wide),
+        BenchmarkCase("regex_heavy", lambda: PolicyFactory.get_policy_from_argument({
+            "regex": regex_keys,
+            "fol": f"Ax@['data.*']($x~\"^v[0-9]+$\")"
+        }), wide),
+    ]
+
+
+def _time(function: Callable[[], Any], repeat: int) -> Tuple[float, float]:
+    """
+    Minimum and median over repeats of the mean time of one call.
+    The minimum is the least disturbed by other load on the machine, so comparisons use it.
+    The number of calls per repeat is calibrated so that each repeat takes at least MIN_REPEAT_SECONDS.
+    :param function:
+    :param repeat:
+    :return: (minimum, median) seconds
+    """
+    number, elapsed = 1, 0.
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_REPEAT_SECONDS:
+            break
+        number *= 2
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings), statistics.median(timings)
+
+
+def _peak_memory(function: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(case: BenchmarkCase, repeat: int) -> Dict[str, Any]:
+    policy = case.build()
+
+    def evaluate_all():
+        for request in case.requests:
+            policy(Request.from_dict(request))
+
+    # warm up
+    case.build()
+    evaluate_all()
+    gc.collect()
+    gc.disable()
+    try:
+        build_min, build_median = _time(case.build, repeat)
+        evaluate_min, evaluate_median = _time(evaluate_all, repeat)
+    finally:
+        gc.enable()
+    return {
+        "build_us": build_min * 1e6,
+        "build_median_us": build_median * 1e6,
+        "evaluate_us_per_request": evaluate_min / len(case.requests) * 1e6,
+        "evaluate_median_us_per_request": evaluate_median / len(case.requests) * 1e6,
+        "build_peak_bytes": _peak_memory(case.build),
+        "evaluate_peak_bytes": _peak_memory(evaluate_all),
+    }
+
+
+def run_batch_case(case: BenchmarkCase, repeat: int) -> Dict[str, Any]:
+    """
+    Time per request of evaluating BATCH_SIZE payloads one at a time, and in one batch
+    :param case:
+    :param repeat:
+    :return:
+    """
+    rng = random.Random(SEED)
+    payloads = [_wide_payload(rng, 16) for _ in range(BATCH_SIZE)]
+    policy = case.build()
+    evaluator = BatchPolicyEvaluator(policy)
+
+    def one_at_a_time():
+        return [policy.validate(Request.from_dict(payload)) for payload in payloads]
+
+    def batch():
+        return evaluator.evaluate([Request.from_dict(payload) for payload in payloads])
+
+    # the batch must decide as the policy does
+    expected = one_at_a_time()
+    approved, reasons = batch()
+    for row, (result, reason) in enumerate(expected):
+        if bool(approved[row]) != bool(result) or (not result and reasons[row] != reason):
+            raise AssertionError(f"Batch evaluation of {case.name} differs on payload {row}")
+    gc.collect()
+    gc.disable()
+    try:
+        scalar_min, _ = _time(one_at_a_time, repeat)
+        batch_min, _ = _time(batch, repeat)
+    finally:
+        gc.enable()
+    return {
+        "scalar_us_per_request": scalar_min / BATCH_SIZE * 1e6,
+        "batch_us_per_request": batch_min / BATCH_SIZE * 1e6,
+        "approved": int(approved.sum()),
+        "requests": BATCH_SIZE
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run(repeat: int, name_filter: str = None, batch: bool = False) -> Dict[str, Any]:
+    results, batch_results = {}, {}
+    for case in build_cases():
+        if name_filter is not None and name_filter not in case.name:
+            continue
+        results[case.name] = run_case(case, repeat)
+        if batch and case.name in BATCH_CASES:
+            batch_results[case.name] = run_batch_case(case, repeat)
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": SEED,
+        "repeat": repeat,
+        "results": results,
+        "batch_results": batch_results
+    }
+
+
+def print_results(report: Dict[str, Any], baseline: Dict[str, Any] = None) -> None:
+    print(f"commit {report['commit']} python {report['python']}")
+    header = f"{'case':<30}{'build us':>12}{'eval us/req':>14}{'build peak B':>14}{'eval peak B':>14}"
+    if baseline is not None:
+        header += f"{'build x':>10}{'eval x':>10}"
+        print(f"compared to commit {baseline['commit']}")
+    print(header)
+    for name, result in report["results"].items():
+        line = (f"{name:<30}{result['build_us']:>12.1f}{result['evaluate_us_per_request']:>14.1f}"
+                f"{result['build_peak_bytes']:>14}{result['evaluate_peak_bytes']:>14}")
+        if baseline is not None and name in baseline["results"]:
+            old = baseline["results"][name]
+            line += (f"{result['build_us'] / old['build_us']:>10.2f}"
+                     f"{result['evaluate_us_per_request'] / old['evaluate_us_per_request']:>10.2f}")
+        print(line)
+    if len(report.get("batch_results", {})) > 0:
+        print(f"\n{'batch of ' + str(BATCH_SIZE):<30}{'scalar us/req':>14}{'batch us/req':>14}{'speedup':>10}{'approved':>10}")
+        for name, result in report["batch_results"].items():
+            print(f"{name:<30}{result['scalar_us_per_request']:>14.1f}{result['batch_us_per_request']:>14.1f}"
+                  f"{result['scalar_us_per_request'] / result['batch_us_per_request']:>10.2f}{result['approved']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Policy engine micro-benchmarks")
+    parser.add_argument("--repeat", type=int, default=7, help="Timing repeats, the minimum and median are reported")
+    parser.add_argument("--filter", default=None, help="Only run cases containing this string")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this path")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare against")
+    parser.add_argument("--batch", action="store_true", help="Also compare batch evaluation to one request at a time")
+    args = parser.parse_args()
+
+    report = run(args.repeat, args.filter, args.batch)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+    print_results(report, baseline)
+    if args.output is not None:
+        with open(args.output, "w+") as file:
+            json.dump(report, file, indent=4)
@@ -0,0 +1,125 @@
+"""
+Benchmarks of request parsing.
+
+Compares Request, which decodes only the head and then the body, with the legacy parser which decoded the whole message
+to str and split it before decoding the JSON body. Both decode the body once and JSON decoding dominates, so small
+requests parse in about the same time. Large ones save the split of the whole message and its peak memory, by an amount
+which varies from machine to machine. Payloads are generated from a fixed seed:
+
+python -m benchmarks.request_benchmarks --output before.json
+python -m benchmarks.request_benchmarks --compare before.json
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+from typing import Callable, Dict, Any
+
+from backend.requests.requests import Request
+from benchmarks.policy_benchmarks import SEED, _time, _peak_memory, _commit
+
+PAYLOAD_SIZES = {
+    "small": 512,
+    "1mb": 1024 * 1024
+}
+
+
+class LegacyRequest(Request):
+    """
+    Request as it parsed before working on bytes: the whole message is decoded to str and split twice
+    """
+
+    def __init__(self, request_data: bytes):
+        self._key_index = None
+        self._http_headers = {}
+        raw_data = request_data.decode()
+        lines = raw_data.split("\r\n")
+        status_line = lines[0].split(" ")
+        if status_line[1] != "/" or status_line[2] != "HTTP/1.1":
+            raise ValueError("Invalid request line")
+        self.request_method = status_line[0]
+        self._request_data = json.loads(raw_data.split("\r\n\r\n")[-1])
+        self._initialize_route()
+
+
+def build_message(size: int, rng: random.Random) -> bytes:
+    """
+    A POST request whose body is roughly size bytes
+    :param size:
+    :param rng:
+    :return:
+    """
+    body = {
+        "entity": "bench.tickets",
+        "user": {"email": "someone@example.com", "name": "someone"},
+        "data": {"quantity": 1, "notes": []}
+    }
+    while len(json.dumps(body)) < size:
+        body["data"]["notes"].append({"id": rng.randint(0, 10 ** 6), "text": "x" * rng.randint(8, 64)})
+    encoded = json.dumps(body).encode()
+    head = (f"POST / HTTP/1.1\r\nHost: localhost:6000\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(encoded)}\r\n\r\n").encode()
+    return head + encoded
+
+
+def _measure(function: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    function()
+    gc.collect()
+    gc.disable()
+    try:
+        minimum, median = _time(function, repeat)
+    finally:
+        gc.enable()
+    return {"parse_us": minimum * 1e6, "parse_median_us": median * 1e6, "peak_bytes": _peak_memory(function)}
+
+
+def run(repeat: int) -> Dict[str, Any]:
+    rng = random.Random(SEED)
+    results = {}
+    for name, size in PAYLOAD_SIZES.items():
+        message = build_message(size, rng)
+        assert Request(message).raw_request == LegacyRequest(message).raw_request
+        results[f"{name}_legacy"] = _measure(lambda: LegacyRequest(message), repeat)
+        results[f"{name}_request"] = _measure(lambda: Request(message), repeat)
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": SEED,
+        "repeat": repeat,
+        "results": results
+    }
+
+
+def print_results(report: Dict[str, Any], baseline: Dict[str, Any] = None) -> None:
+    print(f"commit {report['commit']} python {report['python']}")
+    header = f"{'case':<30}{'parse us':>12}{'peak B':>14}{'vs legacy':>12}"
+    if baseline is not None:
+        header += f"{'parse x':>10}"
+        print(f"compared to commit {baseline['commit']}")
+    print(header)
+    for name, result in report["results"].items():
+        legacy = report["results"][f"{name.split('_')[0]}_legacy"]
+        line = f"{name:<30}{result['parse_us']:>12.1f}{result['peak_bytes']:>14}{result['parse_us'] / legacy['parse_us']:>12.2f}"
+        if baseline is not None and name in baseline["results"]:
+            line += f"{result['parse_us'] / baseline['results'][name]['parse_us']:>10.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Request parsing benchmarks")
+    parser.add_argument("--repeat", type=int, default=7, help="Timing repeats, the minimum and median are reported")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this path")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    report = run(args.repeat)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+    print_results(report, baseline)
+    if args.output is not None:
+        with open(args.output, "w+") as file:
+            json.dump(report, file, indent=4)
@@ -3,6 +3,49 @@ import os
 DEFAULT_IP = os.environ.get("SERVER_IP", "10.0.0.43")
 DEFAULT_PORT = os.environ.get("SERVER_PORT", 6000)
 BUFFER_SIZE = 2048
+# Maximum number of memoized decisions per policy. 0 disables the cache.
+POLICY_CACHE_SIZE = int(os.environ.get("POLICY_CACHE_SIZE", 1024))
+# Seconds between the server reloading policies which changed, so that the workers it forks inherit their decisions
+POLICY_CATALOG_REFRESH_SECONDS = float(os.environ.get("POLICY_CATALOG_REFRESH_SECONDS", 5))
+# Reorder And/Or children by observed cost and selectivity, unless a policy pins its order
+ADAPTIVE_POLICY_ORDERING = os.environ.get("ADAPTIVE_POLICY_ORDERING", "0") == "1"
+ADAPTIVE_REORDER_INTERVAL = int(os.environ.get("ADAPTIVE_REORDER_INTERVAL", 256))
+# Work allowed for one evaluation of a FOL sentence before it is rejected
+FOL_MAX_EVALUATION_STEPS = int(os.environ.get("FOL_MAX_EVALUATION_STEPS", 100000))
+FOL_MAX_EVALUATION_SECONDS = float(os.environ.get("FOL_MAX_EVALUATION_SECONDS", 0.25))
+FOL_MAX_REGEX_INPUT_LENGTH = int(os.environ.get("FOL_MAX_REGEX_INPUT_LENGTH", 4096))
+# Seconds one match of a regular expression policy may take
+POLICY_REGEX_TIMEOUT_SECONDS = float(os.environ.get("POLICY_REGEX_TIMEOUT_SECONDS", 0.25))
+# Static complexity limit for policies registered with PUT, and the domain width assumed for unbounded quantifiers
+MAX_POLICY_COMPLEXITY = int(os.environ.get("MAX_POLICY_COMPLEXITY", 50000))
+ASSUMED_DOMAIN_WIDTH = int(os.environ.get("ASSUMED_DOMAIN_WIDTH", 64))
+# Request keys fixed for a route, which entity policies are partially evaluated on. Empty disables it.
+PARTIAL_EVALUATION_KEYS = [key for key in os.environ.get("PARTIAL_EVALUATION_KEYS", "entity").split(",") if key]
+# Bulk import: POST {BULK_IMPORT_PATH}/<organization> with a newline delimited JSON body
+BULK_IMPORT_PATH = "/bulk"
+# Registrations written per group commit, and the largest accepted record
+BULK_GROUP_SIZE = int(os.environ.get("BULK_GROUP_SIZE", 1000))
+BULK_MAX_RECORD_BYTES = int(os.environ.get("BULK_MAX_RECORD_BYTES", 1024 * 1024))
+# Expended rows are appended to a log, which a background thread compacts into the CSV snapshot once above this size
+LOG_COMPACTION_BYTES = int(os.environ.get("LOG_COMPACTION_BYTES", 1024 * 1024))
+LOG_COMPACTION_INTERVAL = float(os.environ.get("LOG_COMPACTION_INTERVAL", 30))
+# Storage of new organizations' resource tables: csv or sqlite. Existing organizations keep the backend they were created with.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "csv")
+# Seconds a SQLite worker waits on another worker's write transaction
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 5))
+# When registrations are flushed to disk: commit (fsync before answering), batched (fsync within DURABILITY_BATCH_MS)
+# or os (left to the OS). Organizations may choose their own with "Durability" when they are created.
+DURABILITY_MODES = ("commit", "batched", "os")
+DURABILITY = os.environ.get("DURABILITY", "commit")
+DURABILITY_BATCH_MS = float(os.environ.get("DURABILITY_BATCH_MS", 10))
+# Keep the tickets taken and the slots expended of every entity in shared memory, so workers check registrations without reading the storage
+SHARED_ENTITY_STATE = os.environ.get("SHARED_ENTITY_STATE", "0") == "1"
+# Threads of a worker reading the entities of a GET concurrently, 0 reads them one after another.
+# Entities not read within the deadline of a query, in seconds, are returned as such. 0 disables it.
+QUERY_READ_WORKERS = int(os.environ.get("QUERY_READ_WORKERS", 8))
+QUERY_DEADLINE_SECONDS = float(os.environ.get("QUERY_DEADLINE_SECONDS", 30))
+# GET results of an entity cached on disk per organization, valid while the data version of the entity is unchanged. 0 disables it.
+QUERY_CACHE_ENTRIES = int(os.environ.get("QUERY_CACHE_ENTRIES", 1024))
 
 SUCCESS = 200
 POOR_FORMAT = 400
@@ -10,6 +53,7 @@ REJECTED_BY_ENTITY = 401
 ROUTE_DNE = 404
 INVALID_REQUEST = 403
 UNKNOWN = 402
+NOT_MODIFIED = 304
 
 TEMPORARY_DATA_ROOT = "/home/andrewheschl/PycharmProjects/ResourceScheduler/backend/temp_sus_database"
 if not os.path.exists(TEMPORARY_DATA_ROOT):
@@ -89,3 +89,27 @@ class MalformedEntityError(Exception):
 
     def __str__(self):
         return f'MalformedEntityError: {self._message}'
+
+
+class EvaluationBudgetExceededError(Exception):
+    def __init__(self, message: str = ""):
+        self._message = message
+
+    def __str__(self):
+        return f'EvaluationBudgetExceededError: {self._message}'
+
+
+class PolicyComplexityError(Exception):
+    def __init__(self, message: str = ""):
+        self._message = message
+
+    def __str__(self):
+        return f'PolicyComplexityError: {self._message}'
+
+
+class QueryDeadlineError(Exception):
+    def __init__(self, message: str = ""):
+        self._message = message
+
+    def __str__(self):
+        return f'QueryDeadlineError: {self._message}'